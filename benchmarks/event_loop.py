@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 对比默认事件循环与uvloop的TCP转发性能，在仓库根目录执行：
+# python3 -m benchmarks.event_loop [-t 5] [-c 8] [-s 256] [-n 4]
+
+__author__ = "Guation"
+
+import argparse, multiprocessing, threading, time
+from nat1_traversal.util.event_loop import event_loop_available
+from benchmarks.tcp_relay import UPLOAD, bench, client_session, forwarder, start_backend
+
+def connection_rate(addr, duration, concurrency):
+    # type: (tuple, float, int) -> float
+    """Completed connect + request + response + close cycles per second."""
+    count = [0] * concurrency
+    deadline = time.perf_counter() + duration
+    def worker(i):
+        while time.perf_counter() < deadline:
+            client_session(addr, UPLOAD, 0)
+            count[i] += 1
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(count) / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio vs uvloop")
+    parser.add_argument("-t", "--time", type=float, default=5, help="连接速率测试时长（秒）")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="连接速率测试并发数")
+    parser.add_argument("-s", "--size", type=int, default=256, help="吞吐量测试每个连接传输的MiB数")
+    parser.add_argument("-n", "--connections", type=int, default=4, help="吞吐量测试并发连接数")
+    args = parser.parse_args()
+
+    remote = start_backend()
+    for event_loop in ("asyncio", "uvloop"):
+        if not event_loop_available(event_loop):
+            print("%-8s 未安装，跳过" % event_loop)
+            continue
+        with forwarder(remote, event_loop=event_loop) as (local, _):
+            rate = connection_rate(local, args.time, args.concurrency)
+        upload, download, cpu = bench(remote, args.size * 1024 * 1024, args.connections, event_loop=event_loop)
+        print("%-8s %8.0f conn/s  upload %9.1f MiB/s  download %9.1f MiB/s  cpu %6.2f ms/MiB" % (event_loop, rate, upload, download, cpu))
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 启动导入耗时检查，超出预算或导入了不该导入的模块时返回1，在仓库根目录执行：
+# python3 -m benchmarks.import_time [-n 5] [-b 150] [-t 10]
+
+__author__ = "Guation"
+
+import argparse, subprocess, sys
+
+ENTRY = "nat1_traversal.nat1_traversal"
+PROCESS_MAIN = "nat1_traversal.util.process_main" # spawn出的转发进程导入的全部内容
+FORBIDDEN = ("requests", "charset_normalizer", "urllib3", "http.server") # 启动和转发进程都不应导入
+ENTRY_ONLY = ("argparse", "nat1_traversal.nat1_traversal", "nat1_traversal.dns") # 只有入口需要，转发进程不应导入
+DNS_ALLOWED = ("nat1_traversal.dns", "nat1_traversal.dns.dns_base") # DNS供应商应在使用时才导入
+
+def import_time(module):
+    # type: (str) -> tuple[int, dict[str, tuple[int, int]]]
+    """Cumulative microseconds of importing `module` and (self, cumulative) of every module it loaded."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        if not _self.strip().isdigit():
+            continue # 表头
+        modules[name.strip()] = (int(_self), int(cumulative))
+    return modules[module][1], modules
+
+def forbidden(modules, entry_only=()):
+    # type: (dict[str, tuple[int, int]], tuple[str, ...]) -> list[str]
+    """Forbidden packages among the loaded modules, submodules are reported by their package."""
+    bad = set()
+    for x in modules:
+        if any(x == y or x.startswith(y + ".") for y in entry_only):
+            bad.add(x)
+        elif x.startswith("nat1_traversal.dns.") and x not in DNS_ALLOWED:
+            bad.add(x)
+        elif x.split(".")[0] in FORBIDDEN:
+            bad.add(x.split(".")[0])
+        elif x in FORBIDDEN:
+            bad.add(x)
+    return sorted(bad)
+
+def best(module, runs):
+    # type: (str, int) -> tuple[int, dict[str, tuple[int, int]]]
+    """The fastest of `runs` imports, the first ones are slowed down by a cold disk cache."""
+    return min((import_time(module) for _ in range(runs)), key=lambda x: x[0])
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time budget of the entry point and the forwarder processes")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="每个模块的导入次数，取最快一次")
+    parser.add_argument("-b", "--budget", type=float, default=150, help="入口模块的导入耗时预算（毫秒）")
+    parser.add_argument("-t", "--top", type=int, default=10, help="列出自身耗时最多的模块数")
+    args = parser.parse_args()
+
+    failed = False
+    for module in (ENTRY, PROCESS_MAIN):
+        total, modules = best(module, args.runs)
+        print("%-40s %7.1f ms %4d modules" % (module, total / 1000, len(modules)))
+        bad = forbidden(modules, ENTRY_ONLY if module == PROCESS_MAIN else ())
+        if bad:
+            print("  不应导入：" + ", ".join(bad))
+            failed = True
+        if module == ENTRY:
+            for name, (_self, cumulative) in sorted(modules.items(), key=lambda x: -x[1][0])[:args.top]:
+                print("  %-38s %7.1f ms" % (name, _self / 1000))
+            if total > args.budget * 1000:
+                print("  超出预算 %.1f ms" % args.budget)
+                failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# PROXY Protocol头构建耗时测试，在仓库根目录执行：
+# python3 -m benchmarks.proxy_protocol [-n 200000]
+
+__author__ = "Guation"
+
+import argparse, timeit
+from nat1_traversal.util.proxy_protocol import build_pp_v1_header, build_pp_v2_header, pp_header_builder
+
+SRC = ("203.0.113.7", 51234)
+DST = ("127.0.0.1", 25565)
+
+def main():
+    parser = argparse.ArgumentParser(description="PROXY protocol header build time")
+    parser.add_argument("-n", "--number", type=int, default=200000, help="每项构建次数")
+    args = parser.parse_args()
+
+    cases = (
+        ("v1", lambda: build_pp_v1_header(SRC, DST), pp_header_builder("v1", DST).build),
+        ("v2", lambda: build_pp_v2_header(SRC, DST), pp_header_builder("v2", DST).build),
+        ("v2+tlv", None, pp_header_builder("v2", DST, "mc.example.com", True).build),
+    )
+    for name, legacy, build in cases:
+        new = timeit.timeit(lambda: build(SRC), number=args.number) / args.number * 1e9
+        if legacy is None:
+            print("%-8s builder %7.0f ns" % (name, new))
+            continue
+        old = timeit.timeit(legacy, number=args.number) / args.number * 1e9
+        print("%-8s legacy %7.0f ns  builder %7.0f ns  %5.2fx" % (name, old, new, old / new))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# mcje状态缓存前置检查：非状态请求分多次发送时，后端必须收到完整数据，失败时返回1，在仓库根目录执行：
+# python3 -m benchmarks.status_passthrough
+
+__author__ = "Guation"
+
+import asyncio, socket, sys, threading, time, queue
+from nat1_traversal.util import tcp_port_forwarder
+from nat1_traversal.util.motd import pack_packet, pack_varint
+
+STATUS_TIMEOUT = 0.5 # 缩短等待，超时用例不必等待5秒
+
+def start_backend():
+    # type: () -> tuple[tuple, queue.Queue]
+    """Backend that puts everything received on a connection into the queue once the client closes."""
+    server = socket.create_server(("127.0.0.1", 0))
+    received = queue.Queue()
+    def handle(sock):
+        data = b""
+        with sock:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        received.put(data)
+    def serve():
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=handle, args=(sock,), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname(), received
+
+def start_forwarder(remote):
+    # type: (tuple) -> tuple
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        local = sock.getsockname()
+    forwarder = tcp_port_forwarder.tcp_forwarder(local, remote, status_cache_ttl=5)
+    threading.Thread(target=asyncio.run, args=(forwarder.start(),), daemon=True).start()
+    time.sleep(0.2)
+    return local
+
+def handshake(next_state):
+    # type: (int) -> bytes
+    address = b"localhost"
+    return pack_packet(0x00, pack_varint(763) + pack_varint(len(address)) + address + b"\x63\xdd" + pack_varint(next_state))
+
+def send_chunks(local, chunks):
+    # type: (tuple, list[tuple[bytes, float]]) -> None
+    """Send each chunk and wait the given seconds after it."""
+    with socket.create_connection(local) as sock:
+        for chunk, delay in chunks:
+            sock.sendall(chunk)
+            time.sleep(delay)
+        sock.shutdown(socket.SHUT_WR)
+        sock.settimeout(3)
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+def main():
+    tcp_port_forwarder.STATUS_TIMEOUT = STATUS_TIMEOUT
+    remote, received = start_backend()
+    local = start_forwarder(remote)
+    login = handshake(2)
+    too_large = pack_varint(4000) + b"\x00" + b"a" * 3999
+    step = 0.05
+    cases = (
+        ("login", [(login[:5], step), (login[5:], step), (pack_packet(0x00, b"\x04name"), step)]),
+        ("too_large", [(too_large[i:i + 700], step) for i in range(0, len(too_large), 700)]),
+        ("bad_varint", [(b"\x80\x80", step), (b"\x80\x80\x80\x80", step), (b"rest of the stream", step)]),
+        ("timeout", [(b"\x10ab", step), (b"cd", STATUS_TIMEOUT * 2), (b"after the timeout", step)]),
+        ("eof", [(b"\x10ab", step), (b"cd", step)]),
+    )
+    failed = False
+    for name, chunks in cases:
+        send_chunks(local, chunks)
+        try:
+            data = received.get(timeout=STATUS_TIMEOUT + 3)
+        except queue.Empty:
+            data = None
+        ok = data == b"".join(x[0] for x in chunks)
+        failed = failed or not ok
+        print("%-10s %s" % (name, "ok" if ok else "后端收到 %r" % (data if data is None else data[:64],)))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# TCP转发吞吐量测试，在仓库根目录执行：
+# python3 -m benchmarks.tcp_relay [-s 256] [-n 4]
+
+__author__ = "Guation"
+
+import argparse, contextlib, multiprocessing, os, socket, struct, threading, time
+from nat1_traversal.util.stun import new_tcp_socket
+from nat1_traversal.util.tcp_port_forwarder import start_tcp_port_forward
+
+CHUNK = 65536
+UPLOAD = 0
+DOWNLOAD = 1
+
+def free_port():
+    # type: () -> int
+    with new_tcp_socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def recv_exact(sock, size):
+    # type: (socket.socket, int) -> bytes
+    data = b""
+    while len(data) < size:
+        buf = sock.recv(size - len(data))
+        if not buf:
+            raise ConnectionAbortedError
+        data += buf
+    return data
+
+def backend_session(conn):
+    # type: (socket.socket) -> None
+    with conn:
+        direction, size = struct.unpack("!BQ", recv_exact(conn, 9))
+        if direction == UPLOAD:
+            while size > 0:
+                buf = conn.recv(min(size, CHUNK))
+                if not buf:
+                    return
+                size -= len(buf)
+            conn.sendall(b"\x00")
+        else:
+            payload = b"\x00" * CHUNK
+            while size > 0:
+                size -= conn.send(payload[:min(size, CHUNK)])
+
+def backend_main(sock):
+    # type: (socket.socket) -> None
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=backend_session, args=(conn,), daemon=True).start()
+
+def client_session(addr, direction, size):
+    # type: (tuple, int, int) -> None
+    with new_tcp_socket() as sock:
+        sock.connect(addr)
+        sock.sendall(struct.pack("!BQ", direction, size))
+        if direction == UPLOAD:
+            payload = b"\x00" * CHUNK
+            remain = size
+            while remain > 0:
+                remain -= sock.send(payload[:min(remain, CHUNK)])
+            recv_exact(sock, 1)
+        else:
+            remain = size
+            while remain > 0:
+                buf = sock.recv(min(remain, CHUNK))
+                if not buf:
+                    raise ConnectionAbortedError
+                remain -= len(buf)
+
+def cpu_time(pid):
+    # type: (int) -> float
+    """utime + stime of a process in seconds, 0 where /proc is unavailable."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def run(addr, direction, size, connections):
+    # type: (tuple, int, int, int) -> float
+    threads = [threading.Thread(target=client_session, args=(addr, direction, size)) for _ in range(connections)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return size * connections / (time.perf_counter() - start) / 1024 / 1024
+
+@contextlib.contextmanager
+def forwarder(remote, **options):
+    # type: (tuple, ...) -> Iterator[tuple[tuple, int]]
+    """Run a forwarder process to remote, yields its address and pid."""
+    local = ("127.0.0.1", free_port())
+    process = multiprocessing.Process(target=start_tcp_port_forward, args=(local, remote, local), kwargs=options, daemon=True)
+    process.start()
+    time.sleep(1) # 等待ping连接占用第一个连接
+    try:
+        yield local, process.pid
+    finally:
+        process.terminate()
+        process.join()
+
+def bench(remote, size, connections, **options):
+    # type: (tuple, int, int, ...) -> tuple[float, float, float]
+    with forwarder(remote, **options) as (local, pid):
+        cpu = cpu_time(pid)
+        upload, download = run(local, UPLOAD, size, connections), run(local, DOWNLOAD, size, connections)
+        cpu = cpu_time(pid) - cpu
+        return upload, download, cpu * 1000 / (size * connections * 2 / 1024 / 1024)
+
+def start_backend():
+    # type: () -> tuple
+    backend = new_tcp_socket()
+    backend.bind(("127.0.0.1", 0))
+    backend.listen()
+    threading.Thread(target=backend_main, args=(backend,), daemon=True).start()
+    return backend.getsockname()
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP relay throughput")
+    parser.add_argument("-s", "--size", type=int, default=256, help="每个连接传输的MiB数")
+    parser.add_argument("-n", "--connections", type=int, default=4, help="并发连接数")
+    args = parser.parse_args()
+
+    remote = start_backend()
+    size = args.size * 1024 * 1024
+
+    direct = run(remote, UPLOAD, size, args.connections), run(remote, DOWNLOAD, size, args.connections)
+    print("%-8s upload %9.1f MiB/s  download %9.1f MiB/s" % ("direct", *direct))
+    for name, splice in (("asyncio", False), ("splice", True)):
+        print("%-8s upload %9.1f MiB/s  download %9.1f MiB/s  cpu %6.2f ms/MiB" % (name, *bench(remote, size, args.connections, splice=splice)))
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
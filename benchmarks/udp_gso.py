@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# UDP下行burst吞吐测试（GSO开/关），在仓库根目录执行：
+# python3 -m benchmarks.udp_gso [-t 5] [-c 4] [-n 32] [-s 1200]
+
+__author__ = "Guation"
+
+import argparse, multiprocessing, socket, struct, time
+from nat1_traversal.util.gso import gso_available
+from nat1_traversal.util.stun import new_udp_socket
+from benchmarks.udp_relay import forwarder
+from benchmarks.tcp_relay import cpu_time
+
+def burst_main(sock):
+    # type: (socket.socket) -> None
+    """Answer each request (count, size) with `count` datagrams of `size` bytes."""
+    payload = b"\0" * 65535
+    while True:
+        data, addr = sock.recvfrom(16)
+        count, size = struct.unpack("!HH", data[:4])
+        for _ in range(count):
+            sock.sendto(payload[:size], addr)
+
+def start_burst():
+    # type: () -> tuple
+    sock = new_udp_socket()
+    sock.bind(("127.0.0.1", 0))
+    multiprocessing.Process(target=burst_main, args=(sock,), daemon=True).start()
+    return sock.getsockname()
+
+def client_main(addr, duration, count, size, result):
+    # type: (tuple, float, int, int, multiprocessing.Value) -> None
+    request = struct.pack("!HH", count, size)
+    received = 0
+    with new_udp_socket() as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.connect(addr)
+        sock.settimeout(0.2)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            try:
+                sock.send(request)
+                for _ in range(count):
+                    if len(sock.recv(65536)) != size:
+                        raise RuntimeError("收到的数据包长度错误")
+                    received += 1
+            except socket.timeout:
+                pass
+            except ConnectionRefusedError: # 转发进程尚未就绪
+                time.sleep(0.1)
+    with result.get_lock():
+        result.value += received
+
+def bench(remote, duration, clients, count, size, **options):
+    # type: (tuple, float, int, int, int, ...) -> tuple[float, float]
+    """Datagrams per second delivered to the clients and forwarder CPU per 1k datagrams."""
+    with forwarder(remote, **options) as (local, pid):
+        result = multiprocessing.Value("q", 0)
+        processes = [multiprocessing.Process(target=client_main, args=(local, duration, count, size, result)) for _ in range(clients)]
+        cpu = cpu_time(pid)
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - start
+        cpu = cpu_time(pid) - cpu
+        packets = result.value
+        return packets / elapsed, cpu * 1000 / (packets / 1000) if packets else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP relay burst throughput with GSO")
+    parser.add_argument("-t", "--time", type=float, default=5, help="每项测试时长（秒）")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="并发客户端数")
+    parser.add_argument("-n", "--count", type=int, default=32, help="后端每次回复的数据包数")
+    parser.add_argument("-s", "--size", type=int, default=1200, help="数据包大小")
+    args = parser.parse_args()
+
+    if not gso_available():
+        print("当前系统不支持UDP GSO/GRO，gso项将回退到逐个收发")
+    remote = start_burst()
+    for name, options in (("off", {"batch": 64}), ("gso", {"batch": 64, "gso": True})):
+        pps, cpu = bench(remote, args.time, args.clients, args.count, args.size, **options)
+        print("%-4s %9.0f pkt/s %8.1f MiB/s  cpu %6.2f ms/kpkt" % (name, pps, pps * args.size / (1 << 20), cpu))
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# UDP转发每秒数据包数测试，在仓库根目录执行：
+# python3 -m benchmarks.udp_relay [-t 5] [-c 4] [-w 32] [-s 64]
+
+__author__ = "Guation"
+
+import argparse, contextlib, multiprocessing, socket, time
+from nat1_traversal.util.stun import new_udp_socket
+from nat1_traversal.util.udp_port_forwarder import start_udp_port_forward
+from benchmarks.tcp_relay import cpu_time
+
+def free_udp_port():
+    # type: () -> int
+    with new_udp_socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def echo_main(sock):
+    # type: (socket.socket) -> None
+    while True:
+        data, addr = sock.recvfrom(65536)
+        sock.sendto(data, addr)
+
+def start_echo(processes=1):
+    # type: (int) -> tuple
+    sock = new_udp_socket()
+    sock.bind(("127.0.0.1", 0))
+    for _ in range(processes):
+        multiprocessing.Process(target=echo_main, args=(sock,), daemon=True).start()
+    return sock.getsockname()
+
+def client_main(addr, duration, window, size, result):
+    # type: (tuple, float, int, int, multiprocessing.Value) -> None
+    """Send `window` datagrams, wait for their echoes (or 0.2 s), repeat."""
+    payload = b"\0" * size
+    received = 0
+    with new_udp_socket() as sock:
+        sock.connect(addr)
+        sock.settimeout(0.2)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            try:
+                for _ in range(window):
+                    sock.send(payload)
+                for _ in range(window):
+                    sock.recv(65536)
+                    received += 1
+            except socket.timeout:
+                pass
+            except ConnectionRefusedError: # 转发进程尚未就绪
+                time.sleep(0.1)
+    with result.get_lock():
+        result.value += received
+
+@contextlib.contextmanager
+def forwarder(remote, **options):
+    # type: (tuple, ...) -> Iterator[tuple[tuple, int]]
+    local = ("127.0.0.1", free_udp_port())
+    process = multiprocessing.Process(target=start_udp_port_forward, args=(local, remote, local), kwargs=options, daemon=True)
+    process.start()
+    time.sleep(1) # 等待ping占用第一个会话
+    try:
+        yield local, process.pid
+    finally:
+        process.terminate()
+        process.join()
+
+def bench(remote, duration, clients, window, size, **options):
+    # type: (tuple, float, int, int, int, ...) -> tuple[float, float]
+    """Relayed datagrams per second (both directions) and forwarder CPU per 1k datagrams."""
+    with forwarder(remote, **options) as (local, pid):
+        result = multiprocessing.Value("q", 0)
+        processes = [multiprocessing.Process(target=client_main, args=(local, duration, window, size, result)) for _ in range(clients)]
+        cpu = cpu_time(pid)
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - start
+        cpu = cpu_time(pid) - cpu
+        packets = result.value * 2
+        return packets / elapsed, cpu * 1000 / (packets / 1000) if packets else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP relay packets per second")
+    parser.add_argument("-t", "--time", type=float, default=5, help="每项测试时长（秒）")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="并发客户端数")
+    parser.add_argument("-w", "--window", type=int, default=32, help="每个客户端每轮发送的数据包数")
+    parser.add_argument("-s", "--size", type=int, default=64, help="数据包大小")
+    args = parser.parse_args()
+
+    remote = start_echo()
+    cases = (
+        ("single", {"batch": 1}),
+        ("batch", {"batch": 64}),
+        ("mmsg", {"batch": 64, "mmsg": True}),
+        ("asyncio", {"engine": "asyncio"}),
+    )
+    for name, options in cases:
+        pps, cpu = bench(remote, args.time, args.clients, args.window, args.size, **options)
+        print("%-8s %9.0f pkt/s  cpu %6.2f ms/kpkt" % (name, pps, cpu))
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
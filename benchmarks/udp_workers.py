@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# UDP转发多进程(workers)扩展性测试，在仓库根目录执行：
+# python3 -m benchmarks.udp_workers [-t 5] [-c 8] [-w 32] [-n 1 2 4]
+
+__author__ = "Guation"
+
+import argparse, multiprocessing, os, signal, sys, time
+from nat1_traversal.nat1_traversal import run_forward
+from nat1_traversal.util.stun import TYPE_UDP
+from benchmarks.udp_relay import client_main, free_udp_port, start_echo
+
+def forward_target(local, remote, options, workers):
+    # type: (tuple, tuple, dict, int) -> None
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # 退出时结束各转发进程
+    run_forward(local, remote, local, False, TYPE_UDP, options, workers)
+
+def bench(remote, workers, duration, clients, window, size):
+    # type: (tuple, int, float, int, int, int) -> float
+    local = ("127.0.0.1", free_udp_port())
+    options = {"metrics_port": None, "log_options": {"rate": 10, "burst": 100, "sample": 100}, "batch": 64}
+    process = multiprocessing.Process(target=forward_target, args=(local, remote, options, workers))
+    process.start()
+    time.sleep(1 + workers * 0.5) # 等待ping占用第一个会话及各进程启动
+    try:
+        result = multiprocessing.Value("q", 0)
+        processes = [multiprocessing.Process(target=client_main, args=(local, duration, window, size, result)) for _ in range(clients)]
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        return result.value * 2 / (time.perf_counter() - start)
+    finally:
+        process.terminate()
+        process.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP relay scaling with workers")
+    parser.add_argument("-t", "--time", type=float, default=5, help="每项测试时长（秒）")
+    parser.add_argument("-c", "--clients", type=int, default=8, help="并发客户端数（不同来源端口）")
+    parser.add_argument("-w", "--window", type=int, default=32, help="每个客户端每轮发送的数据包数")
+    parser.add_argument("-s", "--size", type=int, default=64, help="数据包大小")
+    parser.add_argument("-n", "--workers", type=int, nargs="+", default=[1, 2, 4], help="测试的转发进程数")
+    args = parser.parse_args()
+
+    print("CPU核心数 %d" % os.cpu_count())
+    remote = start_echo(max(args.workers))
+    for workers in args.workers:
+        print("workers %-3d %9.0f pkt/s" % (workers, bench(remote, workers, args.time, args.clients, args.window, args.size)))
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -9,7 +9,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('nat1_traversal', 'nat1_traversal')],
-    hiddenimports=[],
+    hiddenimports=collect_submodules('nat1_traversal.dns'), # DNS供应商按名称导入
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
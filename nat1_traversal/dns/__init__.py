@@ -5,13 +5,14 @@ __author__ = "Guation"
 
 __all__ = ["dns_base", "alidns", "aliesa", "cloudflare", "dynv6", "edgeone", "edgeone_intl", "no_dns", "tencentcloud", "webhook"]
 
+import importlib
 from .dns_base import dns_base
-from .alidns import alidns
-from .aliesa import aliesa
-from .cloudflare import cloudflare
-from .dynv6 import dynv6
-from .edgeone import edgeone
-from .edgeone_intl import edgeone_intl
-from .no_dns import no_dns
-from .tencentcloud import tencentcloud
-from .webhook import webhook
+
+def __getattr__(name):
+    # type: (str) -> type[dns_base]
+    """Providers are imported on first use, only the configured one pulls in requests."""
+    if name not in __all__:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    provider = getattr(importlib.import_module("." + name, __name__), name)
+    globals()[name] = provider
+    return provider
@@ -5,12 +5,20 @@
 
 __author__ = "Guation"
 
-import os, argparse, sys, json, traceback, socket, time, threading, multiprocessing, signal, charset_normalizer
-from logging import debug, info, warning, error, DEBUG, INFO, basicConfig
-from nat1_traversal.util.stun import nat_type_test, get_self_ip_port, addr_available, TYPE_TCP, TYPE_UDP, IS_WINDOWS
-from nat1_traversal.util.tcp_port_forwarder import start_tcp_port_forward
-from nat1_traversal.util.udp_port_forwarder import start_udp_port_forward
-from nat1_traversal.util.motd import mcje_query, srv_query, tcp_query, mcbe_query, udp_query
+import multiprocessing
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # 打包后的转发进程会重新执行本文件，在导入命令行所需的模块前转入process_main
+
+import os, argparse, sys, json, traceback, socket, time, threading, multiprocessing.connection, signal
+from logging import debug, info, warning, error
+from nat1_traversal.util.stun import nat_type_test, mapping_timeout_test, get_self_ip_port, addr_available, set_stun_servers, TYPE_TCP, TYPE_UDP, IS_WINDOWS, \
+    MAPPING_TIMEOUT_MAX, TCP_STUN_SERVERS, UDP_STUN_SERVERS, STUN_PORT
+from nat1_traversal.util.tcp_port_forwarder import PING_INTERVAL
+from nat1_traversal.util.udp_port_forwarder import UDP_ENGINES
+from nat1_traversal.util.event_loop import EVENT_LOOPS, event_loop_available, ping_nonce
+from nat1_traversal.util.process_main import init_logger, forward_main, services_main, standby_main
+from nat1_traversal.util.motd import mcje_query, srv_query, tcp_query, mcbe_query, udp_query, raknet_ping
+from nat1_traversal.util.probe import probe_scheduler, PROBE_INTERVAL, PROBE_FULL_INTERVAL
 from nat1_traversal.util.addr_tool import convert_addr, convert_mc_host
 from nat1_traversal.util.version import VERSION
 import nat1_traversal.dns
@@ -29,16 +37,6 @@ def register_exit():
     signal.signal(signal.SIGTERM, stop)
     signal.signal(signal.SIGINT, stop)
 
-def init_logger(debug: bool) -> None:
-    if debug:
-        basicConfig(
-            level=DEBUG, force=True,
-            format='[%(levelname)8s] %(asctime)s <%(module)s.%(funcName)s>:%(lineno)d\n[%(levelname)8s] %(message)s')
-    else:
-        basicConfig(
-            level=INFO, force=True,
-            format='[%(levelname)8s] %(message)s')
-
 def register_logger_level_change():
     def change_on(signum, frame):
         init_logger(True)
@@ -65,13 +63,733 @@ class logger_filter:
             self.buff_msg = msg
             return True
 
-def forward_main(local_addr, remote_addr, mapped_addr, debug, _type, proxy_protocol_version=None):
-    # type: (socket._Address, socket._Address, socket._Address, bool, int, str | None) -> None
-    init_logger(debug)
-    if _type is TYPE_TCP:
-        start_tcp_port_forward(local_addr, remote_addr, mapped_addr, proxy_protocol_version)
-    elif _type is TYPE_UDP:
-        start_udp_port_forward(local_addr, remote_addr, mapped_addr)
+class standby_pool:
+    """
+    Forwarder processes started ahead of time. With the spawn start method
+    most of a respawn is the new interpreter importing the modules, so a
+    replacement taken from here only has to receive its arguments.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.idle = [] # type: list[tuple[multiprocessing.Process, multiprocessing.connection.Connection]]
+
+    def spawn(self):
+        # type: () -> tuple[multiprocessing.Process, multiprocessing.connection.Connection]
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=standby_main, args=(child,), daemon=True)
+        process.start()
+        child.close()
+        return process, parent
+
+    def fill(self) -> None:
+        self.idle = [x for x in self.idle if x[0].is_alive()]
+        while len(self.idle) < self.size:
+            self.idle.append(self.spawn())
+
+    def start(self, target, *args):
+        # type: (Callable[..., None], ...) -> tuple[multiprocessing.Process, multiprocessing.connection.Connection]
+        """target(*args) in an idle process, or a new one when none is left; returns it with its control pipe."""
+        self.idle = [x for x in self.idle if x[0].is_alive()]
+        process, control = self.idle.pop(0) if self.idle else self.spawn()
+        control.send((target, args))
+        self.fill()
+        return process, control
+
+REMAP_ATTEMPTS = 3
+REMAP_TIMEOUT = 10
+
+def remap_addr(local_addr, _type):
+    # type: (socket._Address, int) -> socket._Address | None
+    """get_self_ip_port() with REMAP_ATTEMPTS tries, None when all of them fail."""
+    for _ in range(REMAP_ATTEMPTS):
+        try:
+            return get_self_ip_port(local_addr, _type)
+        except ValueError as e:
+            error("获取映射地址失败：%s", e)
+            debug(traceback.format_exc())
+            time.sleep(5)
+    return None
+
+def run_forward(local_addr, remote_addr, mapped_addr, _debug, _type, options, workers, standby, on_remap=None):
+    # type: (socket._Address, socket._Address, socket._Address, bool, int, dict, int, standby_pool, Callable[[socket._Address], None] | None) -> None
+    """
+    Run the forwarder until the process owning the ping/pong channel exits.
+    With several workers the others bind the same port with SO_REUSEPORT
+    and are started only after the pong connection is taken, so the ping
+    always lands on the owner; any of them that dies is restarted.
+    UDP has no connection to pin the ping to, so the owner reports the ping
+    source and its pong address and the other shards redirect it there.
+    When the ping fails the mapping is refreshed in place: STUN runs again
+    on the shared port, the new address is sent to every process through
+    its control pipe and relayed connections/sessions are kept.
+    Processes come from standby and report ("listening", None) once bound,
+    the time from (re)start to that is logged.
+    """
+    start_time = time.perf_counter()
+    owner, owner_control = standby.start(forward_main, local_addr, remote_addr, mapped_addr, _debug, _type, dict(options, reuseport=True))
+    message = None
+    while message != "pong":
+        while not owner_control.poll(1):
+            if not owner.is_alive():
+                return
+        try:
+            message, pong = owner_control.recv()
+        except EOFError:
+            break
+        if message == "listening":
+            info("转发进程开始监听，耗时 %.0f ms", (time.perf_counter() - start_time) * 1000)
+        elif message != "pong":
+            break
+    if message != "pong": # 首次ping即失败，整体重启
+        owner.terminate()
+        owner.join()
+        return
+    worker_options = dict(options, reuseport=True)
+    if _type is TYPE_UDP:
+        worker_options["pong_redirect"] = pong
+    starting = {} # type: dict[multiprocessing.connection.Connection, tuple[int, float, bool]]
+    def spawn(i, respawn=False):
+        # metrics 端口按worker序号递增
+        metrics_port = options["metrics_port"] + i if options.get("metrics_port") else None
+        starting_time = time.perf_counter()
+        process, control = standby.start(forward_main, local_addr, remote_addr, None, _debug, _type, dict(worker_options, metrics_port=metrics_port))
+        starting[control] = i, starting_time, respawn
+        return process, control
+    def wait_message(controls, message, count, deadline):
+        # type: (list[multiprocessing.connection.Connection], str, int, float) -> list | None
+        """Values of the first `count` messages of that kind, None on timeout or when a process exits."""
+        values = []
+        while len(values) < count:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0 or not owner.is_alive():
+                return None
+            for x in multiprocessing.connection.wait(controls, timeout):
+                try:
+                    kind, value = x.recv()
+                except EOFError:
+                    return None
+                if kind == message:
+                    values.append(value)
+                elif kind == "listening":
+                    listening(x)
+        return values
+    def listening(control):
+        # type: (multiprocessing.connection.Connection) -> None
+        if control in starting:
+            i, starting_time, respawn = starting.pop(control)
+            (info if respawn else debug)("转发进程 %d 开始监听，耗时 %.0f ms", i, (time.perf_counter() - starting_time) * 1000)
+    def remap():
+        # type: () -> bool
+        warning("ping/pong检测失败，可能是映射地址已变化，正在重新获取映射地址")
+        new_addr = remap_addr(local_addr, _type)
+        if new_addr is None:
+            return False
+        # 先让其余进程都准备好接收新的ping，再让主进程开始ping；ping带有nonce，等待期间的普通客户端不会被当作pong
+        deadline = time.perf_counter() + REMAP_TIMEOUT
+        remap_value = (new_addr, ping_nonce())
+        workers_control = [x[1] for x in pool]
+        for x in workers_control:
+            x.send(("remap", remap_value))
+        if wait_message(workers_control, "armed", len(workers_control), deadline) is None:
+            error("转发进程未响应映射地址变更")
+            return False
+        controls = [owner_control] + workers_control
+        owner_control.send(("remap", remap_value))
+        taken = wait_message(controls, "pong", 1, deadline)
+        if taken is None:
+            error("新的映射地址 %s:%s 未收到ping", *new_addr)
+            return False
+        for x in controls:
+            x.send(("disarm", None))
+        if _type is TYPE_UDP:
+            worker_options["pong_redirect"] = taken[0]
+        info("映射地址已更新为 %s:%s，已有连接不受影响", *new_addr)
+        if on_remap is not None:
+            on_remap(new_addr)
+        return True
+    pool = [spawn(i + 1) for i in range(workers - 1)]
+    if pool:
+        info("已启动 %d 个转发进程", workers)
+    try:
+        while True:
+            workers_control = [x[1] for x in pool]
+            ready = multiprocessing.connection.wait([owner.sentinel, owner_control] + [x[0].sentinel for x in pool] + workers_control)
+            if not owner.is_alive():
+                return
+            if owner_control in ready:
+                try:
+                    message, _ = owner_control.recv()
+                except EOFError:
+                    return
+                if message == "lost" and not remap():
+                    return
+            for x in workers_control:
+                if x in ready:
+                    try:
+                        if x.recv()[0] == "listening":
+                            listening(x)
+                    except EOFError: # 进程已退出，下面重启
+                        pass
+            for i, (process, control) in enumerate(pool):
+                if not process.is_alive():
+                    warning("转发进程 %d 意外退出(exitcode=%s)，正在重启", i + 1, process.exitcode)
+                    starting.pop(control, None)
+                    time.sleep(1)
+                    pool[i] = spawn(i + 1, True)
+    finally:
+        for process, _ in pool:
+            process.terminate()
+        for process, _ in pool:
+            process.join()
+        if owner.is_alive():
+            owner.terminate()
+        owner.join()
+
+def run_services(services, _debug, options, standby):
+    # type: (list[tuple[socket._Address, socket._Address, int, dict, Callable[[str, int], None], str]], bool, dict, standby_pool) -> None
+    """
+    run_forward of the services mode, services are (local, remote, type,
+    options, update_dns, name). One forwarder process runs all of them and
+    the control messages carry the index of the service. Mapping, ping/pong
+    and re-mapping are per service; the process is restarted as a whole
+    only when it exits or a service cannot be re-mapped.
+    """
+    forwards = []
+    for local_addr, remote_addr, _type, service_options, update_dns, name in services:
+        while True:
+            try:
+                mapped_addr = get_self_ip_port(local_addr, _type)
+                break
+            except ValueError as e:
+                error("%s 获取映射地址失败：%s", name, e)
+                debug(traceback.format_exc())
+                time.sleep(10)
+        info("%s 获取到映射地址： %s:%s", name, *mapped_addr)
+        update_dns(*mapped_addr)
+        forwards.append((_type, local_addr, remote_addr, mapped_addr, service_options))
+    start_time = time.perf_counter()
+    process, control = standby.start(services_main, forwards, _debug, options)
+    remapping = {} # type: dict[int, socket._Address]
+    lost = [0] * len(services)
+    try:
+        while True:
+            multiprocessing.connection.wait([process.sentinel, control])
+            if not process.is_alive():
+                return
+            try:
+                index, message, value = control.recv()
+            except EOFError:
+                return
+            local_addr, _, _type, _, update_dns, name = services[index]
+            if message == "listening":
+                info("%s 开始监听，耗时 %.0f ms", name, (time.perf_counter() - start_time) * 1000)
+            elif message == "pong":
+                lost[index] = 0
+                if index in remapping:
+                    new_addr = remapping.pop(index)
+                    info("%s 映射地址已更新为 %s:%s，已有连接不受影响", name, *new_addr)
+                    update_dns(*new_addr)
+            elif message == "lost":
+                lost[index] += 1
+                if lost[index] > REMAP_ATTEMPTS:
+                    error("%s 重新映射后仍无法收到ping", name)
+                    return
+                warning("%s ping/pong检测失败，可能是映射地址已变化，正在重新获取映射地址", name)
+                new_addr = remap_addr(local_addr, _type)
+                if new_addr is None:
+                    return
+                remapping[index] = new_addr
+                control.send((index, "remap", (new_addr, ping_nonce())))
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+def parse_stun_servers(value, name):
+    # type: (Any, str) -> list[socket._Address]
+    """host[:port] strings of a STUN server list, exit on errors."""
+    if not isinstance(value, list) or not value or not all(isinstance(x, str) for x in value):
+        error("%s 应为非空的字符串数组", name)
+        sys.exit(1)
+    servers = []
+    for x in value:
+        try:
+            host, port = convert_mc_host(x)
+        except ValueError as e:
+            error("%s 中的 %s 解析错误: %s", name, x, e)
+            debug(traceback.format_exc())
+            sys.exit(1)
+        if not host:
+            error("%s 中的 %s 缺少主机名", name, x)
+            sys.exit(1)
+        servers.append((host, port or STUN_PORT))
+    return servers
+
+NAT_TIMEOUT_FILE = "nat_timeout.json" # --probe-nat-timeout的结果，与配置文件位于同一目录
+KEEPALIVE_FRACTION = 0.5 # 自动设置的保活间隔占映射超时的比例
+
+def nat_timeout_path(config_path):
+    # type: (str) -> str
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), NAT_TIMEOUT_FILE)
+
+def load_nat_timeout(path):
+    # type: (str) -> dict[str, float]
+    """Stored result of --probe-nat-timeout, empty when there is none."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {k: float(v) for k, v in json.load(f).items() if k in ("tcp", "udp")}
+    except (OSError, ValueError, TypeError, AttributeError):
+        debug(traceback.format_exc())
+        return {}
+
+def probe_nat_timeout(local_addr, maximum, path):
+    # type: (socket._Address | None, float, str) -> None
+    """Measure the idle timeout of TCP and UDP mappings and store them in path."""
+    result = {} # type: dict[str, float]
+    def test(_type, key):
+        try:
+            timeout, expired = mapping_timeout_test(local_addr, _type, maximum)
+        except ValueError as e:
+            error("%s 映射超时探测失败：%s", key.upper(), e)
+            debug(traceback.format_exc())
+            return
+        result[key] = timeout
+        if expired:
+            info("%s: 映射空闲 %g 秒后仍有效", key.upper(), timeout)
+        else:
+            info("%s: 映射空闲 %g 秒后仍有效，未测到超时", key.upper(), timeout)
+    info("正在探测NAT映射超时，最长需要约 %g 分钟", maximum * 3 / 60)
+    threads = [threading.Thread(target=test, args=x) for x in ((TYPE_TCP, "tcp"), (TYPE_UDP, "udp"))]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    if not result:
+        sys.exit(1)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=4)
+    except OSError:
+        error("探测结果 %s 保存失败", path)
+        debug(traceback.format_exc())
+        sys.exit(1)
+    info("探测结果已保存到 %s，keepalive_interval/probe_interval(UDP) 为null时使用", path)
+
+def keepalive_interval(value, socket_type, nat_timeout, default, name):
+    # type: (Any, int, dict[str, float] | None, float, str) -> float
+    """
+    Keepalive period from the config field `name`; None derives it from the
+    stored result of --probe-nat-timeout, default when there is none.
+    """
+    if value is None:
+        timeout = nat_timeout.get("tcp" if socket_type is TYPE_TCP else "udp") if nat_timeout else None
+        if timeout is None:
+            return default
+        value = max(1.0, timeout * KEEPALIVE_FRACTION)
+        info("NAT映射空闲超时约为 %g 秒，%s 设置为 %g 秒", timeout, name, value)
+        return value
+    try:
+        value = float(value)
+        if value <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("%s 应为正数或null，当前值: %s", name, value)
+        sys.exit(1)
+    return value
+
+def parse_forward_options(config, socket_type, splice=False, nat_timeout=None):
+    # type: (dict, int, bool, dict[str, float] | None) -> tuple[int, int, dict]
+    """Check the forwarding fields of config, exit on errors; returns workers, standby and the options of forward_main."""
+    # Proxy Protocol validation: only for TCP types
+    proxy_protocol_version = config.get("proxy_protocol", None)
+    if proxy_protocol_version is not None:
+        proxy_protocol_version = str(proxy_protocol_version).strip().lower()
+        if proxy_protocol_version not in ("v1", "v2"):
+            error("不支持的 proxy_protocol 版本: %s，可选值为 v1, v2 或 null", config["proxy_protocol"])
+            sys.exit(1)
+        if socket_type is not TYPE_TCP:
+            error("proxy_protocol 仅在 TCP 模式下可用 (mcje/web/tcp)，当前模式: %s", config["type"])
+            sys.exit(1)
+        info("已启用 PROXY Protocol %s，将转发真实客户端IP", proxy_protocol_version)
+    proxy_protocol_authority = config.get("proxy_protocol_authority", None)
+    proxy_protocol_unique_id = bool(config.get("proxy_protocol_unique_id", False))
+    if (proxy_protocol_authority or proxy_protocol_unique_id) and proxy_protocol_version != "v2":
+        error("proxy_protocol_authority 与 proxy_protocol_unique_id 仅在 proxy_protocol 为 v2 时可用")
+        sys.exit(1)
+    if proxy_protocol_authority is not None:
+        proxy_protocol_authority = str(proxy_protocol_authority)
+    splice = splice or bool(config.get("splice", False))
+    if splice and socket_type is not TYPE_TCP:
+        error("splice 仅在 TCP 模式下可用 (mcje/web/tcp)，当前模式: %s", config["type"])
+        sys.exit(1)
+    try:
+        workers = int(config.get("workers", 1))
+        if workers < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("workers 应为正整数，当前值: %s", config["workers"])
+        sys.exit(1)
+    if workers > 1:
+        if IS_WINDOWS or not hasattr(socket, "SO_REUSEPORT"):
+            warning("当前系统不支持SO_REUSEPORT，workers 将被设置为1")
+            workers = 1
+    try:
+        standby = int(config.get("standby", 1))
+        if standby < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("standby 应为非负整数，当前值: %s", config["standby"])
+        sys.exit(1)
+    udp_engine = config.get("udp_engine", None)
+    if udp_engine is not None:
+        udp_engine = str(udp_engine).strip().lower()
+        if udp_engine not in UDP_ENGINES:
+            error("不支持的 udp_engine: %s，可选值为 %s 或 null", config["udp_engine"], ", ".join(UDP_ENGINES))
+            sys.exit(1)
+        if socket_type is not TYPE_UDP:
+            error("udp_engine 仅在 UDP 模式下可用 (mcbe/udp)，当前模式: %s", config["type"])
+            sys.exit(1)
+        info("UDP转发使用 %s 实现", udp_engine)
+    try:
+        udp_batch = int(config.get("udp_batch", 64))
+        if udp_batch < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("udp_batch 应为正整数，当前值: %s", config["udp_batch"])
+        sys.exit(1)
+    udp_mmsg = bool(config.get("udp_mmsg", False))
+    if udp_mmsg and (socket_type is not TYPE_UDP or udp_engine == "asyncio"):
+        error("udp_mmsg 仅在 UDP 模式 (mcbe/udp) 且 udp_engine 为 selector 时可用")
+        sys.exit(1)
+    udp_gso = bool(config.get("udp_gso", False))
+    if udp_gso and (socket_type is not TYPE_UDP or udp_engine == "asyncio"):
+        error("udp_gso 仅在 UDP 模式 (mcbe/udp) 且 udp_engine 为 selector 时可用")
+        sys.exit(1)
+    if udp_gso and udp_mmsg:
+        error("udp_gso 与 udp_mmsg 不能同时启用")
+        sys.exit(1)
+    try:
+        udp_max_datagram = int(config.get("udp_max_datagram", 65535))
+        if not 512 <= udp_max_datagram <= 65535:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("udp_max_datagram 应为512-65535之间的整数，当前值: %s", config["udp_max_datagram"])
+        sys.exit(1)
+    udp_session_timeout = config.get("udp_session_timeout", None)
+    if udp_session_timeout is None:
+        # RakNet 客户端可能长时间只发送少量保活包
+        udp_session_timeout = 60 if config["type"] == "mcbe" else 30
+    else:
+        try:
+            udp_session_timeout = float(udp_session_timeout)
+            if udp_session_timeout <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            error("udp_session_timeout 应为正数，当前值: %s", config["udp_session_timeout"])
+            sys.exit(1)
+    try:
+        udp_max_sessions = config.get("udp_max_sessions", None)
+        if udp_max_sessions is not None:
+            udp_max_sessions = int(udp_max_sessions)
+        udp_per_prefix_sessions = int(config.get("udp_per_prefix_sessions", 0))
+        if (udp_max_sessions or 0) < 0 or udp_per_prefix_sessions < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("udp_max_sessions, udp_per_prefix_sessions 应为非负整数")
+        sys.exit(1)
+    if udp_max_sessions == 1:
+        error("udp_max_sessions 至少为2，其中1个会话用于ping/pong存活检测")
+        sys.exit(1)
+    try:
+        mcbe_pong_cache = float(config.get("mcbe_pong_cache", 5))
+        if mcbe_pong_cache < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("mcbe_pong_cache 应为非负数，当前值: %s", config["mcbe_pong_cache"])
+        sys.exit(1)
+    if config["type"] != "mcbe":
+        mcbe_pong_cache = 0
+    event_loop = config.get("event_loop", None)
+    if event_loop is not None:
+        event_loop = str(event_loop).strip().lower()
+        if event_loop not in EVENT_LOOPS:
+            error("不支持的 event_loop: %s，可选值为 %s 或 null", config["event_loop"], ", ".join(EVENT_LOOPS))
+            sys.exit(1)
+        if socket_type is not TYPE_TCP and udp_engine != "asyncio":
+            error("event_loop 仅在 TCP 模式或 udp_engine 为 asyncio 时可用，当前模式: %s", config["type"])
+            sys.exit(1)
+        if not event_loop_available(event_loop):
+            warning("未安装%s，转发将使用默认事件循环", event_loop)
+            event_loop = None
+        else:
+            info("转发使用 %s 事件循环", event_loop)
+    try:
+        pool_size = int(config.get("backend_pool", 0))
+        pool_rate = float(config.get("backend_pool_rate", 10))
+        if pool_size < 0 or pool_rate <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("backend_pool 应为非负整数，backend_pool_rate 应为正数")
+        sys.exit(1)
+    if pool_size > 0:
+        if socket_type is not TYPE_TCP:
+            error("backend_pool 仅在 TCP 模式下可用 (mcje/web/tcp)，当前模式: %s", config["type"])
+            sys.exit(1)
+        info("已启用后端连接池，空闲连接数 %d，每秒最多补充 %s 个", pool_size, pool_rate)
+    try:
+        mcje_status_cache = float(config.get("mcje_status_cache", 0))
+        if mcje_status_cache < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("mcje_status_cache 应为非负数，当前值: %s", config["mcje_status_cache"])
+        sys.exit(1)
+    if mcje_status_cache > 0:
+        if config["type"] != "mcje":
+            error("mcje_status_cache 仅在 mcje 模式下可用，当前模式: %s", config["type"])
+            sys.exit(1)
+        info("服务器状态缓存 %s 秒", mcje_status_cache)
+    metrics_port = config.get("metrics_port", None)
+    if metrics_port is not None:
+        try:
+            metrics_port = int(metrics_port)
+            if metrics_port < 1 or metrics_port + workers - 1 > 65535:
+                raise ValueError
+        except (TypeError, ValueError):
+            error("metrics_port 应为1-65535之间的端口号，当前值: %s", config["metrics_port"])
+            sys.exit(1)
+    try:
+        limits = {
+            "max_connections": int(config.get("max_connections", 0)),
+            "per_ip_connections": int(config.get("per_ip_connections", 0)),
+            "per_ip_rate": float(config.get("per_ip_rate", 0)),
+            "per_ip_burst": int(config.get("per_ip_burst", 10))
+        }
+        if any(x < 0 for x in limits.values()):
+            raise ValueError
+    except (TypeError, ValueError):
+        error("max_connections, per_ip_connections, per_ip_rate, per_ip_burst 应为非负数")
+        sys.exit(1)
+    if limits["max_connections"] or limits["per_ip_connections"] or limits["per_ip_rate"]:
+        if socket_type is not TYPE_TCP:
+            error("连接数限制仅在 TCP 模式下可用 (mcje/web/tcp)，当前模式: %s", config["type"])
+            sys.exit(1)
+        info("已启用连接数限制 %s", limits)
+    try:
+        log_options = {
+            "rate": float(config.get("log_rate", 10)),
+            "burst": int(config.get("log_burst", 100)),
+            "sample": int(config.get("log_sample", 100))
+        }
+        if any(x < 0 for x in log_options.values()):
+            raise ValueError
+    except (TypeError, ValueError):
+        error("log_rate, log_burst, log_sample 应为非负数")
+        sys.exit(1)
+    ping_interval = keepalive_interval(config.get("keepalive_interval"), socket_type, nat_timeout, PING_INTERVAL, "keepalive_interval")
+    forward_options = {"metrics_port": metrics_port, "log_options": log_options, "ping_interval": ping_interval}
+    if socket_type is TYPE_UDP:
+        forward_options.update({
+            "engine": udp_engine,
+            "event_loop": event_loop,
+            "batch": udp_batch,
+            "mmsg": udp_mmsg,
+            "gso": udp_gso,
+            "max_datagram": udp_max_datagram,
+            "session_timeout": udp_session_timeout,
+            "max_sessions": udp_max_sessions,
+            "per_prefix": udp_per_prefix_sessions,
+            "raknet_pong_interval": mcbe_pong_cache
+        })
+    if socket_type is TYPE_TCP:
+        forward_options.update({
+            "proxy_protocol_version": proxy_protocol_version,
+            "proxy_protocol_authority": proxy_protocol_authority,
+            "proxy_protocol_unique_id": proxy_protocol_unique_id,
+            "splice": splice,
+            "event_loop": event_loop,
+            "pool_size": pool_size,
+            "pool_rate": pool_rate,
+            "status_cache_ttl": mcje_status_cache,
+            **limits
+        })
+    return workers, standby, forward_options
+
+def parse_probe_options(config, socket_type, nat_timeout=None):
+    # type: (dict, int, dict[str, float] | None) -> tuple[float, float]
+    """Check the probe fields of shared-port mode, exit on errors."""
+    if socket_type is TYPE_TCP: # 测得的是已建立连接的空闲超时，共享端口的映射只由随即关闭的探测连接维持，适用更短的关闭超时
+        nat_timeout = None
+    probe_interval = keepalive_interval(config.get("probe_interval"), socket_type, nat_timeout, PROBE_INTERVAL, "probe_interval")
+    try:
+        probe_full_interval = float(config.get("probe_full_interval", PROBE_FULL_INTERVAL))
+        if probe_full_interval <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error("probe_full_interval 应为正数")
+        sys.exit(1)
+    return probe_interval, probe_full_interval
+
+SERVICE_TYPES = {
+    "mcje": ("_minecraft._tcp.", mcje_query, TYPE_TCP),
+    "web": ("_web._tcp.", tcp_query, TYPE_TCP),
+    "tcp": ("_tcp.", tcp_query, TYPE_TCP),
+    "mcbe": ("_minecraft._udp.", mcbe_query, TYPE_UDP),
+    "udp": ("_udp.", udp_query, TYPE_UDP)
+} # type: dict[str, tuple[str, Callable[[str, int], tuple[bool, str]], int]]
+
+# services 模式下仅顶层有效的字段
+PROCESS_FIELDS = ("workers", "standby", "event_loop", "udp_engine", "metrics_port", "log_rate", "log_burst", "log_sample")
+
+def dns_updater(dns, srv_prefix, sub_domain, domain):
+    # type: (nat1_traversal.dns.dns_base, str, str, str) -> Callable[[str, int], None]
+    """update_dns(ip, port) of one record, the update runs in a background thread."""
+    def update_dns(ip: str, port: int):
+        info("开始更新DDNS记录")
+        for _ in range(3):
+            try:
+                dns.update_record_simple(srv_prefix, sub_domain, domain, ip, port)
+                info("DDNS更新成功 %s.%s", sub_domain, domain)
+                return
+            except ValueError as e:
+                error("DDNS更新失败： %s", e)
+                debug(traceback.format_exc())
+                time.sleep(3)
+    return lambda ip, port: threading.Thread(target=update_dns, args=(ip, port), daemon=True).start()
+
+def shared_port(local_addr, socket_type, query_function, update_dns, name="", probe_interval=PROBE_INTERVAL, probe_full_interval=PROBE_FULL_INTERVAL):
+    # type: (socket._Address, int, Callable[[str, int], tuple[bool, str]], Callable[[str, int], None], str, float, float) -> None
+    """
+    Shared-port mode of one service, name prefixes its log lines. The mapped
+    address is checked with a TCP connect or a RakNet ping, query_function
+    only runs every probe_full_interval seconds.
+    """
+    probe_function = tcp_query if socket_type is TYPE_TCP else raknet_ping
+    local_online_filter = logger_filter(60) # 相同日志60次合并成1次
+    while True:
+        status, msg = query_function("127.0.0.1", local_addr[1])
+        if not status:
+            if local_online_filter(msg):
+                warning("%s服务器不在线, %s", name, msg)
+            time.sleep(10)
+            continue
+        try:
+            mapped_addr = get_self_ip_port(local_addr, socket_type)
+        except ValueError as e:
+            error("%s获取映射地址失败：%s", name, e)
+            debug(traceback.format_exc())
+            time.sleep(10)
+            continue
+        info("%s获取到映射地址： %s:%s", name, *mapped_addr)
+        status, msg = query_function(*mapped_addr)
+        if not status:
+            error("%s映射地址不可用，开始重新映射，%s", name, msg)
+            time.sleep(1)
+            continue
+        update_dns(*mapped_addr)
+        remote_online_filter = logger_filter(1800)
+        scheduler = probe_scheduler(probe_interval, probe_full_interval)
+        while True:
+            delay, full = scheduler.next()
+            time.sleep(delay)
+            status, msg = (query_function if full else probe_function)(*mapped_addr)
+            if not scheduler.report(status):
+                warning("%s映射地址离线，开始重新映射，%s", name, msg)
+                break
+            if not status:
+                info("%s映射地址探测失败，%s 秒后重试，%s", name, scheduler.retry_interval, msg)
+            elif full and remote_online_filter(msg):
+                info("%sMOTD: %s", name, msg)
+
+def main_services(config, dns, _debug, splice, nat_timeout):
+    # type: (dict, nat1_traversal.dns.dns_base, bool, bool, dict[str, float]) -> None
+    """
+    services: [...] mode. Each item is a config of its own whose missing
+    fields come from the top level. Shared-port services run in threads of
+    this process, the others share one forwarder process and event loop.
+    """
+    services = config["services"]
+    if not isinstance(services, list) or not all(isinstance(x, dict) for x in services):
+        error("services 应为对象数组")
+        sys.exit(1)
+    base = {k: v for k, v in config.items() if k != "services"}
+    shared = [] # type: list[tuple]
+    forwards = [] # type: list[tuple]
+    process_options = {}
+    standby = 1
+    ports = set()
+    for i, service in enumerate(services):
+        service_config = dict(base, **service)
+        for key in PROCESS_FIELDS:
+            service_config[key] = base[key]
+        name = "服务%d(%s)" % (i + 1, service_config["type"])
+        if service_config["type"] not in SERVICE_TYPES:
+            error("%s 不支持的type: %s", name, service_config["type"])
+            sys.exit(1)
+        srv_prefix, query_function, socket_type = SERVICE_TYPES[service_config["type"]]
+        try:
+            local_addr = convert_addr(service_config["local"], "0.0.0.0")
+            remote_addr = convert_addr(service_config["remote"], "127.0.0.1")
+        except ValueError as e:
+            error("%s 的 local 或 remote 字段解析错误: %s", name, e)
+            debug(traceback.format_exc())
+            sys.exit(1)
+        if local_addr is None:
+            error("%s 缺少 local 字段", name)
+            sys.exit(1)
+        try:
+            local_addr = addr_available(local_addr, socket_type)
+        except ValueError as e:
+            error("%s 的local地址不可用：%s", name, e)
+            debug(traceback.format_exc())
+            sys.exit(1)
+        if (socket_type, local_addr[1]) in ports:
+            error("%s 的local端口 %s 与其他服务重复", name, local_addr[1])
+            sys.exit(1)
+        ports.add((socket_type, local_addr[1]))
+        update_dns = dns_updater(dns, srv_prefix, service_config["sub_domain"], service_config["domain"])
+        if remote_addr is None:
+            if IS_WINDOWS:
+                error("Windows平台不支持共端口模式")
+                sys.exit(1)
+            if local_addr[1] == 0:
+                error("共端口模式port不能为0")
+                sys.exit(1)
+            info("%s 共端口模式", name)
+            shared.append((local_addr, socket_type, query_function, update_dns, name + " ", *parse_probe_options(service_config, socket_type, nat_timeout)))
+            continue
+        if socket_type is TYPE_UDP:
+            if str(service_config["udp_engine"]).strip().lower() not in ("none", "asyncio"):
+                error("services 模式下UDP转发仅支持 asyncio 实现")
+                sys.exit(1)
+            service_config["udp_engine"] = "asyncio"
+            service_config["splice"] = service.get("splice", False) # 顶层的splice只作用于TCP服务
+        else:
+            service_config["udp_engine"] = None
+        info("%s 转发模式", name)
+        workers, standby, options = parse_forward_options(service_config, socket_type, splice and socket_type is TYPE_TCP, nat_timeout)
+        if workers > 1:
+            warning("services 模式下 workers 将被设置为1")
+        process_options = {key: options.pop(key) for key in ("event_loop", "metrics_port", "log_options")}
+        for key in ("engine", "batch", "mmsg", "gso", "max_datagram"): # 仅selector实现使用
+            options.pop(key, None)
+        forwards.append((local_addr, remote_addr, socket_type, dict(options, reuseport=True), update_dns, name))
+    if not services:
+        error("services 不能为空")
+        sys.exit(1)
+    register_exit()
+    register_logger_level_change()
+    for x in shared:
+        threading.Thread(target=shared_port, args=x, daemon=True).start()
+    if not forwards:
+        while True:
+            time.sleep(3600)
+    multiprocessing.set_start_method("spawn")
+    standby = standby_pool(standby)
+    standby.fill() # 获取映射地址期间完成导入
+    while True:
+        run_services(forwards, _debug, process_options, standby)
+        warning("转发发生异常，可能是映射地址离线，开始重新转发")
+        time.sleep(5)
 
 def main():
     parser = argparse.ArgumentParser(description='NAT1 Traversal', add_help=False, allow_abbrev=False, usage=argparse.SUPPRESS)
@@ -80,8 +798,10 @@ def main():
     parser.add_argument('-r', '--remote', dest='R', type=str, nargs='?', const=':')
     parser.add_argument('-c', '--config', dest='C', type=str, default="config.json")
     parser.add_argument('-d', '--debug', dest='D', action='store_true')
+    parser.add_argument('-s', '--splice', dest='S', action='store_true')
     parser.add_argument('-v', '--version', dest='V', action='store_true')
     parser.add_argument('-t', '--nat-type-test', dest='T', action='store_true')
+    parser.add_argument('-p', '--probe-nat-timeout', dest='P', type=float, nargs='?', const=MAPPING_TIMEOUT_MAX)
     parser.add_argument('-q', '--query', dest='Q', type=str, nargs='?', const=':0')
     parser.add_argument('-qj', '--query-java', dest='QJ', type=str, nargs='?', const=':0')
     parser.add_argument('-qj6', '--query-java-v6', dest='QJ6', type=str, nargs='?', const=':0')
@@ -93,7 +813,7 @@ def main():
 
     if args.H:
         info(
-            "\n%s [-h] [-l] [-r] [-c] [-d] [-v] [-q]"
+            "\n%s [-h] [-l] [-r] [-c] [-d] [-s] [-v] [-q]"
             "\n-h   --help                              显示本帮助"
             "\n-l   --local [[ip]:[port]]               本地监听地址，省略ip时默认为0.0.0.0，省略port时默认为25565"
             "\n                                         此字段将覆盖config.json中的local字段"
@@ -101,8 +821,12 @@ def main():
             "\n                                         此字段将覆盖config.json中的remote字段"
             "\n-c   --config <config.json>              DDNS配置文件，不指定时默认为当前目录的config.json"
             "\n-d   --debug                             Debug模式"
+            "\n-s   --splice                            TCP转发使用splice零拷贝（仅Linux），不支持时自动回退"
+            "\n                                         此字段将覆盖config.json中的splice字段"
             "\n-v   --version                           显示版本"
             "\n-t   --nat-type-test                     NAT类型测试（仅参考）"
+            "\n-p   --probe-nat-timeout [seconds]       探测NAT映射的空闲超时，最长测试seconds秒，默认为600"
+            "\n                                         结果保存到配置文件所在目录的nat_timeout.json，用于自动设置保活间隔"
             "\n-q   --query [<host>[:port]]             MC服务器MOTD查询，IPv6优先（Java+Bedrock）"
             "\n-qj  --query-java [<host>[:port]]        JE服务器MOTD查询，仅IPv4，省略port时默认为25565"
             "\n-qj6 --query-java-v6 [<host>[:port]]     JE服务器MOTD查询，仅IPv6，省略port时默认为25565"
@@ -119,6 +843,39 @@ def main():
             "\nlocal(String|null)"
             "\nremote(String|null)"
             "\nproxy_protocol(String|null)              v1|v2|null，仅TCP模式下可用，转发真实客户端IP"
+            "\nproxy_protocol_authority(String|null)    PROXY Protocol v2 附带的 AUTHORITY TLV（主机名）"
+            "\nproxy_protocol_unique_id(Boolean)        PROXY Protocol v2 是否附带每个连接唯一的 UNIQUE_ID TLV"
+            "\nsplice(Boolean)                          true|false，仅TCP转发模式下可用，使用splice零拷贝转发"
+            "\nworkers(Number)                          转发进程数，大于1时使用SO_REUSEPORT分摊连接/会话"
+            "\nstandby(Number)                          预先启动并完成导入的备用转发进程数，转发进程重启时直接接替，0为不启用"
+            "\nevent_loop(String|null)                  asyncio|uvloop|null，转发使用的事件循环，uvloop未安装时回退到asyncio"
+            "\nudp_engine(String|null)                  selector|asyncio|null，UDP转发的实现，默认为selector"
+            "\nudp_batch(Number)                        selector实现每次唤醒每个socket最多收取的数据包数"
+            "\nudp_mmsg(Boolean)                        selector实现使用recvmmsg/sendmmsg批量收发（仅Linux）"
+            "\nudp_gso(Boolean)                         selector实现使用UDP GRO接收、GSO发送同长度的连续数据包（仅Linux）"
+            "\nudp_max_datagram(Number)                 selector实现的最大数据包大小，超出部分会被截断，最大65535"
+            "\nudp_session_timeout(Number|null)         UDP会话空闲超时秒数，null时mcbe为60，udp为30"
+            "\nudp_max_sessions(Number|null)            UDP最大会话数，超出时断开最久未活动的会话，null时按fd上限自动计算，0为不限制"
+            "\nudp_per_prefix_sessions(Number)          UDP每个来源网段(IPv4 /24，IPv6 /64)的最大会话数，0为不限制"
+            "\nmcbe_pong_cache(Number)                  mcbe转发模式下由转发进程应答RakNet Unconnected Ping，缓存的后端pong刷新间隔秒数，0为不启用"
+            "\nbackend_pool(Number)                     预连接到remote的空闲连接数，仅TCP转发模式下可用，0为不启用"
+            "\nbackend_pool_rate(Number)                连接池每秒最多补充的连接数"
+            "\nmcje_status_cache(Number)                mcje转发模式下由转发进程应答服务器列表状态请求，缓存秒数，0为不启用"
+            "\nmetrics_port(Number|null)                转发模式下在127.0.0.1该端口提供Prometheus格式的/metrics，null为不启用"
+            "\nmax_connections(Number)                  TCP转发模式下的最大并发连接数，0为不限制"
+            "\nper_ip_connections(Number)               TCP转发模式下每个IP的最大并发连接数，0为不限制"
+            "\nper_ip_rate(Number)                      TCP转发模式下每个IP每秒最多接受的新连接数，0为不限制"
+            "\nper_ip_burst(Number)                     per_ip_rate允许的突发连接数"
+            "\nlog_rate(Number)                         转发进程中每条日志语句每秒最多输出的行数，0为不限制"
+            "\nlog_burst(Number)                        log_rate允许的突发行数"
+            "\nlog_sample(Number)                       超出log_rate后每N行采样输出1行，0为全部丢弃"
+            "\nstun_tcp(Array)                          TCP的STUN服务器列表（host[:port]），并行竞速，按历史延迟与失败次数排序"
+            "\nstun_udp(Array)                          UDP的STUN服务器列表（host[:port]），省略port时默认为3478"
+            "\nkeepalive_interval(Number|null)          转发模式下ping/pong保活的间隔秒数，null时按--probe-nat-timeout的结果设置，无结果时为1"
+            "\nprobe_interval(Number|null)              共端口模式下轻量探测映射地址（TCP连接/RakNet ping）的间隔秒数，失败后每秒重试"
+            "\n                                         null时按--probe-nat-timeout的结果设置，无结果时为5"
+            "\nprobe_full_interval(Number)              共端口模式下完整MOTD查询的间隔秒数"
+            "\nservices(Array)                          多服务模式，每项为一个服务的配置，未填写的字段使用顶层的值"
         , sys.argv[0])
         sys.exit(0)
     if args.V:
@@ -173,6 +930,13 @@ def main():
         info("TCP: NAT%s", nat_type_test(local_addr, TYPE_TCP)[1])
         info("UDP: NAT%s", nat_type_test(local_addr, TYPE_UDP)[1])
         sys.exit(0)
+    if args.P is not None:
+        if args.P <= 0:
+            error("参数 --probe-nat-timeout 应为正数")
+            sys.exit(1)
+        if not os.path.isfile(args.C): # 没有配置文件时使用默认的stun服务器
+            probe_nat_timeout(local_addr, args.P, nat_timeout_path(args.C))
+            sys.exit(0)
     config = {
         "type": "mcje",
         "dns": "no_dns",
@@ -182,7 +946,39 @@ def main():
         "sub_domain": "",
         "local": None,
         "remote": None,
-        "proxy_protocol": None
+        "proxy_protocol": None,
+        "proxy_protocol_authority": None,
+        "proxy_protocol_unique_id": False,
+        "splice": False,
+        "workers": 1,
+        "standby": 1,
+        "event_loop": None,
+        "udp_engine": None,
+        "udp_batch": 64,
+        "udp_mmsg": False,
+        "udp_gso": False,
+        "udp_max_datagram": 65535,
+        "udp_session_timeout": None,
+        "udp_max_sessions": None,
+        "udp_per_prefix_sessions": 0,
+        "mcbe_pong_cache": 5,
+        "backend_pool": 0,
+        "backend_pool_rate": 10,
+        "mcje_status_cache": 0,
+        "metrics_port": None,
+        "max_connections": 0,
+        "per_ip_connections": 0,
+        "per_ip_rate": 0,
+        "per_ip_burst": 10,
+        "log_rate": 10,
+        "log_burst": 100,
+        "log_sample": 100,
+        "stun_tcp": ["%s:%d" % x for x in TCP_STUN_SERVERS],
+        "stun_udp": ["%s:%d" % x for x in UDP_STUN_SERVERS],
+        "keepalive_interval": None,
+        "probe_interval": None,
+        "probe_full_interval": PROBE_FULL_INTERVAL,
+        "services": []
     }
     if not os.path.isfile(args.C):
         error("DDNS配置文件 %s 未找到" , os.path.abspath(args.C))
@@ -197,6 +993,7 @@ def main():
         except (EOFError, OSError):
             debug(traceback.format_exc())
         sys.exit(1)
+    import charset_normalizer # 只有读取配置文件时才需要
     try:
         with open(args.C, "rb") as f:
             config_b1 = f.read()
@@ -220,6 +1017,10 @@ def main():
         del config_b1
         del config_b2
         del config_d
+    set_stun_servers(parse_stun_servers(config["stun_tcp"], "stun_tcp"), parse_stun_servers(config["stun_udp"], "stun_udp"))
+    if args.P is not None:
+        probe_nat_timeout(local_addr, args.P, nat_timeout_path(args.C))
+        sys.exit(0)
     try:
         dns = getattr(nat1_traversal.dns, config["dns"])(config["id"], config["token"]) # type: nat1_traversal.dns.dns_base
         info("使用的DNS供应商为 %s", config["dns"])
@@ -227,6 +1028,12 @@ def main():
         error("不受支持的DNS供应商 %s", config["dns"])
         debug(traceback.format_exc())
         sys.exit(1)
+    nat_timeout = load_nat_timeout(nat_timeout_path(args.C))
+    if config["services"]:
+        if args.L or args.R:
+            warning("services 模式下忽略 --local 与 --remote 参数")
+        main_services(config, dns, args.D, args.S, nat_timeout)
+        return
     try:
         remote_addr = convert_addr(args.R, "127.0.0.1")
     except ValueError as e:
@@ -255,30 +1062,11 @@ def main():
     if remote_addr is None and local_addr[1] == 0:
         error("共端口模式port不能为0")
         sys.exit(1)
-    if config["type"] == "mcje":
-        srv_prefix = "_minecraft._tcp."
-        query_function = mcje_query
-        socket_type = TYPE_TCP
-    elif config["type"] == "web":
-        srv_prefix = "_web._tcp."
-        query_function = tcp_query
-        socket_type = TYPE_TCP
-    elif config["type"] == "tcp":
-        srv_prefix = "_tcp."
-        query_function = tcp_query
-        socket_type = TYPE_TCP
-    elif config["type"] == "mcbe":
-        srv_prefix = "_minecraft._udp."
-        query_function = mcbe_query
-        socket_type = TYPE_UDP
-    elif config["type"] == "udp":
-        srv_prefix = "_udp."
-        query_function = udp_query
-        socket_type = TYPE_UDP
-    else:
+    if config["type"] not in SERVICE_TYPES:
         error("不支持的type: %s", config["type"])
         sys.exit(1)
         return
+    srv_prefix, query_function, socket_type = SERVICE_TYPES[config["type"]]
     try:
         local_addr = addr_available(local_addr, socket_type)
     except ValueError as e:
@@ -287,69 +1075,19 @@ def main():
         sys.exit(1)
     register_exit()
     register_logger_level_change()
-    def update_dns(ip: str, port: int):
-        nonlocal dns, config, srv_prefix
-        info("开始更新DDNS记录")
-        for _ in range(3):
-            try:
-                dns.update_record_simple(srv_prefix, config["sub_domain"], config["domain"], ip, port)
-                info("DDNS更新成功 %s.%s", config["sub_domain"], config["domain"])
-                return
-            except ValueError as e:
-                error("DDNS更新失败： %s", e)
-                debug(traceback.format_exc())
-                time.sleep(3)
+    update_dns = dns_updater(dns, srv_prefix, config["sub_domain"], config["domain"])
     if remote_addr is None:
         if IS_WINDOWS:
             error("Windows平台不支持共端口模式")
             sys.exit(1)
         info("共端口模式")
-        local_online_filter = logger_filter(60) # 相同日志60次合并成1次
-        while True:
-            status, msg = query_function("127.0.0.1", local_addr[1])
-            if not status:
-                if local_online_filter(msg):
-                    warning("服务器不在线, %s", msg)
-                time.sleep(10)
-                continue
-            try:
-                mapped_addr = get_self_ip_port(local_addr, socket_type)
-            except ValueError as e:
-                error("获取映射地址失败：%s", e)
-                debug(traceback.format_exc())
-                time.sleep(10)
-                continue
-            info("获取到映射地址： %s:%s", *mapped_addr)
-            status, msg = query_function(*mapped_addr)
-            if not status:
-                error("映射地址不可用，开始重新映射，%s", msg)
-                time.sleep(1)
-                continue
-            threading.Thread(target=update_dns, args=mapped_addr, daemon=True).start()
-            remote_online_filter = logger_filter(1800)
-            while True:
-                time.sleep(1)
-                status, msg = query_function(*mapped_addr)
-                if not status:
-                    warning("映射地址离线，开始重新映射，%s", msg)
-                    break
-                else:
-                    if remote_online_filter(msg):
-                        info("MOTD: %s", msg)
+        shared_port(local_addr, socket_type, query_function, update_dns, "", *parse_probe_options(config, socket_type, nat_timeout))
     else:
         info("转发模式")
-        # Proxy Protocol validation: only for TCP types
-        proxy_protocol_version = config.get("proxy_protocol", None)
-        if proxy_protocol_version is not None:
-            proxy_protocol_version = str(proxy_protocol_version).strip().lower()
-            if proxy_protocol_version not in ("v1", "v2"):
-                error("不支持的 proxy_protocol 版本: %s，可选值为 v1, v2 或 null", config["proxy_protocol"])
-                sys.exit(1)
-            if socket_type is not TYPE_TCP:
-                error("proxy_protocol 仅在 TCP 模式下可用 (mcje/web/tcp)，当前模式: %s", config["type"])
-                sys.exit(1)
-            info("已启用 PROXY Protocol %s，将转发真实客户端IP", proxy_protocol_version)
+        workers, standby, forward_options = parse_forward_options(config, socket_type, args.S, nat_timeout)
         multiprocessing.set_start_method("spawn")
+        standby = standby_pool(standby)
+        standby.fill() # 获取映射地址期间完成导入
         while True:
             try:
                 mapped_addr = get_self_ip_port(local_addr, socket_type)
@@ -358,13 +1096,11 @@ def main():
                 debug(traceback.format_exc())
                 time.sleep(10)
                 continue
-            threading.Thread(target=update_dns, args=mapped_addr, daemon=True).start()
-            forward_process = multiprocessing.Process(target=forward_main, args=(local_addr, remote_addr, mapped_addr, args.D, socket_type, proxy_protocol_version), daemon=True)
-            forward_process.start()
-            forward_process.join()
+            update_dns(*mapped_addr)
+            run_forward(local_addr, remote_addr, mapped_addr, args.D, socket_type, forward_options, workers, standby,
+                        lambda addr: update_dns(*addr))
             warning("转发发生异常，可能是映射地址离线，开始重新转发")
             time.sleep(5)
 
 if __name__ == "__main__":
-    multiprocessing.freeze_support()
     main()
@@ -3,10 +3,11 @@
 
 __author__ = "Guation"
 
-import requests
 from logging import debug, info, warning, error
 
-def resolve(qname: str, qtype: str) -> list[dict]:
+def resolve(qname, qtype):
+    # type: (str, str) -> list[dict]
+    import requests # 仅在需要解析时导入，转发进程用不到
     for _ in range(3):
         try:
             response = requests.request("GET", "https://223.5.5.5/resolve", params={"name": qname, "type": qtype}, timeout=5.0)
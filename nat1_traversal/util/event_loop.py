@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+__author__ = "Guation"
+
+import asyncio, importlib.util, os, threading
+from logging import debug, info, warning, error
+
+EVENT_LOOPS = ("asyncio", "uvloop")
+PING = b"ping" # ping的前缀，其后为nonce
+PING_NONCE_SIZE = 8
+
+def ping_nonce():
+    # type: () -> bytes
+    """
+    Nonce of a ping/pong channel. A ping is PING + nonce, so a process
+    waiting for the pong does not take a client arriving meanwhile for it.
+    """
+    return os.urandom(PING_NONCE_SIZE)
+
+def event_loop_available(event_loop):
+    # type: (str | None) -> bool
+    if event_loop is None or event_loop == "asyncio":
+        return True
+    return importlib.util.find_spec(event_loop) is not None
+
+def run_event_loop(main, event_loop=None):
+    # type: (Coroutine, str | None) -> Any
+    """asyncio.run() on the selected event loop, falling back to the default one."""
+    if event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            warning("未安装uvloop，使用默认事件循环")
+        else:
+            debug("使用uvloop事件循环")
+            if hasattr(uvloop, "run"): # uvloop 0.18+
+                return uvloop.run(main)
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
+
+def watch_connection(connection, callback):
+    # type: (Connection, Callable[..., None]) -> None
+    """
+    Call callback(*message) on the running loop for every message received
+    on a multiprocessing connection. A thread does the blocking recv(), so
+    it also works where pipes cannot be added to the loop (Windows).
+    """
+    loop = asyncio.get_running_loop()
+    def reader():
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                return
+            loop.call_soon_threadsafe(callback, *message)
+    threading.Thread(target=reader, daemon=True).start()
+
+class control_channel:
+    """
+    One service's share of the control pipe of a multi-service forwarder:
+    messages carry the index of the service in both directions.
+    """
+    def __init__(self, connection, index):
+        # type: (Connection, int) -> None
+        self.connection = connection
+        self.index = index
+        self.callback = None # type: Callable[..., None] | None
+
+    def send(self, message):
+        # type: (tuple) -> None
+        self.connection.send((self.index,) + message)
+
+def watch_control(control, callback):
+    # type: (Connection | control_channel, Callable[..., None]) -> None
+    """watch_connection() for a pipe of its own or a control_channel."""
+    if isinstance(control, control_channel):
+        control.callback = callback
+    else:
+        watch_connection(control, callback)
+
+def watch_channels(connection, channels):
+    # type: (Connection, list[control_channel]) -> None
+    """Hand (index, *message) received on connection to channels[index]."""
+    def dispatch(index, *message):
+        callback = channels[index].callback
+        if callback is not None:
+            callback(*message)
+    watch_connection(connection, dispatch)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# UDP GSO (UDP_SEGMENT) / GRO (UDP_GRO), Linux 4.18+ / 5.0+
+
+__author__ = "Guation"
+
+import socket, struct, sys, traceback
+from logging import debug, info, warning, error
+
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+UDP_MAX_SEGMENTS = 64 # 内核单次GSO发送的最大分段数
+GSO_MAX_SIZE = 65000 # 单次GSO发送的最大负载，需小于IP包上限
+GRO_ANCBUFSIZE = socket.CMSG_SPACE(4) if hasattr(socket, "CMSG_SPACE") else 0
+
+def gso_available():
+    # type: () -> bool
+    """Probe UDP_GRO and a two segment UDP_SEGMENT send on loopback."""
+    if not sys.platform.startswith("linux") or not hasattr(socket.socket, "sendmsg"):
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock1, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock2:
+            sock1.bind(("127.0.0.1", 0))
+            sock1.setsockopt(SOL_UDP, UDP_GRO, 1)
+            sock1.settimeout(1)
+            sock2.sendmsg([b"\0" * 8], [gso_cmsg(4)], 0, sock1.getsockname())
+            data, ancdata, _, _ = sock1.recvmsg(16, GRO_ANCBUFSIZE)
+            if len(data) == 8: # 回环上GSO包会原样合并交付
+                return gro_segment_size(ancdata, len(data)) == 4
+            return len(data) == 4 and len(sock1.recv(16)) == 4
+    except OSError:
+        debug(traceback.format_exc())
+        return False
+
+def enable_gro(sock):
+    # type: (socket.socket) -> None
+    sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+
+def gso_cmsg(segment_size):
+    # type: (int) -> tuple[int, int, bytes]
+    return SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment_size)
+
+def gro_segment_size(ancdata, size):
+    # type: (list[tuple[int, int, bytes]], int) -> int
+    """Segment size of a buffer returned by recvmsg on a UDP_GRO socket."""
+    for level, _type, data in ancdata:
+        if level == SOL_UDP and _type == UDP_GRO:
+            return struct.unpack("=i", data[:4])[0]
+    return size
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+__author__ = "Guation"
+
+import queue, time
+from logging import Filter, Handler, LogRecord
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_QUEUE_SIZE = 10000
+
+class sample_filter(Filter):
+    """
+    Per call site (file + line) token bucket: each site may emit `rate`
+    records per second with bursts of `burst`. Once the bucket is empty only
+    every `sample`-th record passes (0 drops all of them); the next record
+    that passes carries the number of lines suppressed since.
+    """
+    def __init__(self, rate, burst, sample):
+        # type: (float, int, int) -> None
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.sites = {} # type: dict[tuple[str, int], list]
+        self.suppressed = 0
+
+    def filter(self, record):
+        # type: (LogRecord) -> bool
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        site = self.sites.get(key)
+        if site is None:
+            # tokens, last, suppressed, sampled
+            site = self.sites[key] = [self.burst, now, 0, 0]
+        site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+        site[1] = now
+        if site[0] >= 1:
+            site[0] -= 1
+        else:
+            site[3] += 1
+            if not self.sample or site[3] % self.sample:
+                site[2] += 1
+                self.suppressed += 1
+                return False
+        if site[2]:
+            record.msg = "%s (已抑制 %d 条同类日志)" % (record.msg, site[2])
+            site[2] = 0
+        return True
+
+class queue_handler(QueueHandler):
+    """Enqueue records as is and drop them when the queue is full, the caller never blocks."""
+    def __init__(self, log_queue, log_filter):
+        # type: (queue.Queue, sample_filter) -> None
+        super().__init__(log_queue)
+        self.addFilter(log_filter)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # type: (LogRecord) -> LogRecord
+        # 同进程内的写线程负责格式化，这里不做任何格式化
+        return record
+
+    def enqueue(self, record):
+        # type: (LogRecord) -> None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class queue_listener(QueueListener):
+    def enqueue_sentinel(self):
+        # type: () -> None
+        # 队列满时等待写线程腾出空间，不能像记录一样丢弃
+        self.queue.put(self._sentinel)
+
+_listener = None # type: queue_listener | None
+_filter = None # type: sample_filter | None
+_handler = None # type: queue_handler | None
+
+def start_log_queue(handler, rate=0, burst=0, sample=0):
+    # type: (Handler, float, int, int) -> queue_handler
+    """
+    Return a handler that hands records to a background thread writing to
+    `handler`. Calling it again swaps the output handler (e.g. on a debug
+    level change) while keeping the queue and the rate limit state.
+    """
+    global _listener, _filter, _handler
+    if _listener is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _filter = sample_filter(rate, burst, sample)
+        _handler = queue_handler(log_queue, _filter)
+        _listener = queue_listener(log_queue, handler)
+        _listener.start()
+    else:
+        _listener.handlers = (handler,)
+    return _handler
+
+def stop_log_queue():
+    # type: () -> None
+    """Write out what is left in the queue and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def suppressed_lines():
+    # type: () -> int
+    """Lines dropped by the rate limit or because the queue was full."""
+    if _handler is None:
+        return 0
+    return _filter.suppressed + _handler.dropped
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+__author__ = "Guation"
+
+import bisect, threading, traceback
+from logging import debug, info, warning, error
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class counter:
+    """Plain int cell, the hot path only does `c.value += n`."""
+    __slots__ = ("value",)
+    def __init__(self):
+        self.value = 0
+
+class histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+    def __init__(self, buckets):
+        # type: (tuple[float, ...]) -> None
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # type: (float) -> None
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class histogram_sum:
+    """Histograms with the same buckets read as one."""
+    def __init__(self, parts):
+        # type: (list[histogram | histogram_sum]) -> None
+        self.parts = parts
+        self.buckets = parts[0].buckets
+
+    @property
+    def counts(self):
+        return [sum(x) for x in zip(*(part.counts for part in self.parts))]
+
+    @property
+    def sum(self):
+        return sum(part.sum for part in self.parts)
+
+    @property
+    def count(self):
+        return sum(part.count for part in self.parts)
+
+def _value(metric):
+    # type: (counter | Callable[[], float]) -> float
+    return metric.value if isinstance(metric, counter) else metric()
+
+class registry:
+    """
+    Metrics of one forwarder process. Values are only read and formatted
+    when scraped, gauges backed by a function are computed at that time.
+    A series added again with the same name and labels, e.g. by another
+    service of the process, is added up with the existing one.
+    """
+    def __init__(self):
+        self.metrics = {} # type: dict[str, tuple[str, str, list[tuple[str, object]]]]
+
+    def _add(self, name, _type, help, labels, metric):
+        # type: (str, str, str, dict | None, object) -> object
+        label_str = ",".join('%s="%s"' % x for x in labels.items()) if labels else ""
+        self._add_series(name, _type, help, label_str, metric)
+        return metric
+
+    def _add_series(self, name, _type, help, label_str, metric):
+        # type: (str, str, str, str, object) -> None
+        series = self.metrics.setdefault(name, (_type, help, []))[2]
+        for i, (x, y) in enumerate(series):
+            if x != label_str:
+                continue
+            if y is not metric:
+                if isinstance(y, (histogram, histogram_sum)):
+                    series[i] = (x, histogram_sum([y, metric]))
+                else:
+                    series[i] = (x, lambda y=y: _value(y) + _value(metric))
+            return
+        series.append((label_str, metric))
+
+    def merge(self, other):
+        # type: (registry) -> None
+        """Serve the metrics of other too, metric objects shared by both are counted once."""
+        for name, (_type, help, series) in other.metrics.items():
+            for label_str, metric in series:
+                self._add_series(name, _type, help, label_str, metric)
+
+    def counter(self, name, help, labels=None):
+        # type: (str, str, dict | None) -> counter
+        return self._add(name, "counter", help, labels, counter())
+
+    def gauge(self, name, help, labels=None):
+        # type: (str, str, dict | None) -> counter
+        return self._add(name, "gauge", help, labels, counter())
+
+    def gauge_func(self, name, help, func, labels=None):
+        # type: (str, str, Callable[[], float], dict | None) -> None
+        self._add(name, "gauge", help, labels, func)
+
+    def counter_func(self, name, help, func, labels=None):
+        # type: (str, str, Callable[[], float], dict | None) -> None
+        self._add(name, "counter", help, labels, func)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        # type: (str, str, tuple[float, ...], dict | None) -> histogram
+        return self._add(name, "histogram", help, labels, histogram(buckets))
+
+    def render(self):
+        # type: () -> str
+        lines = []
+        for name, (_type, help, series) in self.metrics.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, _type))
+            for label_str, metric in series:
+                if isinstance(metric, (histogram, histogram_sum)):
+                    cumulative = 0
+                    prefix = label_str + "," if label_str else ""
+                    for bound, count in zip(metric.buckets + ("+Inf",), metric.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, cumulative))
+                    lines.append("%s_sum%s %s" % (name, "{%s}" % label_str if label_str else "", metric.sum))
+                    lines.append("%s_count%s %d" % (name, "{%s}" % label_str if label_str else "", metric.count))
+                else:
+                    value = _value(metric)
+                    lines.append("%s%s %s" % (name, "{%s}" % label_str if label_str else "", value))
+        return "\n".join(lines) + "\n"
+
+def start_metrics_server(metrics, port):
+    # type: (registry, int) -> None
+    """Serve /metrics on 127.0.0.1:port from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, HTTPServer # 未启用metrics时不导入
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            try:
+                body = metrics.render().encode()
+            except Exception:
+                error("生成metrics失败")
+                debug(traceback.format_exc())
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            debug("metrics %s - %s", self.address_string(), format % args)
+
+    try:
+        server = HTTPServer(("127.0.0.1", port), handler)
+    except OSError:
+        error("metrics 无法监听 127.0.0.1:%d", port)
+        debug(traceback.format_exc())
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    info("metrics 监听于 http://127.0.0.1:%d/metrics", port)
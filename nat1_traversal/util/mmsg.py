@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# recvmmsg(2)/sendmmsg(2) through ctypes, Linux only
+
+__author__ = "Guation"
+
+import ctypes, ctypes.util, errno, os, socket, struct, sys, traceback
+from logging import debug, info, warning, error
+
+MSG_DONTWAIT = 0x40
+SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        for func in (_libc.recvmmsg, _libc.sendmmsg):
+            func.restype = ctypes.c_int
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    return _libc
+
+def mmsg_available():
+    # type: () -> bool
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        _load_libc()
+        sock1 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock1.bind(("127.0.0.1", 0))
+            sock2.connect(sock1.getsockname())
+            sock2.send(b"\0")
+            return len(mmsg_buffer(1, 16).recv(sock1)) == 1
+        finally:
+            sock1.close()
+            sock2.close()
+    except (OSError, AttributeError):
+        debug(traceback.format_exc())
+        return False
+
+def _parse_sockaddr(buffer, offset):
+    # type: (ctypes.Array, int) -> socket._RetAddress
+    family = struct.unpack_from("=H", buffer, offset)[0]
+    if family == socket.AF_INET:
+        port, = struct.unpack_from("!H", buffer, offset + 2)
+        return socket.inet_ntop(socket.AF_INET, bytes(buffer[offset + 4:offset + 8])), port
+    port, flowinfo = struct.unpack_from("!HI", buffer, offset + 2)
+    scope_id, = struct.unpack_from("=I", buffer, offset + 24)
+    return socket.inet_ntop(socket.AF_INET6, bytes(buffer[offset + 8:offset + 24])), port, flowinfo, scope_id
+
+def _build_sockaddr(addr):
+    # type: (socket._Address) -> bytes
+    try:
+        return struct.pack("=H", socket.AF_INET) + struct.pack("!H", addr[1]) + socket.inet_pton(socket.AF_INET, addr[0]) + bytes(8)
+    except OSError:
+        flowinfo, scope_id = (addr[2], addr[3]) if len(addr) == 4 else (0, 0)
+        return struct.pack("=H", socket.AF_INET6) + struct.pack("!HI", addr[1], flowinfo) + socket.inet_pton(socket.AF_INET6, addr[0]) + struct.pack("=I", scope_id)
+
+class mmsg_buffer:
+    """
+    Preallocated headers and buffers for up to `count` datagrams of `size`
+    bytes. The received data is copied out, so one instance can be shared
+    by all sockets of a single threaded loop.
+    """
+    def __init__(self, count, size):
+        # type: (int, int) -> None
+        self.libc = _load_libc()
+        self.count = count
+        self.size = size
+        self.data = ctypes.create_string_buffer(count * size)
+        self.names = ctypes.create_string_buffer(count * SOCKADDR_SIZE)
+        self.send_data = ctypes.create_string_buffer(count * size)
+        self.send_name = ctypes.create_string_buffer(SOCKADDR_SIZE)
+        self.headers = (mmsghdr * count)()
+        self.send_headers = (mmsghdr * count)()
+        self.addr_cache = {} # type: dict[bytes, socket._RetAddress]
+        self.name_cache = {} # type: dict[socket._Address, bytes]
+        # 结构体字段的Python视图只创建一次，热路径上只改长度
+        self.recv_entries = list(self.headers)
+        self.recv_hdrs = [x.msg_hdr for x in self.recv_entries]
+        self.send_hdrs = [x.msg_hdr for x in self.send_headers]
+        self.send_iovecs = (iovec * count)()
+        iovecs = (iovec * count)()
+        for i in range(count):
+            iovecs[i].iov_base = ctypes.addressof(self.data) + i * size
+            iovecs[i].iov_len = size
+            self.recv_hdrs[i].msg_name = ctypes.addressof(self.names) + i * SOCKADDR_SIZE
+            self.recv_hdrs[i].msg_namelen = SOCKADDR_SIZE
+            self.recv_hdrs[i].msg_iov = ctypes.pointer(iovecs[i])
+            self.recv_hdrs[i].msg_iovlen = 1
+            self.send_iovecs[i].iov_base = ctypes.addressof(self.send_data) + i * size
+            self.send_hdrs[i].msg_iov = ctypes.pointer(self.send_iovecs[i])
+            self.send_hdrs[i].msg_iovlen = 1
+        self.recv_iovecs = iovecs
+        self.send_iovec_list = list(self.send_iovecs)
+        self.names_used = 0
+
+    def recv(self, sock, count=None, with_addr=True):
+        # type: (socket.socket, int | None, bool) -> list[tuple[bytes, socket._RetAddress | None]]
+        """Receive up to `count` datagrams without blocking, empty when there are none."""
+        count = min(count or self.count, self.count)
+        # 只需重置上次被内核改写过的namelen
+        for hdr in self.recv_hdrs[:self.names_used]:
+            hdr.msg_namelen = SOCKADDR_SIZE
+        n = self.libc.recvmmsg(sock.fileno(), self.headers, count, MSG_DONTWAIT, None)
+        self.names_used = max(n, 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(err, os.strerror(err))
+        data_base = ctypes.addressof(self.data)
+        datagrams = []
+        if not with_addr:
+            for i in range(n):
+                datagrams.append((ctypes.string_at(data_base + i * self.size, self.recv_entries[i].msg_len), None))
+            return datagrams
+        names = self.names
+        cache = self.addr_cache
+        for i in range(n):
+            offset = i * SOCKADDR_SIZE
+            key = names[offset:offset + self.recv_hdrs[i].msg_namelen]
+            addr = cache.get(key)
+            if addr is None:
+                if len(cache) > 4096:
+                    cache.clear()
+                addr = cache[key] = _parse_sockaddr(names, offset)
+            datagrams.append((ctypes.string_at(data_base + i * self.size, self.recv_entries[i].msg_len), addr))
+        return datagrams
+
+    def send(self, sock, datagrams, addr=None):
+        # type: (socket.socket, list[bytes], socket._Address | None) -> int
+        """
+        Send datagrams to `addr` (or the connected peer), returns how many
+        were sent; the rest would block and are dropped like any UDP packet.
+        """
+        if addr is not None:
+            name = self.name_cache.get(addr)
+            if name is None:
+                if len(self.name_cache) > 4096:
+                    self.name_cache.clear()
+                name = self.name_cache[addr] = _build_sockaddr(addr)
+            ctypes.memmove(self.send_name, name, len(name))
+            name_addr, name_len = ctypes.addressof(self.send_name), len(name)
+        else:
+            name_addr, name_len = None, 0
+        send_base = ctypes.addressof(self.send_data)
+        size = self.size
+        sent = 0
+        while sent < len(datagrams):
+            batch = datagrams[sent:sent + self.count]
+            for i, data in enumerate(batch):
+                ctypes.memmove(send_base + i * size, data, len(data))
+                self.send_iovec_list[i].iov_len = len(data)
+                hdr = self.send_hdrs[i]
+                hdr.msg_name = name_addr
+                hdr.msg_namelen = name_len
+            n = self.libc.sendmmsg(sock.fileno(), self.send_headers, len(batch), MSG_DONTWAIT)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return sent
+                raise OSError(err, os.strerror(err))
+            sent += n
+            if n < len(batch):
+                return sent
+        return sent
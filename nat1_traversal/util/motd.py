@@ -3,15 +3,18 @@
 
 # https://github.com/FragLand/minestat/blob/master/Python/minestat/__init__.py
 
-import socket, struct, json, traceback, time, io, re
+import socket, struct, json, traceback, time, re
 from logging import debug, info, warning, error
-from .stun import new_tcp_socket, new_udp_socket
-from dns_resolve import resolve
+from .stun import new_tcp_socket, new_udp_socket, MTU
+from .dns_resolve import resolve
 
 RAKNET_MAGIC = b'\x00\xff\xff\x00\xfe\xfe\xfe\xfe\xfd\xfd\xfd\xfd\x12\x34\x56\x78'
 MOTD_INDEX = ["edition", "motd_1", "protocol_version", "version", "current_players", "max_players",
                   "server_uid", "motd_2", "gamemode", "gamemode_numeric", "port_ipv4", "port_ipv6"]
 STRIP_MOTD = re.compile(r'§[0-9a-v]')
+RAKNET_UNCONNECTED_PING = 0x01
+RAKNET_UNCONNECTED_PING_OPEN = 0x02
+RAKNET_UNCONNECTED_PONG = 0x1c
 
 
 def unpack_varint(sock: socket.socket) -> int:
@@ -45,6 +48,58 @@ def pack_varint(data) -> bytes:
 
     return ordinal
 
+def read_varint(data: bytes, offset: int = 0) -> tuple:
+    """
+    Varint at `data[offset:]` and the offset after it (buffer counterpart of unpack_varint).
+    Raises IndexError if the buffer ends inside the varint, ValueError if it is longer than 5 bytes.
+    """
+    value = 0
+    for i in range(5):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << 7 * i
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise ValueError("varint too long")
+
+def pack_packet(packet_id: int, payload: bytes) -> bytes:
+    """ Length prefixed Java Edition packet. """
+    data = pack_varint(packet_id) + payload
+    return pack_varint(len(data)) + data
+
+def read_packet(data: bytes, offset: int = 0) -> tuple:
+    """
+    (packet id, payload, end offset) of the length prefixed packet at `data[offset:]`,
+    None if the buffer does not hold all of it yet. Raises ValueError on a malformed length.
+    """
+    try:
+        length, start = read_varint(data, offset)
+    except IndexError:
+        return None
+    if length < 1:
+        raise ValueError("empty packet")
+    end = start + length
+    if end > len(data):
+        return None
+    try:
+        packet_id, body = read_varint(data, start)
+    except IndexError:
+        body = end + 1
+    if body > end:
+        raise ValueError("malformed packet id")
+    return packet_id, data[body:end], end
+
+def parse_handshake(payload: bytes) -> tuple:
+    """ Protocol version, server address, server port and next state of a Handshake (0x00) payload. """
+    try:
+        protocol, offset = read_varint(payload)
+        length, offset = read_varint(payload, offset)
+        address = payload[offset:offset + length].decode("utf8")
+        port, = struct.unpack_from(">H", payload, offset + length)
+        next_state, _ = read_varint(payload, offset + length + 2)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise ValueError("malformed handshake")
+    return protocol, address, port, next_state
+
 def recv_exact(sock: socket.socket, size: int) -> bytearray:
     """
     Helper function for receiving a specific amount of data. Works around the problems of `socket.recv`.
@@ -67,6 +122,47 @@ def recv_exact(sock: socket.socket, size: int) -> bytearray:
 
     return data
 
+def build_unconnected_ping(timestamp, guid):
+    # type: (int, int) -> bytes
+    """ Unconnected Ping: id, timestamp, MAGIC, client GUID. """
+    return struct.pack("<Bq", RAKNET_UNCONNECTED_PING, timestamp) + RAKNET_MAGIC + struct.pack("<q", guid)
+
+def is_unconnected_ping(data):
+    # type: (bytes | memoryview) -> bool
+    return len(data) >= 25 and data[0] in (RAKNET_UNCONNECTED_PING, RAKNET_UNCONNECTED_PING_OPEN) and data[9:25] == RAKNET_MAGIC
+
+def build_unconnected_pong(ping, guid, server_id):
+    # type: (bytes | memoryview, int, bytes) -> bytes
+    """ Unconnected Pong answering `ping`: id, echoed timestamp, server GUID, MAGIC, server ID string. """
+    return struct.pack("<B", RAKNET_UNCONNECTED_PONG) + bytes(ping[1:9]) + struct.pack("<q", guid) + RAKNET_MAGIC + struct.pack(">H", len(server_id)) + server_id
+
+def parse_unconnected_pong(data):
+    # type: (bytes) -> tuple[int, bytes]
+    """ Server GUID and raw server ID string of an Unconnected Pong, raises ValueError if it is not one. """
+    if len(data) < 35 or data[0] != RAKNET_UNCONNECTED_PONG:
+        raise ValueError("packet_id != \\x1c")
+    if data[17:33] != RAKNET_MAGIC:
+        raise ValueError("response_magic != RAKNET_MAGIC")
+    guid, = struct.unpack_from("<q", data, 9)
+    length, = struct.unpack_from(">H", data, 33)
+    return guid, data[35:35 + length]
+
+def parse_server_id(server_id):
+    # type: (str) -> dict
+    """ Unconnected Pong server ID string as the motd dict printed by mcbe_query. """
+    payload_dict = {e: f for e, f in zip(MOTD_INDEX, server_id.split(";"))}
+    out_dict = {}
+    out_dict["version"] = {
+        "name": payload_dict["version"] + " (" + payload_dict["edition"] + ")",
+        "protocol": int(payload_dict["protocol_version"])
+    }
+    try:
+        out_dict["description"] = [STRIP_MOTD.sub('', payload_dict["motd_1"]), STRIP_MOTD.sub('', payload_dict["motd_2"])]
+    except KeyError:  # older Bedrock server versions do not respond with the secondary MotD.
+        out_dict["description"] = [STRIP_MOTD.sub('', payload_dict["motd_1"])]
+    out_dict["players"] = {"max": int(payload_dict["max_players"]), "online": int(payload_dict["current_players"])}
+    return out_dict
+
 def description2str(data):
     # type: (dict | str) -> str
     if type(data) == str:
@@ -257,14 +353,8 @@ def mcbe_query(address, port, family = socket.AF_INET):
         return False, 'OSError'
 
     # Construct the `Unconnected_Ping` packet
-    # Packet ID - 0x01
-    req_data = bytearray([0x01])
-    # current unix timestamp in ms as signed long (64-bit) LE-encoded
-    req_data += struct.pack("<q", int(time.time() * 1000))
-    # RakNet MAGIC (0x00ffff00fefefefefdfdfdfd12345678)
-    req_data += RAKNET_MAGIC
-    # Client GUID - as signed long (64-bit) LE-encoded
-    req_data += struct.pack("<q", 0x02)
+    # current unix timestamp in ms, client GUID 0x02
+    req_data = build_unconnected_ping(int(time.time() * 1000), 0x02)
 
     sock.send(req_data)
 
@@ -279,33 +369,12 @@ def mcbe_query(address, port, family = socket.AF_INET):
     # string - Server ID string
     try:
         response_buffer, response_addr = sock.recvfrom(1024)
-        response_stream = io.BytesIO(response_buffer)
-
-        # Receive packet id
-        packet_id = response_stream.read(1)
-
-        # Response packet ID should always be 0x1c
-        if packet_id != b'\x1c':
-            debug(f"packet_id == {packet_id} != \\x1c")
-            return False, "packet_id != \\x1c"
-
-        # Receive (& ignore) response timestamp
-        response_timestamp = struct.unpack("<q", response_stream.read(8))
-
-        # Server GUID
-        response_server_guid = struct.unpack("<q", response_stream.read(8))
-
-        # Magic
-        response_magic = response_stream.read(16)
-        if response_magic != RAKNET_MAGIC:
-            debug(f"response_magic == {response_magic} != RAKNET_MAGIC")
-            return False, "response_magic != RAKNET_MAGIC"
-
-        # Server ID string length
-        response_id_string_length = struct.unpack(">h", response_stream.read(2))
-
-        # Receive server ID string
-        response_id_string = response_stream.read().decode("utf8")
+        try:
+            response_server_guid, response_id_string = parse_unconnected_pong(response_buffer)
+        except ValueError as e:
+            debug("%s", e)
+            return False, str(e)
+        response_id_string = response_id_string.decode("utf8")
 
     except socket.timeout:
         debug("connect timeout\n%s", traceback.format_exc())
@@ -320,17 +389,7 @@ def mcbe_query(address, port, family = socket.AF_INET):
         sock.close()
     
     try:
-        payload_dict = {e: f for e, f in zip(MOTD_INDEX, response_id_string.split(";"))}
-        out_dict = {}
-        out_dict["version"] = {
-            "name": payload_dict["version"] + " (" + payload_dict["edition"] + ")",
-            "protocol": int(payload_dict["protocol_version"])
-        }
-        try:
-            out_dict["description"] = [STRIP_MOTD.sub('', payload_dict["motd_1"]), STRIP_MOTD.sub('', payload_dict["motd_2"])]
-        except KeyError:  # older Bedrock server versions do not respond with the secondary MotD.
-            out_dict["description"] = [STRIP_MOTD.sub('', payload_dict["motd_1"])]
-        out_dict["players"] = {"max": int(payload_dict["max_players"]), "online": int(payload_dict["current_players"])}
+        out_dict = parse_server_id(response_id_string)
         debug("server(%s:%s) motd %s", address, port, out_dict)
     except Exception:
         debug(traceback.format_exc())
@@ -338,6 +397,24 @@ def mcbe_query(address, port, family = socket.AF_INET):
 
     return True, json.dumps(out_dict, ensure_ascii = False)
 
+def raknet_ping(address, port, timeout = 2):
+    # type: (str, int, float) -> tuple[bool, str]
+    """ Reachability check: one Unconnected Ping answered by any Unconnected Pong, the pong is not parsed. """
+    with new_udp_socket() as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect((address, port))
+            sock.send(build_unconnected_ping(int(time.time() * 1000), 0x02))
+            while sock.recv(MTU)[:1] != bytes((RAKNET_UNCONNECTED_PONG,)):
+                pass
+        except socket.timeout:
+            debug("recv timeout\n%s", traceback.format_exc())
+            return False, 'timeout'
+        except OSError:
+            debug("os error\n%s", traceback.format_exc())
+            return False, 'OSError'
+    return True, 'pong received.'
+
 def udp_query(address, port):
     # type: (str, int) -> tuple[bool, str]
     import sys
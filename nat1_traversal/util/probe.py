@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Health probing of the mapped address in shared-port mode
+
+__author__ = "Guation"
+
+import time
+
+PROBE_INTERVAL = 5 # 映射正常时轻量探测的间隔秒数
+PROBE_FULL_INTERVAL = 60 # 完整MOTD查询的间隔秒数
+PROBE_RETRY_INTERVAL = 1 # 探测失败后的重试间隔秒数
+PROBE_FAILURES = 2 # 连续失败该次数后认为映射已失效
+
+class probe_scheduler:
+    """
+    Decides when the next probe runs and whether it is the cheap
+    reachability check or the full MOTD query. While the mapping is healthy
+    a cheap probe runs every `interval` seconds and a full query replaces one
+    of them every `full_interval` seconds; after a failure cheap probes are
+    retried every `retry_interval` seconds, `failures` failures in a row mean
+    the mapping is lost.
+    """
+    def __init__(self, interval=PROBE_INTERVAL, full_interval=PROBE_FULL_INTERVAL, retry_interval=PROBE_RETRY_INTERVAL, failures=PROBE_FAILURES):
+        # type: (float, float, float, int) -> None
+        self.interval = interval
+        self.full_interval = full_interval
+        self.retry_interval = min(retry_interval, interval)
+        self.failures = failures
+        self.failed = 0
+        self.full_due = time.monotonic() + full_interval
+
+    def next(self):
+        # type: () -> tuple[float, bool]
+        """Seconds to wait before the next probe and whether it is a full query."""
+        if self.failed:
+            return self.retry_interval, False
+        due = time.monotonic() + self.interval
+        if due < self.full_due:
+            return self.interval, False
+        self.full_due = due + self.full_interval
+        return self.interval, True
+
+    def report(self, ok):
+        # type: (bool) -> bool
+        """Record the result of a probe, False once the mapping is considered lost."""
+        self.failed = 0 if ok else self.failed + 1
+        return self.failed < self.failures
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Entry points of the forwarder processes, spawn children import only this module and the forwarders
+
+__author__ = "Guation"
+
+import socket, multiprocessing.connection
+from logging import DEBUG, INFO, basicConfig, Formatter, StreamHandler
+from .stun import TYPE_TCP, TYPE_UDP
+from .tcp_port_forwarder import start_tcp_port_forward
+from .udp_port_forwarder import start_udp_port_forward
+from .service_forwarder import start_service_forward
+from .log_queue import start_log_queue, stop_log_queue
+
+_log_queue_options = None # type: dict | None
+
+def init_logger(debug: bool) -> None:
+    if debug:
+        level, format = DEBUG, '[%(levelname)8s] %(asctime)s <%(module)s.%(funcName)s>:%(lineno)d\n[%(levelname)8s] %(message)s'
+    else:
+        level, format = INFO, '[%(levelname)8s] %(message)s'
+    if _log_queue_options is None:
+        basicConfig(level=level, force=True, format=format)
+    else:
+        # 转发进程经由队列在后台线程写日志，避免stdout阻塞转发
+        handler = StreamHandler()
+        handler.setFormatter(Formatter(format))
+        basicConfig(level=level, force=True, handlers=[start_log_queue(handler, **_log_queue_options)])
+
+def forward_main(local_addr, remote_addr, mapped_addr, debug, _type, options, control=None):
+    # type: (socket._Address, socket._Address, socket._Address | None, bool, int, dict, multiprocessing.connection.Connection | None) -> None
+    global _log_queue_options
+    options = dict(options)
+    _log_queue_options = options.pop("log_options")
+    init_logger(debug)
+    try:
+        if _type is TYPE_TCP:
+            start_tcp_port_forward(local_addr, remote_addr, mapped_addr, control=control, **options)
+        elif _type is TYPE_UDP:
+            start_udp_port_forward(local_addr, remote_addr, mapped_addr, control=control, **options)
+    finally:
+        stop_log_queue()
+
+def services_main(services, debug, options, control=None):
+    # type: (list[tuple], bool, dict, multiprocessing.connection.Connection | None) -> None
+    """forward_main of the services mode, see start_service_forward."""
+    global _log_queue_options
+    options = dict(options)
+    _log_queue_options = options.pop("log_options")
+    init_logger(debug)
+    try:
+        start_service_forward(services, control, **options)
+    finally:
+        stop_log_queue()
+
+def standby_main(control):
+    # type: (multiprocessing.connection.Connection) -> None
+    """Idle until (target, args) arrives on control, then run target(*args, control=control)."""
+    try:
+        target, args = control.recv()
+    except (EOFError, KeyboardInterrupt):
+        return
+    target(*args, control=control)
@@ -3,7 +3,7 @@
 
 __author__ = "Zxi2233"
 
-import struct, socket
+import struct, socket, os
 
 # PROXY Protocol v2 Specification:
 # https://www.haproxy.org/download/2.9/doc/proxy-protocol.txt
@@ -57,3 +57,84 @@ def build_pp_v2_header(src_addr: tuple, dst_addr: tuple) -> bytes:
 
     header = PP2_SIGNATURE + struct.pack("!BBH", ver_cmd, fam_proto, addr_len) + addr_data
     return header
+
+
+# --- Precompiled header builder ---
+
+PP2_TYPE_AUTHORITY = 0x02
+PP2_TYPE_UNIQUE_ID = 0x05
+
+PP2_UNIQUE_ID_LENGTH = 16
+
+
+class pp_header_builder:
+    """
+    PROXY protocol header builder for one forwarder. The signature,
+    destination half and TLVs are encoded once, each connection only packs
+    the client address into a preallocated buffer.
+    Optional v2 TLVs: PP2_TYPE_AUTHORITY (fixed host name) and
+    PP2_TYPE_UNIQUE_ID (per-process random prefix + connection counter).
+    """
+
+    def __init__(self, version: str, dst_addr: tuple, authority: str = None, unique_id: bool = False):
+        self.version = version
+        self.dst_addr = dst_addr
+        dst_ip, dst_port = dst_addr[0], dst_addr[1]
+        try:
+            dst_packed = socket.inet_pton(socket.AF_INET, dst_ip)
+            self.family = socket.AF_INET
+        except (socket.error, OSError):
+            dst_packed = socket.inet_pton(socket.AF_INET6, dst_ip)
+            self.family = socket.AF_INET6
+
+        if version == "v1":
+            proto = "TCP4" if self.family == socket.AF_INET else "TCP6"
+            self.v1_format = "PROXY %s %%s %s %%d %d\r\n" % (proto, dst_ip, dst_port)
+            return
+
+        tlvs = b""
+        if authority:
+            value = authority.encode("utf-8")
+            tlvs += struct.pack("!BH", PP2_TYPE_AUTHORITY, len(value)) + value
+        self.unique_id_offset = None
+        if unique_id:
+            self.unique_id_prefix = int.from_bytes(os.urandom(8), "big")
+            self.unique_id_counter = 0
+            tlvs += struct.pack("!BH", PP2_TYPE_UNIQUE_ID, PP2_UNIQUE_ID_LENGTH) + bytes(PP2_UNIQUE_ID_LENGTH)
+
+        if self.family == socket.AF_INET:
+            self.addr_struct = struct.Struct("!4s")
+            fam_proto = PP2_AF_INET | PP2_PROTO_STREAM
+        else:
+            self.addr_struct = struct.Struct("!16s")
+            fam_proto = PP2_AF_INET6 | PP2_PROTO_STREAM
+        addr_len = self.addr_struct.size * 2 + 4
+        # signature | ver_cmd fam_proto len | src dst | sport dport | TLVs
+        self.src_offset = len(PP2_SIGNATURE) + 4
+        self.sport_offset = self.src_offset + addr_len - 4
+        self.buffer = bytearray(
+            PP2_SIGNATURE
+            + struct.pack("!BBH", PP2_VERSION | PP2_CMD_PROXY, fam_proto, addr_len + len(tlvs))
+            + bytes(self.addr_struct.size) + dst_packed
+            + struct.pack("!HH", 0, dst_port)
+            + tlvs
+        )
+        if unique_id:
+            self.unique_id_offset = len(self.buffer) - PP2_UNIQUE_ID_LENGTH
+
+    def build(self, src_addr: tuple) -> bytes:
+        src_ip, src_port = src_addr[0], src_addr[1]
+        if (":" in src_ip) != (self.family == socket.AF_INET6): # 地址族不一致，退回通用实现
+            if self.version == "v1":
+                return build_pp_v1_header(src_addr, self.dst_addr)
+            return build_pp_v2_header(src_addr, self.dst_addr)
+        if self.version == "v1":
+            return (self.v1_format % (src_ip, src_port)).encode("ascii")
+        buffer = self.buffer
+        self.addr_struct.pack_into(buffer, self.src_offset, socket.inet_pton(self.family, src_ip))
+        struct.pack_into("!H", buffer, self.sport_offset, src_port)
+        if self.unique_id_offset is not None:
+            self.unique_id_counter += 1
+            struct.pack_into("!QQ", buffer, self.unique_id_offset, self.unique_id_prefix, self.unique_id_counter)
+        # 返回副本，发送时buffer可能已被下一个连接复用
+        return bytes(buffer)
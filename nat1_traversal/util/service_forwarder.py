@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# Multi-service mode: every service forwarded by one process on one event loop
+
+__author__ = "Guation"
+
+import asyncio, socket
+from logging import debug, info, warning, error
+from .stun import TYPE_TCP, TYPE_UDP
+from .event_loop import run_event_loop, control_channel, watch_channels
+from .metrics import registry, start_metrics_server
+from . import tcp_port_forwarder, udp_port_forwarder
+
+async def forward_services(services, control=None):
+    # type: (list[tuple[int, socket._Address, socket._Address, socket._Address | None, dict]], Connection | None) -> None
+    """
+    services are (type, local, remote, call, options) with the options of
+    tcp_forwarder or udp_port_forward. The forwarder of a service that fails
+    to start takes the whole process down, like a single forwarder does.
+    """
+    channels = [control_channel(control, i) for i in range(len(services))] if control is not None else [None] * len(services)
+    udp_services = sum(1 for x in services if x[0] is TYPE_UDP)
+    tasks = []
+    for (_type, local, remote, call, options), channel in zip(services, channels):
+        if _type is TYPE_TCP:
+            main = tcp_port_forwarder.tcp_forwarder(local, remote, call, control=channel, **options).start()
+        else:
+            options = dict(options)
+            if options.get("max_sessions") is None: # 各UDP服务平分fd上限
+                options["max_sessions"] = udp_port_forwarder.default_max_sessions() // udp_services
+            main = udp_port_forwarder.udp_port_forward(local, remote, call, control=channel, **options)
+        tasks.append(asyncio.create_task(main))
+    if control is not None:
+        watch_channels(control, channels)
+    await asyncio.gather(*tasks)
+
+def start_service_forward(services, control=None, event_loop=None, metrics_port=None):
+    # type: (list[tuple[int, socket._Address, socket._Address, socket._Address | None, dict]], Connection | None, str | None, int | None) -> None
+    """
+    Run forward_services() on one event loop. control is the pipe to the
+    supervisor, messages in both directions are prefixed with the index of
+    the service; metrics add up over the services.
+    """
+    if metrics_port:
+        metrics = registry()
+        metrics.merge(tcp_port_forwarder.metrics)
+        metrics.merge(udp_port_forwarder.metrics)
+        start_metrics_server(metrics, metrics_port)
+    try:
+        run_event_loop(forward_services(services, control), event_loop)
+    except (KeyboardInterrupt, SystemExit):
+        return
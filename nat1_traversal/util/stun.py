@@ -7,15 +7,20 @@
 # https://cloud.tencent.com/developer/article/2419665
 # https://cloud.tencent.com/developer/article/2419666
 
-import os, socket, struct, traceback
+import os, queue, socket, struct, threading, time, traceback
 from logging import debug, info, warning, error
-from dns_resolve import resolve
+from .dns_resolve import resolve
 
 MTU             = 1500
 TCP_STUN_HOST   = "turn.cloud-rtc.com"
 TCP_STUN_PORT   = 80
 UDP_STUN_HOST   = "stun.douyucdn.cn"
 UDP_STUN_PORT   = 18000
+STUN_PORT       = 3478
+TCP_STUN_SERVERS = [(TCP_STUN_HOST, TCP_STUN_PORT), ("turn.cloudflare.com", STUN_PORT)]
+UDP_STUN_SERVERS = [(UDP_STUN_HOST, UDP_STUN_PORT), ("stun.miwifi.com", STUN_PORT), ("stun.chat.bilibili.com", STUN_PORT)]
+STUN_TIMEOUT    = 3
+STUN_STAGGER    = 0.25 # 上一个stun服务器未响应时启动下一个的间隔
 MAGIC_COOKIE    = 0x2112A442
 BIND_REQUEST    = 0x0001
 BIND_RESPONSE   = 0x0101
@@ -31,6 +36,10 @@ ATTRIB_OTHER_ADDRESS       = 0x802C
 TYPE_TCP = 1
 TYPE_UDP = 2
 
+MAPPING_TIMEOUT_MAX = 600 # 映射超时探测的最长空闲秒数
+MAPPING_TIMEOUT_PROBES = 8 # 细化阶段每轮并行探测的空闲时长数
+MAPPING_TIMEOUT_PRECISION = 0.1
+
 IS_WINDOWS = os.name == "nt"
 
 def _random_tran_id():
@@ -98,6 +107,11 @@ def _extract_other_addr(payload):
 
 def resolve_stun_address(host, port):
     # type: (str, int) -> list[socket._Address]
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return [(host, port)]
+    except OSError:
+        pass
     return [(x["data"], port) for x in resolve(host, "A")]
 
 if hasattr(socket, "SO_REUSEPORT_LB"):
@@ -126,10 +140,29 @@ def new_udp_socket(*, reuseport = False, family = socket.AF_INET):
         socket_set_reuseport(sock)
     return sock
 
-def tcp_single_test(stun, source, timeout = 3):
-    # type: (socket._Address, socket._Address, int) -> tuple[socket._RetAddress, socket._RetAddress, socket._RetAddress, socket._RetAddress]
+def _tcp_bind_request(sock):
+    # type: (socket.socket) -> tuple[socket._RetAddress, socket._RetAddress]
+    """Binding Request on a connected TCP socket, returns mapped_addr and other_addr."""
     # rfc5389 and rfc8489 only
     tran_id = _random_tran_id()
+    data = _pack_stun_message(BIND_REQUEST, tran_id)
+    sock.sendall(data)
+    try:
+        buf = sock.recv(MTU)
+    except socket.timeout as e:
+        raise ValueError(
+            "未从stun服务器收到有效信息，请尝试关闭透明代理后重试。"
+        ) from e
+    msg_type, msg_id, payload = _unpack_stun_message(buf)
+    if tran_id == msg_id and msg_type == BIND_RESPONSE:
+        return _extract_mapped_addr(payload), _extract_other_addr(payload)
+    else:
+        raise ValueError(
+            "stun服务器响应异常 %s" % buf
+        )
+
+def tcp_single_test(stun, source, timeout = 3):
+    # type: (socket._Address, socket._Address, int) -> tuple[socket._RetAddress, socket._RetAddress, socket._RetAddress, socket._RetAddress]
     with new_tcp_socket(reuseport=True) as sock:
         sock.settimeout(timeout)
         if IS_WINDOWS:
@@ -146,26 +179,11 @@ def tcp_single_test(stun, source, timeout = 3):
             raise ValueError(
                 "无法连接到stun服务器"
             ) from e
-        data = _pack_stun_message(BIND_REQUEST, tran_id)
-        sock.sendall(data)
-        try:
-            buf = sock.recv(MTU)
-        except TimeoutError as e:
-            raise ValueError(
-                "未从stun服务器收到有效信息，请尝试关闭透明代理后重试。"
-            ) from e
-        msg_type, msg_id, payload = _unpack_stun_message(buf)
-        if tran_id == msg_id and msg_type == BIND_RESPONSE:
-            source_addr = sock.getsockname()
-            distination_addr = sock.getpeername()
-            mapped_addr = _extract_mapped_addr(payload)
-            other_addr = _extract_other_addr(payload)
-            debug("stun source_addr=%s, distination_addr=%s, mapped_addr=%s, other_addr=%s", source_addr, distination_addr, mapped_addr, other_addr)
-            return (source_addr, distination_addr, mapped_addr, other_addr)
-        else:
-            raise ValueError(
-                "stun服务器响应异常 %s" % buf
-            )
+        mapped_addr, other_addr = _tcp_bind_request(sock)
+        source_addr = sock.getsockname()
+        distination_addr = sock.getpeername()
+        debug("stun source_addr=%s, distination_addr=%s, mapped_addr=%s, other_addr=%s", source_addr, distination_addr, mapped_addr, other_addr)
+        return (source_addr, distination_addr, mapped_addr, other_addr)
 
 def udp_single_test(stun, source, change_ip = False, change_port = False, timeout = 3, repeat = 3):
     # type: (socket._Address, socket._Address, bool, bool, int, int) -> tuple[socket._RetAddress, socket._RetAddress, socket._RetAddress, socket._RetAddress]
@@ -195,8 +213,13 @@ def udp_single_test(stun, source, change_ip = False, change_port = False, timeou
             data = _pack_stun_message(BIND_REQUEST, tran_id, payload)
         else:
             data = _pack_stun_message(BIND_REQUEST, tran_id)
+            # 已连接的socket优先于同端口SO_REUSEPORT的转发socket收到响应
+            sock.connect(distination_addr)
         for _ in range(repeat):
-            sock.sendto(data, distination_addr)
+            if flags:
+                sock.sendto(data, distination_addr)
+            else:
+                sock.send(data)
         for _ in range(repeat * 2):
             try:
                 buf, addr = sock.recvfrom(MTU)
@@ -224,12 +247,91 @@ def udp_single_test(stun, source, change_ip = False, change_port = False, timeou
                 "stun服务器响应异常 %s" % buf
             )
 
+class stun_scoreboard:
+    """
+    Latency (moving average) and consecutive failures of the STUN servers
+    used by this process. Servers are tried fastest first and a server that
+    failed last time goes behind every one that did not; servers never
+    used yet keep their configured order behind the ones that answered.
+    """
+    def __init__(self):
+        self.latency = {} # type: dict[socket._Address, float]
+        self.failures = {} # type: dict[socket._Address, int]
+        self.lock = threading.Lock()
+
+    def success(self, server, latency):
+        # type: (socket._Address, float) -> None
+        with self.lock:
+            old = self.latency.get(server)
+            self.latency[server] = latency if old is None else old * 0.7 + latency * 0.3
+            self.failures[server] = 0
+
+    def failure(self, server):
+        # type: (socket._Address) -> None
+        with self.lock:
+            self.failures[server] = self.failures.get(server, 0) + 1
+
+    def order(self, servers):
+        # type: (list[socket._Address]) -> list[socket._Address]
+        with self.lock:
+            return sorted(servers, key=lambda x: (self.failures.get(x, 0), self.latency.get(x, float("inf"))))
+
+scoreboard = stun_scoreboard()
+_stun_servers = {TYPE_TCP: TCP_STUN_SERVERS, TYPE_UDP: UDP_STUN_SERVERS} # type: dict[int, list[socket._Address]]
+
+def set_stun_servers(tcp, udp):
+    # type: (list[socket._Address], list[socket._Address]) -> None
+    _stun_servers[TYPE_TCP] = tcp
+    _stun_servers[TYPE_UDP] = udp
+
+def _stun_attempt(server, local, _type, results):
+    # type: (socket._Address, socket._Address, int, queue.Queue) -> None
+    start = time.perf_counter()
+    try:
+        if _type is TYPE_TCP:
+            mapped_addr = tcp_single_test(server, local, STUN_TIMEOUT)[2]
+        else:
+            mapped_addr = udp_single_test(server, local, timeout=STUN_TIMEOUT)[2]
+        if mapped_addr is None:
+            raise ValueError("响应中没有XOR-MAPPED-ADDRESS")
+    except (ValueError, OSError) as e:
+        scoreboard.failure(server)
+        debug("stun %s:%s 失败\n%s", server[0], server[1], traceback.format_exc())
+        results.put((server, None, e))
+        return
+    latency = time.perf_counter() - start
+    scoreboard.success(server, latency)
+    debug("stun %s:%s 响应耗时 %d ms", server[0], server[1], latency * 1000)
+    results.put((server, mapped_addr, None))
+
 def get_self_ip_port(local, _type):
     # type: (socket._Address, int) -> socket._RetAddress
-    if _type is TYPE_TCP:
-        return tcp_single_test((TCP_STUN_HOST, TCP_STUN_PORT), local)[2]
-    else:
-        return udp_single_test((UDP_STUN_HOST, UDP_STUN_PORT), local)[2]
+    """
+    Race the configured STUN servers in the order of the scoreboard: the
+    next one starts when the previous failed or has not answered within
+    STUN_STAGGER, the first mapped address wins and slower answers only
+    update the scoreboard. Windows cannot bind the port twice, so servers
+    are tried one after another there.
+    """
+    servers = scoreboard.order(_stun_servers[_type])
+    results = queue.Queue() # type: queue.Queue[tuple[socket._Address, socket._RetAddress | None, Exception | None]]
+    pending = 0
+    errors = []
+    while servers or pending:
+        if servers:
+            threading.Thread(target=_stun_attempt, args=(servers.pop(0), local, _type, results), daemon=True).start()
+            pending += 1
+        try:
+            server, mapped_addr, e = results.get(timeout=STUN_STAGGER if servers and not IS_WINDOWS else None)
+        except queue.Empty:
+            continue
+        pending -= 1
+        if mapped_addr is not None:
+            return mapped_addr
+        errors.append("%s:%s %s" % (server[0], server[1], e))
+    raise ValueError(
+        "所有stun服务器均不可用：%s" % "; ".join(errors)
+    )
 
 def addr_available(local, _type):
     # type: (socket._Address, int) -> socket._RetAddress
@@ -388,3 +490,137 @@ def nat_type_test(local, _type):
         return tcp_nat_type_test(local)
     else:
         return udp_nat_type_test(local)
+
+
+def _idle_mapping_test(test, first, second, ip, idle, state):
+    # type: (Callable, socket._Address, socket._Address, str, float, dict) -> None
+    """One UDP trial of mapping_timeout_test(): a fresh port stays idle for `idle` seconds between two STUN requests."""
+    try:
+        source_addr, _, mapped_addr, _ = test(first, (ip, 0))
+    except (ValueError, OSError):
+        debug(traceback.format_exc())
+        return
+    with state["lock"]:
+        state["started"] = True
+        if state["lock"].wait_for(lambda: state["hi"] <= idle, timeout=idle): # 更短的空闲时长已失效
+            return
+    try:
+        mapped_addr2 = test(second, source_addr)[2]
+    except (ValueError, OSError):
+        debug(traceback.format_exc())
+        mapped_addr2 = None
+    with state["lock"]:
+        if mapped_addr2 == mapped_addr:
+            state["alive"].append(idle)
+        else:
+            state["hi"] = min(state["hi"], idle)
+            state["lock"].notify_all()
+    debug("idle=%s mapped_addr=%s mapped_addr2=%s", idle, mapped_addr, mapped_addr2)
+
+def _idle_connection_test(stun, ip, idle, state):
+    # type: (socket._Address, str, float, dict) -> None
+    """
+    One TCP trial of mapping_timeout_test(): an established STUN connection
+    stays idle for `idle` seconds between two Binding Requests, like a
+    forwarded connection between two keepalives. A connection the server
+    closed meanwhile says nothing about the NAT and is only recorded in
+    state["closed"].
+    """
+    try:
+        with new_tcp_socket() as sock:
+            sock.settimeout(3)
+            sock.bind((ip, 0))
+            sock.connect(stun)
+            mapped_addr = _tcp_bind_request(sock)[0]
+            with state["lock"]:
+                state["started"] = True
+                if state["lock"].wait_for(lambda: state["hi"] <= idle, timeout=idle): # 更短的空闲时长已失效
+                    return
+            try:
+                sock.setblocking(False)
+                closed = sock.recv(1, socket.MSG_PEEK) == b"" # 服务端主动关闭的空闲连接
+            except BlockingIOError:
+                closed = False
+            except OSError: # NAT丢弃映射后对端的报文会被RST
+                debug(traceback.format_exc())
+                closed = None
+            if closed:
+                with state["lock"]:
+                    state["closed"] = min(state["closed"], idle)
+                debug("idle=%s stun服务器已关闭连接", idle)
+                return
+            mapped_addr2 = None
+            if closed is not None:
+                sock.settimeout(3)
+                try:
+                    mapped_addr2 = _tcp_bind_request(sock)[0]
+                except (ValueError, OSError):
+                    debug(traceback.format_exc())
+    except (ValueError, OSError):
+        debug(traceback.format_exc())
+        return
+    with state["lock"]:
+        if mapped_addr2 == mapped_addr:
+            state["alive"].append(idle)
+        else:
+            state["hi"] = min(state["hi"], idle)
+            state["lock"].notify_all()
+    debug("idle=%s mapped_addr=%s mapped_addr2=%s", idle, mapped_addr, mapped_addr2)
+
+def mapping_timeout_test(local, _type, maximum = MAPPING_TIMEOUT_MAX):
+    # type: (socket._Address | None, int, float) -> tuple[float, bool]
+    """
+    How long the NAT keeps the mapping of an idle port. Every UDP trial
+    binds a fresh port, gets its mapping, stays idle and asks again from the
+    same port; the mapping survived when both answers agree. TCP trials keep
+    the STUN connection open and ask again on it after the idle time, which
+    measures the established-connection timeout the keepalive has to beat;
+    idle connections closed by the server only bound the result from below.
+    Trials of a round run in parallel and a failure cancels the longer ones:
+    the first round doubles the idle time up to maximum, later rounds split
+    the interval between the longest survived and the shortest failed idle
+    time until it is within 10%. Returns the longest survived idle time and
+    whether any trial failed. The configured STUN servers are tried in the
+    order of the scoreboard, ValueError is raised when none of them answers.
+    """
+    ip = "0.0.0.0" if local is None else local[0]
+    errors = []
+    for server in scoreboard.order(_stun_servers[_type]):
+        stun_address = resolve_stun_address(*server) or [server] # DoH解析失败时交给系统解析
+        try:
+            return _mapping_timeout_rounds(stun_address, ip, _type, maximum)
+        except ValueError as e:
+            debug(traceback.format_exc())
+            errors.append("%s:%s %s" % (server[0], server[1], e))
+    raise ValueError(
+        "所有stun服务器均不可用：%s" % "; ".join(errors)
+    )
+
+def _mapping_timeout_rounds(stun_address, ip, _type, maximum):
+    # type: (list[socket._Address], str, int, float) -> tuple[float, bool]
+    """mapping_timeout_test() against one STUN server."""
+    name = "TCP" if _type is TYPE_TCP else "UDP"
+    state = {"lock": threading.Condition(), "alive": [], "hi": float("inf"), "closed": float("inf"), "started": False}
+    candidates = [2.0 ** x for x in range(1, 32) if 2 ** x < maximum] + [float(maximum)]
+    while candidates:
+        info("%s: 测试空闲 %s 秒后映射是否有效", name, ", ".join("%g" % x for x in candidates))
+        if _type is TYPE_TCP:
+            threads = [threading.Thread(target=_idle_connection_test, args=(stun_address[0], ip, x, state), daemon=True) for x in candidates]
+        else:
+            threads = [threading.Thread(target=_idle_mapping_test, args=(udp_single_test, stun_address[0], stun_address[-1], ip, x, state), daemon=True) for x in candidates]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        if not state["started"]:
+            raise ValueError("未从stun服务器收到有效信息")
+        hi = state["hi"]
+        lo = max([x for x in state["alive"] if x < hi], default=0.0) # 结果不单调时以更短的失效时长为准
+        info("%s: 映射在空闲 %g 秒后仍有效%s", name, lo, "，%g 秒后失效" % hi if hi != float("inf") else "")
+        if hi == float("inf") or hi - lo <= max(1, lo * MAPPING_TIMEOUT_PRECISION):
+            break
+        step = (hi - lo) / (MAPPING_TIMEOUT_PROBES + 1)
+        candidates = [round(lo + step * x, 1) for x in range(1, MAPPING_TIMEOUT_PROBES + 1)]
+    if state["closed"] < hi:
+        warning("%s: stun服务器在连接空闲 %g 秒后将其关闭，映射超时至少为 %g 秒", name, state["closed"], lo)
+    return lo, hi != float("inf")
@@ -3,136 +3,781 @@
 
 __author__ = "Guation"
 
-import asyncio, traceback, os, sys, socket
+import asyncio, traceback, os, sys, socket, time, collections, errno
 from logging import debug, info, warning, error, exception
 from .stun import new_tcp_socket
+from .event_loop import run_event_loop, watch_control, ping_nonce, PING
+from .metrics import registry, start_metrics_server
+from .proxy_protocol import pp_header_builder
+from .motd import pack_packet, parse_handshake, read_packet
+from .log_queue import stop_log_queue, suppressed_lines
+from typing import Any, Awaitable, Callable
 
-_proxy_protocol_version = None
+SPLICE_SIZE = 65536
+RELAY_BUFFER_SIZE = 65536
+POOL_IDLE_TIMEOUT = 30
+LIMIT_REPORT_INTERVAL = 60
+LIMIT_PRUNE_INTERVAL = 10 # 清理令牌已回满的IP的最短间隔秒数
+LIMIT_MAX_BUCKETS = 65536 # 令牌桶上限，超出时丢弃最久未连接的IP
+STATUS_TIMEOUT = 5
+STATUS_MAX_HANDSHAKE = 1024
+STATUS_CACHE_SIZE = 256
+PING_INTERVAL = 1
+PONG_TIMEOUT = 15 # pong线程等待ping的最短超时，不小于3倍ping间隔
+PING_TOKEN_TIMEOUT = 3 # 等待pong时新连接发来ping的超时，超时后按普通客户端转发
+ACCEPT_RETRY_DELAY = 1 # 文件描述符或内存耗尽时暂停accept的秒数，与asyncio一致
+ACCEPT_RESOURCE_ERRNOS = tuple(getattr(errno, x) for x in ("EMFILE", "ENFILE", "ENOBUFS", "ENOMEM", "WSAEMFILE", "WSAENOBUFS") if hasattr(errno, x))
+# 客户端在accept前已断开，或Linux把新连接上的网络错误交给accept返回，跳过这个连接即可
+ACCEPT_TRANSIENT_ERRNOS = tuple(getattr(errno, x) for x in ("ECONNABORTED", "ECONNRESET", "EINTR", "EAGAIN", "EWOULDBLOCK", "EPROTO", "ENETDOWN", "ENOPROTOOPT",
+                                                           "EHOSTDOWN", "ENONET", "EHOSTUNREACH", "EOPNOTSUPP", "ENETUNREACH", "EPERM", "ETIMEDOUT") if hasattr(errno, x))
 
-def set_proxy_protocol_version(version):
-    """Set the proxy protocol version for this forwarder process."""
-    global _proxy_protocol_version
-    _proxy_protocol_version = version
+_backend_pools = [] # type: list[backend_pool]
+
+metrics = registry()
+metrics_accepted = metrics.counter("nat1_tcp_accepted_total", "Accepted client connections")
+metrics_active = metrics.gauge("nat1_tcp_active_connections", "Client connections being relayed")
+metrics_bytes_up = metrics.counter("nat1_tcp_bytes_total", "Relayed bytes", {"direction": "client_to_backend"})
+metrics_bytes_down = metrics.counter("nat1_tcp_bytes_total", "Relayed bytes", {"direction": "backend_to_client"})
+metrics_connect_latency = metrics.histogram("nat1_tcp_backend_connect_seconds", "Backend connect latency")
+metrics.counter_func("nat1_log_suppressed_total", "Log lines dropped by rate limiting or a full log queue", suppressed_lines)
+metrics_errors = metrics.counter("nat1_tcp_relay_errors_total", "Backend connect and relay errors")
+metrics_ping_rtt = metrics.histogram("nat1_ping_rtt_seconds", "Ping/pong round-trip time through the mapped address")
+metrics.counter_func("nat1_tcp_backend_pool_hits_total", "Clients paired with a pooled backend connection", lambda: sum(x.hits for x in _backend_pools))
+metrics.counter_func("nat1_tcp_backend_pool_misses_total", "Clients that had to connect to the backend", lambda: sum(x.misses for x in _backend_pools))
+metrics.gauge_func("nat1_tcp_backend_pool_idle", "Idle pooled backend connections", lambda: sum(len(x.idle) for x in _backend_pools))
+metrics_rejected = {
+    reason: metrics.counter("nat1_tcp_rejected_total", "Connections rejected by the limiter", {"reason": reason})
+    for reason in ("max_connections", "per_ip_connections", "per_ip_rate")
+}
+metrics_status = {
+    result: metrics.counter("nat1_tcp_status_requests_total", "Java Edition status requests answered by the forwarder", {"result": result})
+    for result in ("hit", "miss")
+}
+
+class connection_limiter:
+    """
+    Global connection ceiling, per-IP concurrent connections and per-IP
+    token-bucket accept rate; 0 disables a limit. Rejections are counted
+    in metrics and only summarised in the log.
+    """
+    def __init__(self, max_connections, per_ip_connections, per_ip_rate, per_ip_burst):
+        # type: (int, int, float, int) -> None
+        self.max_connections = max_connections
+        self.per_ip_connections = per_ip_connections
+        self.per_ip_rate = per_ip_rate
+        self.per_ip_burst = max(per_ip_burst, 1)
+        self.total = 0
+        self.active = {} # type: dict[str, int]
+        self.buckets = {} # type: dict[str, list[float]]
+        self.rejected = 0
+        self.report_time = time.perf_counter() + LIMIT_REPORT_INTERVAL
+        self.refill_time = self.per_ip_burst / per_ip_rate if per_ip_rate else 0
+        self.prune_time = time.perf_counter() + max(self.refill_time, LIMIT_PRUNE_INTERVAL)
+
+    def acquire(self, ip):
+        # type: (str) -> str | None
+        """Return None if admitted, otherwise the reason of rejection."""
+        if self.max_connections and self.total >= self.max_connections:
+            return self._reject("max_connections")
+        if self.per_ip_connections and self.active.get(ip, 0) >= self.per_ip_connections:
+            return self._reject("per_ip_connections")
+        if self.per_ip_rate:
+            now_time = time.perf_counter()
+            if self.prune_time <= now_time:
+                self._prune(now_time)
+            bucket = self.buckets.pop(ip, None) # 重新插入，使字典保持最久未连接的IP在前
+            if bucket is None:
+                if len(self.buckets) >= LIMIT_MAX_BUCKETS:
+                    del self.buckets[next(iter(self.buckets))]
+                bucket = [self.per_ip_burst, now_time]
+            else:
+                bucket[0] = min(self.per_ip_burst, bucket[0] + (now_time - bucket[1]) * self.per_ip_rate)
+                bucket[1] = now_time
+            self.buckets[ip] = bucket
+            if bucket[0] < 1:
+                return self._reject("per_ip_rate")
+            bucket[0] -= 1
+        self.total += 1
+        self.active[ip] = self.active.get(ip, 0) + 1
+        return None
+
+    def release(self, ip):
+        # type: (str) -> None
+        self.total -= 1
+        count = self.active[ip] - 1
+        if count:
+            self.active[ip] = count
+        else:
+            del self.active[ip]
+
+    def _reject(self, reason):
+        # type: (str) -> str
+        metrics_rejected[reason].value += 1
+        self.rejected += 1
+        now_time = time.perf_counter()
+        if self.report_time <= now_time:
+            warning(f"过去{LIMIT_REPORT_INTERVAL}秒内拒绝了 {self.rejected} 个连接，最近一次原因为 {reason}")
+            self.rejected = 0
+            self.report_time = now_time + LIMIT_REPORT_INTERVAL
+        return reason
+
+    def _prune(self, now_time):
+        # type: (float) -> None
+        # 令牌已回满的IP与新IP等价，删除以限制内存；按最久未连接排序，遇到未回满的即可停止
+        for ip, bucket in list(self.buckets.items()):
+            if now_time - bucket[1] < self.refill_time:
+                break
+            del self.buckets[ip]
+        self.prune_time = now_time + max(self.refill_time, LIMIT_PRUNE_INTERVAL)
+
+class status_cache:
+    """
+    Java Edition status responses keyed by the server address and protocol
+    version of the handshake, reused for `ttl` seconds. Concurrent misses
+    of one key share a single backend query.
+    """
+    def __init__(self, ttl):
+        # type: (float) -> None
+        self.ttl = ttl
+        self.entries = {} # type: dict[tuple[str, int], tuple[bytes, float]]
+        self.pending = {} # type: dict[tuple[str, int], asyncio.Future]
+
+    async def get(self, key, fetch):
+        # type: (tuple[str, int], Callable[[], Awaitable[bytes | None]]) -> bytes | None
+        now_time = time.perf_counter()
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > now_time:
+            metrics_status["hit"].value += 1
+            return entry[0]
+        future = self.pending.get(key)
+        if future is not None:
+            metrics_status["hit"].value += 1
+            return await asyncio.shield(future)
+        metrics_status["miss"].value += 1
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        response = None
+        try:
+            response = await fetch()
+        finally:
+            del self.pending[key]
+            future.set_result(response)
+        if response is not None:
+            if len(self.entries) >= STATUS_CACHE_SIZE:
+                self.entries = {k: v for k, v in self.entries.items() if v[1] > now_time}
+                if len(self.entries) >= STATUS_CACHE_SIZE:
+                    self.entries.clear()
+            self.entries[key] = (response, time.perf_counter() + self.ttl)
+        return response
+
+def splice_available():
+    # type: () -> bool
+    if not hasattr(os, "splice"): # Linux + Python 3.10+
+        return False
+    try:
+        sock1, sock2 = socket.socketpair()
+        pipe_r, pipe_w = os.pipe()
+        try:
+            sock1.send(b"\0")
+            return os.splice(sock2.fileno(), pipe_w, 1, flags=os.SPLICE_F_NONBLOCK) == 1
+        finally:
+            sock1.close()
+            sock2.close()
+            os.close(pipe_r)
+            os.close(pipe_w)
+    except OSError:
+        debug(traceback.format_exc())
+        return False
 
 def stop():
+    stop_log_queue() # os._exit不会等待日志线程，先写出队列中的日志
     sys.stderr.flush()
     sys.stdout.flush()
     os._exit(0)
 
-async def forward(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+class relay_protocol(asyncio.BufferedProtocol):
+    """
+    One direction of a relayed connection: data is received into a buffer
+    preallocated per connection and written to the peer transport as-is.
+    Backpressure pauses the peer's reading instead of awaiting drain().
+    """
+    def __init__(self, bytes_counter):
+        # type: (counter) -> None
+        self.bytes_counter = bytes_counter
+        self.buffer = memoryview(bytearray(RELAY_BUFFER_SIZE))
+        self.transport = None # type: asyncio.Transport | None
+        self.peer = None # type: relay_protocol | None
+        self.pending = b""
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # 任何积压都暂停对端读取，积压清空后才恢复，保证buffer不会在transport引用期间被覆盖
+        transport.set_write_buffer_limits(0)
+        if self.peer.transport is not None:
+            self.peer.transport.resume_reading()
+        if self.pending:
+            transport.write(self.pending)
+            self.pending = b""
+        if self.peer.lost.done():
+            transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        self.bytes_counter.value += nbytes
+        if self.peer.transport is None: # 对端尚未就绪，暂存数据
+            self.peer.pending += bytes(self.buffer[:nbytes])
+            self.transport.pause_reading()
+            return
+        self.peer.transport.write(self.buffer[:nbytes])
+
+    def eof_received(self):
+        if self.peer.transport is not None:
+            self.peer.transport.close()
+        return False
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            metrics_errors.value += 1
+            error(f"转发错误")
+            debug("".join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
+        if self.peer.transport is not None:
+            self.peer.transport.close()
+        if not self.lost.done(): # 等待的任务被取消时future已一并取消
+            self.lost.set_result(None)
+
+async def protocol_relay(local_sock: socket.socket, remote_sock: socket.socket):
+    loop = asyncio.get_running_loop()
+    local = relay_protocol(metrics_bytes_up)
+    remote = relay_protocol(metrics_bytes_down)
+    local.peer = remote
+    remote.peer = local
     try:
-        while True:
-            data = await reader.read(4096)
-            if not data:
-                break
-            writer.write(data)
-            await writer.drain()
-    except asyncio.CancelledError:
-        pass
+        await loop.connect_accepted_socket(lambda: local, local_sock)
+        await loop.connect_accepted_socket(lambda: remote, remote_sock)
     except Exception:
+        metrics_errors.value += 1
         error(f"转发错误")
         debug(traceback.format_exc())
-    finally:
-        writer.close()
+        if local.transport is not None:
+            local.transport.close()
+        local_sock.close()
+        remote_sock.close()
+        return
+    await asyncio.gather(local.lost, remote.lost)
 
-async def handle_client(local_reader: asyncio.StreamReader, local_writer: asyncio.StreamWriter, remote_host: str, remote_port: int):
-    client_address = local_writer.get_extra_info('peername')
+async def _wait_fd(add, remove, sock: socket.socket):
+    fut = asyncio.get_running_loop().create_future()
+    add(sock.fileno(), lambda: fut.done() or fut.set_result(None))
     try:
-        info(f"新客户端 {client_address[0]}:{client_address[1]} 尝试连接到 {remote_host}:{remote_port}")
-        remote_reader, remote_writer = await asyncio.open_connection(remote_host, remote_port)
-        local_address = remote_writer.get_extra_info('sockname')
-        info(f"客户端 {client_address[0]}:{client_address[1]} 已连接，绑定到本地地址 {local_address[0]}:{local_address[1]}")
-
-        if _proxy_protocol_version:
-            pp_header = _build_proxy_protocol_header(client_address, (remote_host, remote_port))
-            if pp_header:
-                remote_writer.write(pp_header)
-                await remote_writer.drain()
-                info(f"已发送 PROXY Protocol {_proxy_protocol_version} 头，客户端真实地址 {client_address[0]}:{client_address[1]}")
-
-        local_to_remote = asyncio.create_task(forward(local_reader, remote_writer))
-        remote_to_local = asyncio.create_task(forward(remote_reader, local_writer))
-
-        await asyncio.gather(local_to_remote, remote_to_local)
-        info(f"客户端 {client_address[0]}:{client_address[1]} 断开连接")
-    except Exception:
-        error(f"转发错误，客户端 {client_address[0]}:{client_address[1]} 无法连接到 {remote_host}:{remote_port}")
-        debug(traceback.format_exc())
+        await fut
     finally:
-        local_writer.close()
+        remove(sock.fileno())
 
-def _build_proxy_protocol_header(src_addr, dst_addr):
-    """Build proxy protocol header based on configured version."""
-    try:
-        if _proxy_protocol_version == "v1":
-            from .proxy_protocol import build_pp_v1_header
-            return build_pp_v1_header(src_addr, dst_addr)
-        elif _proxy_protocol_version == "v2":
-            from .proxy_protocol import build_pp_v2_header
-            return build_pp_v2_header(src_addr, dst_addr)
-    except Exception:
-        error("构建 PROXY Protocol 头失败")
-        debug(traceback.format_exc())
-    return None
-
-async def handle_client_pong(local_reader: asyncio.StreamReader, local_writer: asyncio.StreamWriter, remote_host: str, remote_port: int):
-    global g_handle_client
-    g_handle_client = handle_client
-    info("开始pong线程")
+async def splice_forward(src: socket.socket, dst: socket.socket, bytes_counter):
+    # type: (socket.socket, socket.socket, counter) -> None
+    # socket -> pipe -> socket，数据不经过用户态
+    loop = asyncio.get_running_loop()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    pipe_r, pipe_w = os.pipe()
+    pending = 0
     try:
         while True:
-            data = await asyncio.wait_for(local_reader.read(4096), timeout=15)
-            if not data:
-                break
-            local_writer.write(b"pong")
-            await local_writer.drain()
+            if not pending:
+                try:
+                    pending = os.splice(src.fileno(), pipe_w, SPLICE_SIZE, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop.add_reader, loop.remove_reader, src)
+                    continue
+                if not pending:
+                    break
+                bytes_counter.value += pending
+            try:
+                pending -= os.splice(pipe_r, dst.fileno(), pending, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop.add_writer, loop.remove_writer, dst)
     except asyncio.CancelledError:
         pass
     except Exception:
-        error(f"pong线程异常，可能是ping线程已离线")
+        metrics_errors.value += 1
+        error(f"转发错误")
         debug(traceback.format_exc())
-        stop()
     finally:
-        local_writer.close()
+        os.close(pipe_r)
+        os.close(pipe_w)
 
-async def client_ping(internet_ip: str, internet_port: int):
-    info("开始ping线程")
+async def splice_relay(local_sock: socket.socket, remote_sock: socket.socket):
+    tasks = [
+        asyncio.create_task(splice_forward(local_sock, remote_sock, metrics_bytes_up)),
+        asyncio.create_task(splice_forward(remote_sock, local_sock, metrics_bytes_down))
+    ]
     try:
-        reader, writer = await asyncio.wait_for(asyncio.open_connection(internet_ip, internet_port), timeout=3)
+        # 与protocol_relay一致，任一方向结束即关闭整个连接
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        local_sock.close()
+        remote_sock.close()
+
+def relay_mode(splice):
+    # type: (bool) -> Callable[[socket.socket, socket.socket], Awaitable[None]]
+    """Select the relay engine."""
+    if splice:
+        if splice_available():
+            return splice_relay
+        warning("当前系统不支持splice，回退到asyncio转发")
+    return protocol_relay
+
+def _socket_alive(sock: socket.socket) -> bool:
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError: # 无数据且未关闭
+        return True
+    except OSError:
+        return False
+
+class backend_pool:
+    """
+    Idle backend connections opened ahead of time, so a new client can be
+    paired with one immediately. Connections idle for longer than
+    POOL_IDLE_TIMEOUT or closed by the backend are discarded.
+    """
+    def __init__(self, remote, size, rate):
+        # type: (socket._Address, int, float) -> None
+        self.remote = remote
+        self.size = size
+        self.interval = 1 / rate
+        self.idle = collections.deque() # type: collections.deque[tuple[socket.socket, float]]
+        self.hits = 0
+        self.misses = 0
+        self.wakeup = asyncio.Event()
+
+    def get(self):
+        # type: () -> socket.socket | None
+        self.wakeup.set()
+        expire_time = time.perf_counter() - POOL_IDLE_TIMEOUT
+        while self.idle:
+            sock, create_time = self.idle.popleft()
+            if create_time >= expire_time and _socket_alive(sock):
+                self.hits += 1
+                return sock
+            sock.close()
+        self.misses += 1
+        return None
+
+    def expire(self):
+        expire_time = time.perf_counter() - POOL_IDLE_TIMEOUT
+        while self.idle and self.idle[0][1] < expire_time:
+            self.idle.popleft()[0].close()
+
+    async def refill(self):
+        loop = asyncio.get_running_loop()
+        report_time = time.perf_counter() + 60
+        while True:
+            self.expire()
+            now_time = time.perf_counter()
+            if report_time <= now_time:
+                report_time = now_time + 60
+                debug(f"连接池 命中 {self.hits} 未命中 {self.misses} 空闲 {len(self.idle)}")
+            if len(self.idle) >= self.size:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=POOL_IDLE_TIMEOUT / 2)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            sock = new_tcp_socket()
+            sock.setblocking(False)
+            try:
+                connect_time = time.perf_counter()
+                await asyncio.wait_for(loop.sock_connect(sock, self.remote), timeout=3)
+                metrics_connect_latency.observe(time.perf_counter() - connect_time)
+            except Exception:
+                sock.close()
+                debug(f"连接池无法连接到 {self.remote[0]}:{self.remote[1]}")
+                debug(traceback.format_exc())
+                await asyncio.sleep(1)
+                continue
+            self.idle.append((sock, time.perf_counter()))
+            await asyncio.sleep(self.interval)
+
+
+async def _recv_packet(loop, sock, data):
+    # type: (asyncio.AbstractEventLoop, socket.socket, bytearray) -> tuple[int, bytes, int] | None
+    """
+    Read into data until it holds a whole packet, None at EOF. data is
+    extended in place, so the caller still has every byte read when this raises.
+    """
+    while True:
+        packet = read_packet(data)
+        if packet is not None:
+            return packet
+        if len(data) > STATUS_MAX_HANDSHAKE:
+            raise ValueError("packet too large")
+        chunk = await asyncio.wait_for(loop.sock_recv(sock, 4096), timeout=STATUS_TIMEOUT)
+        if not chunk:
+            return None
+        data += chunk
+
+class tcp_forwarder:
+    """
+    One TCP mapping: the listener, its ping/pong channel and the options of
+    the service. Several of them can share one event loop.
+    call is the mapped address to ping; None starts a worker without the
+    ping/pong channel. control is the pipe to the supervisor: ("listening",
+    None) is sent once bound, ("pong", None) once the pong connection is
+    accepted and ("lost", None) when the ping fails; ("remap", (mapped_addr,
+    nonce)) and ("disarm", None) come back. Only a connection that starts
+    with the ping of the current nonce is taken as the pong, other clients
+    arriving meanwhile are relayed. Without control a failed ping exits the
+    process. status_cache_ttl > 0 answers Java Edition status requests from
+    a cache. ping_interval is the keepalive period of the ping.
+    """
+    def __init__(self, local, remote, call=None, proxy_protocol_version=None, splice=False, reuseport=False, control=None, pool_size=0, pool_rate=10,
+                 max_connections=0, per_ip_connections=0, per_ip_rate=0, per_ip_burst=10, proxy_protocol_authority=None, proxy_protocol_unique_id=False,
+                 status_cache_ttl=0, ping_interval=PING_INTERVAL):
+        # type: (socket._Address, socket._Address, socket._Address | None, str | None, bool, bool, Connection | control_channel | None, int, float, int, int, float, int, str | None, bool, float, float) -> None
+        self.local = local
+        self.remote = remote
+        self.call = call
+        self.reuseport = reuseport
+        self.control = control
+        self.pool_size = pool_size
+        self.pool_rate = pool_rate
+        self.proxy_protocol_version = proxy_protocol_version
+        self.pp_builder = pp_header_builder(proxy_protocol_version, remote, proxy_protocol_authority, proxy_protocol_unique_id) if proxy_protocol_version else None
+        self.relay = relay_mode(splice)
+        self.limiter = None # type: connection_limiter | None
+        if max_connections or per_ip_connections or per_ip_rate:
+            self.limiter = connection_limiter(max_connections, per_ip_connections, per_ip_rate, per_ip_burst)
+        self.status_cache = None # type: status_cache | None
+        self.client_handler = self.handle_client
+        if status_cache_ttl > 0:
+            self.status_cache = status_cache(status_cache_ttl)
+            self.client_handler = self.handle_client_status
+        self.handle = self.client_handler # type: Callable[[socket.socket, socket._RetAddress], Awaitable[None]]
+        self.backend_pool = None # type: backend_pool | None
+        self.ping_task = None # type: asyncio.Task | None
+        self.ping_interval = ping_interval
+        self.ping_token = PING + ping_nonce() if call is not None else None # type: bytes | None
+
+    async def handle_client(self, local_sock, client_address, initial=b""):
+        # type: (socket.socket, socket._RetAddress, bytes) -> None
+        """initial is data already read from the client, sent to the backend before relaying."""
+        loop = asyncio.get_running_loop()
+        remote_host, remote_port = self.remote[:2]
+        remote_sock = self.backend_pool.get() if self.backend_pool is not None else None
         try:
+            info("新客户端 %s:%s 尝试连接到 %s:%s", client_address[0], client_address[1], remote_host, remote_port)
+            if remote_sock is None:
+                remote_sock = new_tcp_socket()
+                remote_sock.setblocking(False)
+                connect_time = time.perf_counter()
+                await loop.sock_connect(remote_sock, (remote_host, remote_port))
+                metrics_connect_latency.observe(time.perf_counter() - connect_time)
+                pool_info = ""
+            else:
+                pool_info = "（连接池）"
+            local_address = remote_sock.getsockname()
+            info("客户端 %s:%s 已连接，绑定到本地地址 %s:%s%s", client_address[0], client_address[1], local_address[0], local_address[1], pool_info)
+
+            if self.proxy_protocol_version:
+                pp_header = self._build_proxy_protocol_header(client_address)
+                if pp_header:
+                    await loop.sock_sendall(remote_sock, pp_header)
+                    info("已发送 PROXY Protocol %s 头，客户端真实地址 %s:%s", self.proxy_protocol_version, client_address[0], client_address[1])
+            if initial:
+                await loop.sock_sendall(remote_sock, initial)
+        except Exception:
+            metrics_errors.value += 1
+            error("转发错误，客户端 %s:%s 无法连接到 %s:%s", client_address[0], client_address[1], remote_host, remote_port)
+            debug(traceback.format_exc())
+            if remote_sock is not None:
+                remote_sock.close()
+            local_sock.close()
+            return
+        metrics_active.value += 1
+        try:
+            await self.relay(local_sock, remote_sock)
+        finally:
+            metrics_active.value -= 1
+        info("客户端 %s:%s 断开连接", client_address[0], client_address[1])
+
+    async def query_status(self, handshake, client_address):
+        # type: (bytes, socket._RetAddress) -> bytes | None
+        """Send the client's status handshake to the backend and return its raw Status Response packet."""
+        loop = asyncio.get_running_loop()
+        remote = self.remote
+        remote_sock = new_tcp_socket()
+        remote_sock.setblocking(False)
+        try:
+            connect_time = time.perf_counter()
+            await asyncio.wait_for(loop.sock_connect(remote_sock, remote), timeout=STATUS_TIMEOUT)
+            metrics_connect_latency.observe(time.perf_counter() - connect_time)
+            header = (self._build_proxy_protocol_header(client_address) or b"") if self.proxy_protocol_version else b""
+            await loop.sock_sendall(remote_sock, header + handshake + pack_packet(0x00, b""))
+            data = b""
             while True:
-                writer.write(b"ping")
-                await writer.drain()
-                await asyncio.wait_for(reader.read(9999), timeout=3)
-                await asyncio.sleep(1)
+                packet = read_packet(data)
+                if packet is not None:
+                    break
+                chunk = await asyncio.wait_for(loop.sock_recv(remote_sock, 65536), timeout=STATUS_TIMEOUT)
+                if not chunk:
+                    raise ConnectionResetError("backend closed the connection")
+                data += chunk
+            if packet[0] != 0x00:
+                raise ValueError("unexpected packet id %d" % packet[0])
+            return data[:packet[2]]
+        except Exception:
+            metrics_errors.value += 1
+            warning("无法从 %s:%s 获取服务器状态", remote[0], remote[1])
+            debug(traceback.format_exc())
+            return None
         finally:
-            writer.close()
-    except Exception:
-        error(f"ping线程异常，无法连接到pong线程")
-        debug(traceback.format_exc())
-        stop()
-
-async def port_forward(local_host: str, local_port: int, remote_host: str, remote_port: int, call_host: str, call_port: int):
-    global g_handle_client
-    g_handle_client = handle_client_pong
-    sock = new_tcp_socket()
-    sock.bind((local_host, local_port))
-    sock.listen()
-    sock.setblocking(False)
-    server = await asyncio.start_server(
-        lambda r, w: g_handle_client(r, w, remote_host, remote_port),
-        sock = sock
-    )
-    asyncio.create_task(client_ping(call_host, call_port))
-    async with server:
-        pp_info = f"（PROXY Protocol {_proxy_protocol_version}）" if _proxy_protocol_version else ""
-        info(f"开启从 {local_host}:{local_port}({call_host}:{call_port}) 到 {remote_host}:{remote_port} 的端口转发{pp_info}")
-        await server.serve_forever()
-
-def start_tcp_port_forward(local, remote, call, proxy_protocol_version=None):
-    # type: (socket._Address, socket._Address, socket._Address, str | None) -> None
-    set_proxy_protocol_version(proxy_protocol_version)
+            remote_sock.close()
+
+    async def handle_client_status(self, local_sock, client_address, initial=b""):
+        # type: (socket.socket, socket._RetAddress, bytes) -> None
+        """
+        mcje front stage: a handshake with next state 1 is answered from the
+        status cache including the ping, anything else is replayed unchanged
+        to the backend by handle_client. initial is data already read from the client.
+        """
+        loop = asyncio.get_running_loop()
+        data = bytearray(initial) # 已读取的全部数据，不是状态请求时原样转发
+        try:
+            if not data:
+                data += await asyncio.wait_for(loop.sock_recv(local_sock, 4096), timeout=STATUS_TIMEOUT)
+            if not data:
+                local_sock.close()
+                return
+            if data[0] == 0xFE: # 1.6及更早版本的Legacy Server List Ping
+                raise ValueError("legacy ping")
+            packet = await _recv_packet(loop, local_sock, data)
+            if packet is None:
+                raise ValueError("incomplete packet")
+            packet_id, payload, end = packet
+            if packet_id != 0x00:
+                raise ValueError("not a handshake")
+            protocol, address, _, next_state = parse_handshake(payload)
+        except (ValueError, asyncio.TimeoutError):
+            debug("客户端 %s:%s 不是状态请求，直接转发", client_address[0], client_address[1])
+            await self.handle_client(local_sock, client_address, bytes(data))
+            return
+        except OSError:
+            local_sock.close()
+            return
+        if next_state != 1:
+            await self.handle_client(local_sock, client_address, bytes(data))
+            return
+        handshake = bytes(data[:end])
+        del data[:end]
+        try:
+            while True:
+                packet = await _recv_packet(loop, local_sock, data)
+                if packet is None:
+                    break
+                packet_id, payload, end = packet
+                if packet_id == 0x00: # Status Request
+                    response = await self.status_cache.get((address, protocol), lambda: self.query_status(handshake, client_address))
+                    if response is None:
+                        break
+                    await loop.sock_sendall(local_sock, response)
+                elif packet_id == 0x01: # Ping Request，原样返回后由客户端关闭
+                    await loop.sock_sendall(local_sock, data[:end])
+                    break
+                else:
+                    break
+                del data[:end]
+        except (ValueError, asyncio.TimeoutError, OSError):
+            debug(traceback.format_exc())
+        finally:
+            local_sock.close()
+
+    def _build_proxy_protocol_header(self, src_addr):
+        """Build proxy protocol header based on configured version."""
+        try:
+            return self.pp_builder.build(src_addr)
+        except Exception:
+            error("构建 PROXY Protocol 头失败")
+            debug(traceback.format_exc())
+        return None
+
+    async def handle_client_pong(self, local_sock, client_address):
+        # type: (socket.socket, socket._RetAddress) -> None
+        loop = asyncio.get_running_loop()
+        token = self.ping_token
+        data = b""
+        try:
+            while len(data) < len(token) and token.startswith(data):
+                chunk = await asyncio.wait_for(loop.sock_recv(local_sock, 4096), timeout=PING_TOKEN_TIMEOUT)
+                if not chunk:
+                    break
+                data += chunk
+        except asyncio.TimeoutError: # 服务端先发言的协议，客户端不会先发送数据
+            pass
+        except OSError:
+            local_sock.close()
+            return
+        if not data.startswith(token):
+            await self.handle_client_armed(local_sock, client_address, data)
+            return
+        self.handle = self.client_handler
+        info("开始pong线程")
+        if self.control is not None:
+            self.control.send(("pong", None))
+        local_reader, local_writer = await asyncio.open_connection(sock=local_sock)
+        try:
+            local_writer.write(b"pong")
+            while True:
+                data = await asyncio.wait_for(local_reader.read(4096), timeout=max(PONG_TIMEOUT, self.ping_interval * 3))
+                if not data:
+                    break
+                local_writer.write(b"pong")
+                await local_writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            error(f"pong线程异常，可能是ping线程已离线")
+            debug(traceback.format_exc())
+            if self.control is None:
+                stop()
+        finally:
+            local_writer.close()
+
+    async def handle_client_armed(self, local_sock, client_address, initial):
+        # type: (socket.socket, socket._RetAddress, bytes) -> None
+        """A client accepted while waiting for the pong, relayed like any other one."""
+        ip = client_address[0]
+        limiter = self.limiter
+        if limiter is not None and limiter.acquire(ip) is not None:
+            local_sock.close()
+            return
+        try:
+            await self.client_handler(local_sock, client_address, initial)
+        finally:
+            if limiter is not None:
+                limiter.release(ip)
+
+    async def client_ping(self, internet_ip, internet_port):
+        # type: (str, int) -> None
+        info("开始ping线程")
+        token = self.ping_token
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(internet_ip, internet_port), timeout=3)
+            try:
+                while True:
+                    ping_time = time.perf_counter()
+                    writer.write(token)
+                    await writer.drain()
+                    await asyncio.wait_for(reader.read(9999), timeout=3)
+                    metrics_ping_rtt.observe(time.perf_counter() - ping_time)
+                    await asyncio.sleep(self.ping_interval)
+            finally:
+                writer.close()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            error(f"ping线程异常，无法连接到pong线程")
+            debug(traceback.format_exc())
+            if self.control is None:
+                stop()
+            else: # 由主进程重新获取映射地址后发来remap
+                self.control.send(("lost", None))
+
+    def handle_control(self, message, value):
+        # type: (str, Any) -> None
+        """
+        remap: the mapped address changed, restart the ping (owner only) with
+        the new nonce and take the connection carrying it as the pong;
+        relayed connections stay.
+        disarm: another worker got the pong connection.
+        """
+        if message == "remap":
+            mapped_addr, nonce = value
+            self.ping_token = PING + nonce
+            if self.ping_task is not None:
+                self.ping_task.cancel()
+                self.ping_task = asyncio.create_task(self.client_ping(*mapped_addr[:2]))
+            self.handle = self.handle_client_pong
+            self.control.send(("armed", None))
+            info("映射地址变更为 %s:%s", mapped_addr[0], mapped_addr[1])
+        elif message == "disarm" and self.handle == self.handle_client_pong:
+            self.handle = self.client_handler
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        local_host, local_port = self.local[:2]
+        remote_host, remote_port = self.remote[:2]
+        if self.pool_size > 0:
+            self.backend_pool = backend_pool(self.remote, self.pool_size, self.pool_rate)
+            _backend_pools.append(self.backend_pool)
+            asyncio.create_task(self.backend_pool.refill())
+        sock = new_tcp_socket(reuseport=self.reuseport)
+        sock.bind((local_host, local_port))
+        sock.listen()
+        sock.setblocking(False)
+        if self.control is not None:
+            self.control.send(("listening", None))
+        pp_info = f"（PROXY Protocol {self.proxy_protocol_version}）" if self.proxy_protocol_version else ""
+        splice_info = "（splice）" if self.relay is splice_relay else ""
+        pool_info = f"（连接池 {self.pool_size}）" if self.pool_size > 0 else ""
+        if self.call is None: # 附属worker，ping-pong由主worker负责
+            info(f"开启从 {local_host}:{local_port} 到 {remote_host}:{remote_port} 的端口转发{pp_info}{splice_info}{pool_info}")
+        else:
+            call_host, call_port = self.call[:2]
+            self.handle = self.handle_client_pong
+            self.ping_task = asyncio.create_task(self.client_ping(call_host, call_port))
+            info(f"开启从 {local_host}:{local_port}({call_host}:{call_port}) 到 {remote_host}:{remote_port} 的端口转发{pp_info}{splice_info}{pool_info}")
+        if self.control is not None:
+            watch_control(self.control, self.handle_control)
+        limiter = self.limiter
+        clients = set()
+        with sock:
+            while True:
+                try:
+                    client_sock, client_address = await loop.sock_accept(sock)
+                except OSError as e:
+                    if e.errno in ACCEPT_RESOURCE_ERRNOS:
+                        error("接受新连接失败: %s，%s 秒后重试", e, ACCEPT_RETRY_DELAY)
+                        await asyncio.sleep(ACCEPT_RETRY_DELAY)
+                    elif isinstance(e, (ConnectionError, InterruptedError, BlockingIOError)) or e.errno in ACCEPT_TRANSIENT_ERRNOS:
+                        debug("接受新连接失败: %s", e)
+                    else:
+                        raise
+                    continue
+                client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                metrics_accepted.value += 1
+                limited = limiter is not None and self.handle != self.handle_client_pong
+                if limited and limiter.acquire(client_address[0]) is not None:
+                    client_sock.close()
+                    continue
+                task = asyncio.create_task(self.handle(client_sock, client_address))
+                clients.add(task)
+                task.add_done_callback(clients.discard)
+                if limited:
+                    task.add_done_callback(lambda _, ip=client_address[0]: limiter.release(ip))
+
+def start_tcp_port_forward(local, remote, call, proxy_protocol_version=None, splice=False, reuseport=False, control=None, event_loop=None, pool_size=0, pool_rate=10, metrics_port=None,
+                           max_connections=0, per_ip_connections=0, per_ip_rate=0, per_ip_burst=10, proxy_protocol_authority=None, proxy_protocol_unique_id=False,
+                           status_cache_ttl=0, ping_interval=PING_INTERVAL):
+    # type: (socket._Address, socket._Address, socket._Address | None, str | None, bool, bool, Connection | None, str | None, int, float, int | None, int, int, float, int, str | None, bool, float, float) -> None
+    """Run a single tcp_forwarder, see there for the arguments."""
+    forwarder = tcp_forwarder(local, remote, call, proxy_protocol_version, splice, reuseport, control, pool_size, pool_rate,
+                              max_connections, per_ip_connections, per_ip_rate, per_ip_burst, proxy_protocol_authority, proxy_protocol_unique_id,
+                              status_cache_ttl, ping_interval)
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port)
     try:
-        asyncio.run(port_forward(*local, *remote, *call))
+        run_event_loop(forwarder.start(), event_loop)
     except (KeyboardInterrupt, SystemExit):
         return
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+__author__ = "Guation"
+
+from typing import Hashable
+
+class timer_wheel:
+    """
+    Hashed timer wheel with `tick` second resolution. A key is stored in the
+    slot of its deadline and each step only looks at the slots that came
+    due, deadlines more than one revolution away are kept for a later round.
+    Keys fire at most one tick late.
+    """
+    def __init__(self, tick, slots, now):
+        # type: (float, int, float) -> None
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)] # type: list[dict[Hashable, float]]
+        self.current = int(now / tick) # 已处理到的slot序号（不含）
+        self.size = 0
+
+    def add(self, key, deadline):
+        # type: (Hashable, float) -> int
+        """Schedule key, returns the handle needed by remove()."""
+        index = max(int(deadline / self.tick), self.current)
+        self.slots[index % len(self.slots)][key] = deadline
+        self.size += 1
+        return index
+
+    def remove(self, key, index):
+        # type: (Hashable, int) -> None
+        if self.slots[index % len(self.slots)].pop(key, None) is not None:
+            self.size -= 1
+
+    def advance(self, now):
+        # type: (float) -> list[Hashable]
+        """Pop the keys whose deadline is before the last elapsed tick."""
+        due = []
+        target = int(now / self.tick)
+        if target - self.current > len(self.slots): # 长时间未推进，每个slot只需看一次
+            self.current = target - len(self.slots)
+        while self.current < target:
+            end = (self.current + 1) * self.tick
+            slot = self.slots[self.current % len(self.slots)]
+            expired = [k for k, deadline in slot.items() if deadline < end]
+            for k in expired:
+                del slot[k]
+            due += expired
+            self.current += 1
+        self.size -= len(due)
+        return due
+
+    def __len__(self):
+        return self.size
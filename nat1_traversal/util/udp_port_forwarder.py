@@ -3,128 +3,629 @@
 
 __author__ = "Guation"
 
-import selectors, traceback, os, sys, time, socket
+import asyncio, collections, errno, random, selectors, traceback, os, sys, time, socket
 from logging import debug, info, warning, error, exception
-from .stun import new_udp_socket, MTU
-from typing import Callable
+from .stun import new_udp_socket, MTU, IS_WINDOWS
+from .event_loop import run_event_loop, watch_control, ping_nonce, PING
+from .mmsg import mmsg_available, mmsg_buffer
+from .timer_wheel import timer_wheel
+from .motd import build_unconnected_ping, build_unconnected_pong, is_unconnected_ping, parse_unconnected_pong
+from .gso import GRO_ANCBUFSIZE, GSO_MAX_SIZE, UDP_MAX_SEGMENTS, enable_gro, gro_segment_size, gso_available, gso_cmsg
+from .metrics import registry, start_metrics_server
+from .log_queue import stop_log_queue, suppressed_lines
+from typing import Any, Callable
+
+metrics = registry()
+metrics_sessions = metrics.counter("nat1_udp_sessions_total", "Created client sessions")
+metrics_packets_up = metrics.counter("nat1_udp_packets_total", "Relayed datagrams", {"direction": "client_to_backend"})
+metrics_packets_down = metrics.counter("nat1_udp_packets_total", "Relayed datagrams", {"direction": "backend_to_client"})
+metrics_bytes_up = metrics.counter("nat1_udp_bytes_total", "Relayed bytes", {"direction": "client_to_backend"})
+metrics_bytes_down = metrics.counter("nat1_udp_bytes_total", "Relayed bytes", {"direction": "backend_to_client"})
+metrics_errors = metrics.counter("nat1_udp_relay_errors_total", "Relay errors")
+metrics_evicted = metrics.counter("nat1_udp_sessions_evicted_total", "Least recently active sessions closed to admit a new source")
+metrics_rejected = {
+    reason: metrics.counter("nat1_udp_sessions_rejected_total", "New sources dropped by the session limits", {"reason": reason})
+    for reason in ("max_sessions", "per_prefix")
+}
+metrics.counter_func("nat1_log_suppressed_total", "Log lines dropped by rate limiting or a full log queue", suppressed_lines)
+metrics_raknet_pings = {
+    result: metrics.counter("nat1_udp_raknet_pings_total", "RakNet Unconnected Pings from sources without a session", {"result": result})
+    for result in ("answered", "dropped")
+}
+metrics_ping_rtt = metrics.histogram("nat1_ping_rtt_seconds", "Ping/pong round-trip time through the mapped address")
+_session_tables = [] # type: list[session_table]
+metrics.gauge_func("nat1_udp_active_sessions", "Client sessions not yet expired", lambda: sum(len(x) for x in _session_tables))
+
+UDP_ENGINES = ("selector", "asyncio")
+SESSION_TIMEOUT = 30
+EXPIRE_TICK = 1
+EXPIRE_SLOTS = 64
+PING_INTERVAL = 1
+MAX_DATAGRAM_SIZE = 65535
+FD_RESERVE = 64 # 留给监听、ping/pong、metrics等的fd
+RAKNET_PONG_INTERVAL = 5
+RAKNET_PONG_MAX_AGE = 3 # 超过该倍数的刷新间隔未收到pong时认为后端不可用
+
+_gso_send = True
+
+def send_segments(sock, data, segment, addr=None):
+    # type: (socket.socket, memoryview, int, socket._Address | None) -> None
+    """Send data as datagrams of `segment` bytes, in one UDP_SEGMENT call while the kernel accepts it."""
+    global _gso_send
+    if _gso_send:
+        try:
+            if addr is None:
+                sock.sendmsg([data], [gso_cmsg(segment)])
+            else:
+                sock.sendmsg([data], [gso_cmsg(segment)], 0, addr)
+            return
+        except OSError as e:
+            if e.errno == errno.EINVAL: # 分段大于路径MTU，本次逐个发送
+                pass
+            elif e.errno in (errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP): # EIO: 出口网卡不支持校验和卸载
+                _gso_send = False
+                warning("UDP GSO发送失败(%s)，改为逐个发送", e)
+            else:
+                raise
+    for offset in range(0, len(data), segment):
+        if addr is None:
+            sock.send(data[offset:offset + segment])
+        else:
+            sock.sendto(data[offset:offset + segment], addr)
+
+class raknet_pong_cache:
+    """
+    Last Unconnected Pong of the backend, refreshed every `interval` seconds
+    through a socket of its own. Pings from sources without a session are
+    answered from it, so server list scans do not open sessions.
+    """
+    def __init__(self, remote, interval=RAKNET_PONG_INTERVAL):
+        # type: (socket._Address, float) -> None
+        client_socket = new_udp_socket()
+        client_socket.setblocking(False)
+        client_socket.connect(remote)
+        self.sock = client_socket
+        self.interval = interval
+        self.guid = random.getrandbits(63)
+        self.pong = None # type: tuple[int, bytes] | None
+        self.pong_time = 0.0
+
+    def ping(self):
+        # type: () -> bytes
+        return build_unconnected_ping(int(time.time() * 1000), self.guid)
+
+    def request(self):
+        try:
+            self.sock.send(self.ping())
+        except OSError:
+            debug("RakNet ping发送失败\n%s", traceback.format_exc())
+
+    def handle(self):
+        try:
+            data = self.sock.recv(MTU)
+        except OSError: # 后端未启动时会收到ICMP端口不可达
+            return
+        self.store(data)
+
+    def store(self, data):
+        # type: (bytes) -> None
+        try:
+            self.pong = parse_unconnected_pong(data)
+        except ValueError:
+            return
+        self.pong_time = time.perf_counter()
+
+    def reply(self, data):
+        # type: (bytes | memoryview) -> bytes | None
+        """Pong answering an Unconnected Ping, b"" when no fresh pong is cached, None for other packets."""
+        if not is_unconnected_ping(data):
+            return None
+        if self.pong is None or time.perf_counter() - self.pong_time > self.interval * RAKNET_PONG_MAX_AGE:
+            metrics_raknet_pings["dropped"].value += 1
+            return b""
+        metrics_raknet_pings["answered"].value += 1
+        return build_unconnected_pong(data, *self.pong)
+
+def default_max_sessions():
+    # type: () -> int
+    """Session cap derived from the fd limit, each session holds one socket."""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, OSError, ValueError):
+        return 4096
+    if soft == resource.RLIM_INFINITY:
+        return 65536
+    return max(soft - FD_RESERVE, 16)
+
+def source_prefix(source):
+    # type: (socket._Address) -> str | bytes
+    """/24 for IPv4 and /64 for IPv6 sources."""
+    if ":" in source[0]:
+        return socket.inet_pton(socket.AF_INET6, source[0].split("%")[0])[:8]
+    return source[0].rsplit(".", 1)[0]
+
+class session_table:
+    """
+    Sessions by source address, bounded by max_sessions and per_prefix
+    (0 means unlimited). Eviction order is an approximate LRU: packets only
+    refresh client.lifetime, an entry that was active since it was queued
+    is moved to the back when it reaches the front instead of evicted.
+    """
+    def __init__(self, max_sessions=0, per_prefix=0):
+        # type: (int, int) -> None
+        self.max_sessions = max_sessions
+        self.per_prefix = per_prefix
+        self.sessions = collections.OrderedDict() # type: collections.OrderedDict[socket._Address, client_handle | client_protocol]
+        self.prefixes = dict() # type: dict[str | bytes, int]
+        self.pinned = None # type: socket._Address | None # 重定向到pong的会话，不会被淘汰
+        self.get = self.sessions.get
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __getitem__(self, source):
+        return self.sessions[source]
+
+    def admit(self, source):
+        # type: (socket._Address) -> bool
+        return not self.per_prefix or self.prefixes.get(source_prefix(source), 0) < self.per_prefix
+
+    def full(self):
+        # type: () -> bool
+        return bool(self.max_sessions) and len(self.sessions) >= self.max_sessions
+
+    def add(self, source, client):
+        # type: (socket._Address, client_handle | client_protocol) -> None
+        self.sessions[source] = client
+        client.order_time = client.lifetime
+        if self.per_prefix:
+            prefix = source_prefix(source)
+            self.prefixes[prefix] = self.prefixes.get(prefix, 0) + 1
+
+    def pop(self, source):
+        # type: (socket._Address) -> client_handle | client_protocol
+        client = self.sessions.pop(source)
+        if self.per_prefix:
+            prefix = source_prefix(source)
+            if self.prefixes[prefix] <= 1:
+                del self.prefixes[prefix]
+            else:
+                self.prefixes[prefix] -= 1
+        return client
+
+    def lru(self):
+        # type: () -> socket._Address | None
+        sessions = self.sessions
+        for _ in range(len(sessions) * 2):
+            source, client = next(iter(sessions.items()))
+            if source != self.pinned and client.lifetime <= client.order_time:
+                return source
+            client.order_time = client.lifetime
+            sessions.move_to_end(source)
+        return None
 
 def stop():
+    stop_log_queue() # os._exit不会等待日志线程，先写出队列中的日志
     sys.stderr.flush()
     sys.stdout.flush()
     os._exit(0)
 
 class server_handle:
-    def __init__(self, local, remote, call) -> None:
-        # type: (socket._Address, socket._Address, socket._Address) -> None
+    def __init__(self, local, remote, call, batch=1, mmsg=None, session_timeout=SESSION_TIMEOUT, max_sessions=0, per_prefix=0,
+                 reuseport=False, control=None, pong_redirect=None, max_datagram=MAX_DATAGRAM_SIZE, gso=False, raknet_pong_interval=0, ping_interval=PING_INTERVAL) -> None:
+        # type: (socket._Address, socket._Address, socket._Address | None, int, mmsg_buffer | None, float, int, int, bool, Connection | None, tuple | None, int, bool, float, float) -> None
+        """
+        call is the mapped address to ping; None starts a shard without the
+        ping/pong channel, which relays pong_redirect = (source, pong_addr)
+        to the owner's pong socket in case the kernel hashes the ping there.
+        While waiting for the pong only a new source whose first datagram is
+        the ping of the current nonce is taken as the pong.
+        """
         self.remote = remote
-        server_socket = new_udp_socket()
+        self.batch = batch
+        self.mmsg = mmsg
+        # 单线程循环中所有socket共用一个接收缓冲区，收到后立即转发
+        self.view = memoryview(bytearray(max_datagram))
+        self.max_datagram = max_datagram
+        # GRO接收的合并包及GSO待发送的burst，最大为64KiB外加一个数据包
+        self.gso_view = memoryview(bytearray(65535 + max_datagram)) if gso else None
+        self.session_timeout = session_timeout
+        self.expire_wheel = timer_wheel(EXPIRE_TICK, EXPIRE_SLOTS, time.perf_counter())
+        server_socket = new_udp_socket(reuseport=reuseport)
         server_socket.bind(local)
         server_socket.setblocking(False)
         self.sock = server_socket
         self.sel = selectors.DefaultSelector()
-        self.sel.register(server_socket, selectors.EVENT_READ, self.handle)
-        self.client_maps = dict()
-        self.create_client = self.create_client2
-        self.pong = pong_handle()
-        self.sel.register(self.pong.sock, selectors.EVENT_READ, self.pong.handle)
-        self.ping = ping_handle(call)
-        self.sel.register(self.ping.sock, selectors.EVENT_READ, self.ping.handle)
+        if gso:
+            enable_gro(server_socket)
+            self.sel.register(server_socket, selectors.EVENT_READ, self.handle_gro)
+        else:
+            self.sel.register(server_socket, selectors.EVENT_READ, self.handle)
+        self.client_maps = session_table(max_sessions, per_prefix)
+        self.control = control
+        self.ping_interval = ping_interval
+        self.ping_token = PING + ping_nonce() if call is not None else None # type: bytes | None
+        if call is not None:
+            self.create_client = self.create_client2
+            self.pong = pong_handle()
+            self.sel.register(self.pong.sock, selectors.EVENT_READ, self.pong.handle)
+            self.pong_source, self.pong_addr = None, self.pong.sock.getsockname()
+            self.ping = ping_handle(call, self.ping_token, ping_interval)
+            self.sel.register(self.ping.sock, selectors.EVENT_READ, self.ping.handle)
+        else:
+            self.create_client = self.create_client1
+            self.pong_source, self.pong_addr = pong_redirect or (None, None)
+            self.pong = None
+            self.ping = None
+        if control is not None and not IS_WINDOWS: # Windows上管道无法select，在定时检查中轮询
+            self.sel.register(control, selectors.EVENT_READ, self.poll_control)
+        if control is not None:
+            control.send(("listening", None))
+        self.raknet = None # type: raknet_pong_cache | None
+        if raknet_pong_interval > 0:
+            self.raknet = raknet_pong_cache(remote, raknet_pong_interval)
+            self.sel.register(self.raknet.sock, selectors.EVENT_READ, self.raknet.handle)
+        _session_tables.append(self.client_maps)
 
     def create_client1(self, source):
         # type: (socket._Address) -> client_handle
+        if source == self.pong_source:
+            return self.create_pong_client(source)
         client_socket = new_udp_socket()
         client_socket.setblocking(False)
         client_socket.connect(self.remote)
-        ch = client_handle(client_socket, source, self.sock.sendto)
-        self.sel.register(client_socket, selectors.EVENT_READ, ch.handle)
-        info(f"新客户端 {source[0]}:{source[1]} ，绑定到本地地址 {client_socket.getsockname()[0]}:{client_socket.getsockname()[1]}")
+        ch = client_handle(client_socket, source, self)
+        self.sel.register(client_socket, selectors.EVENT_READ, ch.handle if self.gso_view is None else ch.handle_gso)
+        metrics_sessions.value += 1
+        info("新客户端 %s:%s ，绑定到本地地址 %s:%s", source[0], source[1], *client_socket.getsockname()[:2])
         return ch
 
     def create_client2(self, source): # 第一个连接重定向到ping-pong
         # type: (socket._Address) -> client_handle
         self.create_client = self.create_client1
+        self.pong_source = source
+        ch = self.create_pong_client(source)
+        if self.control is not None:
+            self.control.send(("pong", (source, self.pong_addr)))
+        return ch
+
+    def create_pong_client(self, source):
+        # type: (socket._Address) -> client_handle
+        self.client_maps.pinned = source
         client_socket = new_udp_socket()
         client_socket.setblocking(False)
-        client_socket.connect(self.pong.sock.getsockname())
-        ch = client_handle(client_socket, source, self.sock.sendto)
-        self.sel.register(client_socket, selectors.EVENT_READ, ch.handle)
+        client_socket.connect(self.pong_addr)
+        ch = client_handle(client_socket, source, self)
+        self.sel.register(client_socket, selectors.EVENT_READ, ch.handle if self.gso_view is None else ch.handle_gso)
         return ch
 
-    def clear_client(self):
-        target_time = time.perf_counter() - 30
-        need_del = []
-        for k, v in self.client_maps.items():
-            if v.lifetime < target_time:
-                need_del.append(k)
-                self.sel.unregister(v.sock)
-                v.sock.close()
-                info(f"客户端 {k[0]}:{k[1]} 停止活动，断开连接")
-        for i in need_del:
-            del self.client_maps[i]
+    def add_client(self, source, data):
+        # type: (socket._Address, bytes | memoryview) -> client_handle | None
+        """Open a session for a new source whose first datagram is data, None when the limits reject it."""
+        if not self.client_maps.admit(source):
+            metrics_rejected["per_prefix"].value += 1
+            debug("客户端 %s:%s 所在网段会话数已达上限", source[0], source[1])
+            return None
+        if self.client_maps.full():
+            evict = self.client_maps.lru()
+            if evict is None:
+                metrics_rejected["max_sessions"].value += 1
+                return None
+            metrics_evicted.value += 1
+            self.remove_client(evict)
+            debug("会话数已达上限，已断开最久未活动的客户端 %s:%s", evict[0], evict[1])
+        create_client = self.create_client
+        if create_client == self.create_client2 and data != self.ping_token: # 等待pong时到来的普通客户端
+            create_client = self.create_client1
+        try:
+            client = create_client(source)
+        except OSError:
+            metrics_errors.value += 1
+            warning("转发错误，无法为客户端 %s:%s 创建会话", source[0], source[1])
+            debug(traceback.format_exc())
+            return None
+        self.client_maps.add(source, client)
+        client.expire_handle = self.expire_wheel.add(source, client.lifetime + self.session_timeout)
+        return client
+
+    def poll_control(self):
+        while self.control is not None and self.control.poll():
+            try:
+                self.handle_control(*self.control.recv())
+            except EOFError: # 主进程已退出
+                stop()
+
+    def handle_control(self, message, value):
+        # type: (str, Any) -> None
+        """
+        remap: the mapped address changed, restart the ping (owner only) with
+        the new nonce and take the new source sending it as the pong;
+        relayed sessions stay.
+        disarm: another shard got the pong source.
+        """
+        if message == "remap":
+            mapped_addr, nonce = value
+            self.ping_token = PING + nonce
+            if self.pong is not None:
+                self.restart_ping(mapped_addr)
+            self.create_client = self.create_client2
+            self.control.send(("armed", None))
+            info("映射地址变更为 %s:%s", mapped_addr[0], mapped_addr[1])
+        elif message == "disarm" and self.create_client == self.create_client2:
+            self.create_client = self.create_client1
+
+    def restart_ping(self, call):
+        # type: (socket._Address | None) -> None
+        if self.ping is not None:
+            self.sel.unregister(self.ping.sock)
+            self.ping.sock.close()
+            self.ping = None
+        if call is not None:
+            self.ping = ping_handle(call, self.ping_token, self.ping_interval)
+            self.sel.register(self.ping.sock, selectors.EVENT_READ, self.ping.handle)
+            self.ping.first_send()
+
+    def answer_ping(self, data, source):
+        # type: (bytes | memoryview, socket._Address) -> bool
+        """True when data from a source without a session was a RakNet ping handled locally."""
+        pong = self.raknet.reply(data)
+        if pong is None:
+            return False
+        if pong:
+            try:
+                self.sock.sendto(pong, source)
+            except OSError:
+                pass
+        return True
+
+    def remove_client(self, source):
+        # type: (socket._Address) -> None
+        client = self.client_maps.pop(source)
+        self.expire_wheel.remove(source, client.expire_handle)
+        self.sel.unregister(client.sock)
+        client.sock.close()
+
+    def clear_client(self, now):
+        # type: (float) -> None
+        """Only sessions whose timer came due are looked at; active ones are rescheduled."""
+        for k in self.expire_wheel.advance(now):
+            v = self.client_maps[k]
+            deadline = v.lifetime + self.session_timeout
+            if deadline > now:
+                v.expire_handle = self.expire_wheel.add(k, deadline)
+                continue
+            self.remove_client(k)
+            info("客户端 %s:%s 停止活动，断开连接", k[0], k[1])
 
     def handle(self):
-        data, source = self.sock.recvfrom(MTU)
-        client = self.client_maps.get(source)
-        if client is None:
-            client = self.create_client(source)
-            self.client_maps[source] = client
-        client.lifetime = time.perf_counter()
-        client.sock.send(data)
+        if self.mmsg is not None:
+            self.handle_mmsg()
+            return
+        view = self.view
+        now = time.perf_counter()
+        packets = total = 0
+        try:
+            for _ in range(self.batch):
+                size, source = self.sock.recvfrom_into(view)
+                client = self.client_maps.get(source)
+                if client is None:
+                    if self.raknet is not None and self.answer_ping(view[:size], source):
+                        continue
+                    client = self.add_client(source, view[:size])
+                    if client is None:
+                        continue
+                client.lifetime = now
+                client.sock.send(view[:size])
+                packets += 1
+                total += size
+        except BlockingIOError:
+            pass
+        finally:
+            metrics_packets_up.value += packets
+            metrics_bytes_up.value += total
+
+    def handle_mmsg(self):
+        datagrams = self.mmsg.recv(self.sock, self.batch)
+        now = time.perf_counter()
+        batches = {} # type: dict[client_handle, list[bytes]]
+        for data, source in datagrams:
+            client = self.client_maps.get(source)
+            if client is None:
+                if self.raknet is not None and self.answer_ping(data, source):
+                    continue
+                client = self.add_client(source, data)
+                if client is None:
+                    continue
+            client.lifetime = now
+            batches.setdefault(client, []).append(data)
+            metrics_bytes_up.value += len(data)
+        for client, batch in batches.items():
+            self.mmsg.send(client.sock, batch)
+        metrics_packets_up.value += len(datagrams)
+
+    def handle_gro(self):
+        view = self.gso_view
+        now = time.perf_counter()
+        packets = total = 0
+        try:
+            for _ in range(self.batch):
+                size, ancdata, _, source = self.sock.recvmsg_into([view], GRO_ANCBUFSIZE)
+                segment = gro_segment_size(ancdata, size)
+                client = self.client_maps.get(source)
+                if client is None:
+                    first = view[:segment] if 0 < segment < size else view[:size] # 合并的数据包中只有第一个是新客户端的首包
+                    if self.raknet is not None and self.answer_ping(first, source):
+                        continue
+                    client = self.add_client(source, first)
+                    if client is None:
+                        continue
+                client.lifetime = now
+                if 0 < segment < size: # 内核合并的同长度数据包，原样以GSO发往后端
+                    send_segments(client.sock, view[:size], segment)
+                    packets += -(-size // segment)
+                else:
+                    client.sock.send(view[:size])
+                    packets += 1
+                total += size
+        except BlockingIOError:
+            pass
+        finally:
+            metrics_packets_up.value += packets
+            metrics_bytes_up.value += total
 
     def start(self):
-        clean_time = time.perf_counter() + 30
+        clean_time = time.perf_counter() + EXPIRE_TICK
         ping_time = time.perf_counter() + 1
-        self.ping.first_send()
+        raknet_time = time.perf_counter() if self.raknet is not None else float("inf")
+        if self.ping is not None:
+            self.ping.first_send()
         while True:
             events = self.sel.select(timeout=0.1)
             for key, mask in events:
                 key.data()
             now_time = time.perf_counter()
             if clean_time <= now_time:
-                clean_time = now_time + 30
-                self.clear_client()
-            if ping_time <= now_time:
-                ping_time = now_time + 1
-                self.ping.send()
+                clean_time = now_time + EXPIRE_TICK
+                self.clear_client(now_time)
+                if IS_WINDOWS:
+                    self.poll_control()
+            if ping_time <= now_time and self.ping is not None:
+                ping_time = now_time + self.ping.delay()
+                if not self.ping.send():
+                    error(f"ping线程异常，无法收到pong线程响应")
+                    if self.control is None:
+                        stop()
+                    else: # 由主进程重新获取映射地址后发来remap
+                        self.restart_ping(None)
+                        self.control.send(("lost", None))
+            if raknet_time <= now_time:
+                raknet_time = now_time + self.raknet.interval
+                self.raknet.request()
 
 class client_handle:
-    def __init__(self, sock, source, send_func):
-        # type: (socket.socket, socket._Address, Callable[[bytes, socket._Address], None]) -> None
+    def __init__(self, sock, source, server):
+        # type: (socket.socket, socket._Address, server_handle) -> None
         self.sock = sock
         self.source = source
-        self.send_func = send_func
+        self.server_sock = server.sock
+        self.view = server.view
+        self.gso_view = server.gso_view
+        self.max_datagram = server.max_datagram
+        self.batch = server.batch
+        self.mmsg = server.mmsg
         self.lifetime = time.perf_counter()
+        self.order_time = self.lifetime
+        self.expire_handle = 0
 
     def handle(self):
+        packets = total = 0
         try:
-            self.send_func(self.sock.recv(MTU), self.source)
+            if self.mmsg is not None:
+                datagrams = [data for data, _ in self.mmsg.recv(self.sock, self.batch, False)]
+                self.mmsg.send(self.server_sock, datagrams, self.source)
+                packets, total = len(datagrams), sum(map(len, datagrams))
+            else:
+                view = self.view
+                for _ in range(self.batch):
+                    size = self.sock.recv_into(view)
+                    self.server_sock.sendto(view[:size], self.source)
+                    packets += 1
+                    total += size
+        except BlockingIOError:
+            pass
         except OSError:
+            metrics_errors.value += 1
             warning(f"转发错误，客户端 {self.source[0]}:{self.source[1]} 无法连接到 {self.sock.getpeername()[0]}:{self.sock.getpeername()[1]}")
             debug(traceback.format_exc())
+        metrics_packets_down.value += packets
+        metrics_bytes_down.value += total
+
+    def handle_gso(self):
+        """
+        Coalesce a burst of equally sized datagrams from the backend (the
+        last one may be shorter) and send it to the client in one GSO call.
+        """
+        view = self.gso_view
+        off = segment = count = 0
+        packets = total = 0
+        try:
+            for _ in range(self.batch):
+                size = self.sock.recv_into(view[off:off + self.max_datagram])
+                packets += 1
+                total += size
+                if count and (size > segment or not segment or count >= UDP_MAX_SEGMENTS or off + size > GSO_MAX_SIZE):
+                    self.flush(off, segment, count)
+                    view[:size] = view[off:off + size]
+                    off = count = 0
+                if not count:
+                    segment = size
+                off += size
+                count += 1
+                if size < segment: # 较短的数据包只能作为最后一段
+                    self.flush(off, segment, count)
+                    off = count = 0
+            if count:
+                self.flush(off, segment, count)
+        except BlockingIOError:
+            if count:
+                self.flush(off, segment, count)
+        except OSError:
+            metrics_errors.value += 1
+            warning("转发错误，客户端 %s:%s 无法连接到 %s:%s", self.source[0], self.source[1], *self.sock.getpeername()[:2])
+            debug(traceback.format_exc())
+        metrics_packets_down.value += packets
+        metrics_bytes_down.value += total
+
+    def flush(self, size, segment, count):
+        # type: (int, int, int) -> None
+        if count == 1:
+            self.server_sock.sendto(self.gso_view[:size], self.source)
+        else:
+            send_segments(self.server_sock, self.gso_view[:size], segment, self.source)
 
 class ping_handle:
-    def __init__(self, remote):
-        # type: (socket._Address) -> None
+    def __init__(self, remote, token, interval=PING_INTERVAL):
+        # type: (socket._Address, bytes, float) -> None
         client_socket = new_udp_socket()
         client_socket.setblocking(False)
         client_socket.connect(remote)
         self.sock = client_socket
+        self.token = token
         self.lost = 0
+        self.interval = interval
+        self.ping_time = time.perf_counter()
         info("开始ping线程")
 
+    def delay(self):
+        # type: () -> float
+        """Seconds until the next ping: the keepalive interval, PING_INTERVAL while pings go unanswered."""
+        return self.interval if self.lost == 0 else PING_INTERVAL
+
     def first_send(self):
         for _ in range(3):
-            self.sock.send(b"ping")
+            self.sock.send(self.token)
 
     def send(self):
+        # type: () -> bool
+        """False once 5 pings in a row went unanswered."""
         self.lost += 1
         if self.lost >= 5:
-            error(f"ping线程异常，无法收到pong线程响应")
-            stop()
-        self.sock.send(b"ping")
+            return False
+        self.ping_time = time.perf_counter()
+        try:
+            self.sock.send(self.token)
+        except OSError: # 映射地址失效时可能收到ICMP不可达
+            debug(traceback.format_exc())
+        return True
 
     def handle(self):
-        if self.sock.recv(MTU) == b"pong":
+        try:
+            data = self.sock.recv(MTU)
+        except OSError:
+            return
+        if data == b"pong":
+            metrics_ping_rtt.observe(time.perf_counter() - self.ping_time)
             self.lost = 0
 
 class pong_handle:
@@ -138,9 +639,352 @@ class pong_handle:
 
     def handle(self):
         data, source = self.sock.recvfrom(MTU)
-        if data == b"ping":
+        if data.startswith(PING):
             self.sock.sendto(b"pong", source)
 
-def start_udp_port_forward(local, remote, call):
-    # type: (socket._Address, socket._Address, socket._Address) -> None
-    server_handle(local, remote, call).start()
+# --- asyncio implementation ---
+
+class server_protocol(asyncio.DatagramProtocol):
+    """
+    asyncio counterpart of server_handle. Session expiry, ping and pong run
+    on call_later timers, so nothing wakes up while the forwarder is idle.
+    """
+    def __init__(self, remote, pong_addr, session_timeout=SESSION_TIMEOUT, max_sessions=0, per_prefix=0, control=None, pong_source=None, raknet=None):
+        # type: (socket._Address, socket._Address, float, int, int, Connection | None, socket._Address | None, raknet_pong_cache | None) -> None
+        self.remote = remote
+        self.raknet = raknet
+        self.pong_addr = pong_addr
+        self.pong_source = pong_source
+        self.control = control
+        self.session_timeout = session_timeout
+        self.loop = asyncio.get_running_loop()
+        self.transport = None # type: asyncio.DatagramTransport | None
+        self.client_maps = session_table(max_sessions, per_prefix)
+        self.ping_token = None # type: bytes | None
+        self.create_client = self.create_client2 if pong_source is None else self.create_client1
+        _session_tables.append(self.client_maps)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def new_client(self, source, remote):
+        # type: (socket._Address, socket._Address) -> client_protocol
+        client_socket = new_udp_socket()
+        client_socket.setblocking(False)
+        client_socket.connect(remote)
+        client = client_protocol(self, source, client_socket)
+        self.loop.create_task(client.open())
+        return client
+
+    def create_client1(self, source):
+        # type: (socket._Address) -> client_protocol
+        if source == self.pong_source:
+            self.client_maps.pinned = source
+            return self.new_client(source, self.pong_addr)
+        client = self.new_client(source, self.remote)
+        metrics_sessions.value += 1
+        info("新客户端 %s:%s ，绑定到本地地址 %s:%s", source[0], source[1], *client.sock.getsockname()[:2])
+        return client
+
+    def create_client2(self, source): # 第一个连接重定向到ping-pong
+        # type: (socket._Address) -> client_protocol
+        self.create_client = self.create_client1
+        self.pong_source = source
+        self.client_maps.pinned = source
+        client = self.new_client(source, self.pong_addr)
+        if self.control is not None:
+            self.control.send(("pong", (source, self.pong_addr)))
+        return client
+
+    def add_client(self, source, data):
+        # type: (socket._Address, bytes) -> client_protocol | None
+        """Open a session for a new source whose first datagram is data, None when the limits reject it."""
+        if not self.client_maps.admit(source):
+            metrics_rejected["per_prefix"].value += 1
+            debug("客户端 %s:%s 所在网段会话数已达上限", source[0], source[1])
+            return None
+        if self.client_maps.full():
+            evict = self.client_maps.lru()
+            if evict is None:
+                metrics_rejected["max_sessions"].value += 1
+                return None
+            metrics_evicted.value += 1
+            self.client_maps.pop(evict).close()
+            debug("会话数已达上限，已断开最久未活动的客户端 %s:%s", evict[0], evict[1])
+        create_client = self.create_client
+        if create_client == self.create_client2 and data != self.ping_token: # 等待pong时到来的普通客户端
+            create_client = self.create_client1
+        try:
+            client = create_client(source)
+        except OSError:
+            metrics_errors.value += 1
+            warning("转发错误，无法为客户端 %s:%s 创建会话", source[0], source[1])
+            debug(traceback.format_exc())
+            return None
+        self.client_maps.add(source, client)
+        return client
+
+    def remove_client(self, source):
+        # type: (socket._Address) -> None
+        client = self.client_maps.pop(source)
+        client.close()
+        info("客户端 %s:%s 停止活动，断开连接", source[0], source[1])
+
+    def datagram_received(self, data, source):
+        client = self.client_maps.get(source)
+        if client is None:
+            if self.raknet is not None:
+                pong = self.raknet.reply(data)
+                if pong is not None:
+                    if pong:
+                        self.transport.sendto(pong, source)
+                    return
+            client = self.add_client(source, data)
+            if client is None:
+                return
+        client.send(data)
+        metrics_packets_up.value += 1
+        metrics_bytes_up.value += len(data)
+
+class client_protocol(asyncio.DatagramProtocol):
+    def __init__(self, server, source, sock):
+        # type: (server_protocol, socket._Address, socket.socket) -> None
+        self.server = server
+        self.source = source
+        self.sock = sock
+        self.loop = server.loop
+        self.transport = None # type: asyncio.DatagramTransport | None
+        self.pending = [] # type: list[bytes] | None
+        self.lifetime = self.loop.time()
+        self.order_time = self.lifetime
+        # 每个数据包只刷新lifetime，定时器到期时再决定是否顺延
+        self.timer = self.loop.call_later(server.session_timeout, self.expire)
+
+    async def open(self):
+        # type: () -> None
+        try:
+            await self.loop.create_datagram_endpoint(lambda: self, sock=self.sock)
+        except Exception:
+            metrics_errors.value += 1
+            error("转发错误，客户端 %s:%s 无法创建会话", self.source[0], self.source[1])
+            debug(traceback.format_exc())
+            self.sock.close()
+            # 与clear_client一致释放会话，下一个数据包会重新创建；已被淘汰时不在表中
+            if self.server.client_maps.get(self.source) is self:
+                self.server.client_maps.pop(self.source)
+            self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.pending is None: # 会话在创建完成前已被关闭
+            transport.close()
+            return
+        for data in self.pending:
+            transport.sendto(data)
+        self.pending = None
+
+    def send(self, data):
+        # type: (bytes) -> None
+        self.lifetime = self.loop.time()
+        if self.transport is not None:
+            self.transport.sendto(data)
+        elif self.pending is not None:
+            self.pending.append(data)
+
+    def expire(self):
+        remain = self.lifetime + self.server.session_timeout - self.loop.time()
+        if remain > 0:
+            self.timer = self.loop.call_later(remain, self.expire)
+        else:
+            self.server.remove_client(self.source)
+
+    def close(self):
+        self.timer.cancel()
+        self.pending = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        self.server.transport.sendto(data, self.source)
+        metrics_packets_down.value += 1
+        metrics_bytes_down.value += len(data)
+
+    def error_received(self, exc):
+        metrics_errors.value += 1
+        warning("转发错误，客户端 %s:%s 无法连接到 %s:%s", self.source[0], self.source[1], *self.sock.getpeername()[:2])
+        debug("%r", exc)
+
+class ping_protocol(asyncio.DatagramProtocol):
+    def __init__(self, token, control=None, interval=PING_INTERVAL):
+        # type: (bytes, Connection | None, float) -> None
+        self.loop = asyncio.get_running_loop()
+        self.token = token
+        self.control = control
+        self.interval = interval
+        self.transport = None # type: asyncio.DatagramTransport | None
+        self.timer = None # type: asyncio.TimerHandle | None
+        self.lost = 0
+        self.ping_time = time.perf_counter()
+        info("开始ping线程")
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(3):
+            transport.sendto(self.token)
+        self.timer = self.loop.call_later(PING_INTERVAL, self.send)
+
+    def send(self):
+        self.lost += 1
+        if self.lost >= 5:
+            error(f"ping线程异常，无法收到pong线程响应")
+            if self.control is None:
+                stop()
+            else: # 由主进程重新获取映射地址后发来remap
+                self.close()
+                self.control.send(("lost", None))
+            return
+        self.ping_time = time.perf_counter()
+        self.transport.sendto(self.token)
+        self.timer = self.loop.call_later(PING_INTERVAL if self.lost > 1 else self.interval, self.send)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        if data == b"pong":
+            metrics_ping_rtt.observe(time.perf_counter() - self.ping_time)
+            self.lost = 0
+
+    def error_received(self, exc):
+        debug("ping %r", exc)
+
+class pong_protocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None # type: asyncio.DatagramTransport | None
+        info("开始pong线程")
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.startswith(PING):
+            self.transport.sendto(b"pong", addr)
+
+class raknet_protocol(asyncio.DatagramProtocol):
+    """Socket of raknet_pong_cache on the asyncio engine, add_reader is not available on the Windows ProactorEventLoop."""
+    def __init__(self, raknet):
+        # type: (raknet_pong_cache) -> None
+        self.raknet = raknet
+
+    def datagram_received(self, data, addr):
+        self.raknet.store(data)
+
+    def error_received(self, exc): # 后端未启动时会收到ICMP端口不可达
+        pass
+
+async def start_raknet_refresh(raknet):
+    # type: (raknet_pong_cache) -> None
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: raknet_protocol(raknet), sock=raknet.sock)
+    def refresh():
+        if transport.is_closing():
+            return
+        transport.sendto(raknet.ping())
+        loop.call_later(raknet.interval, refresh)
+    refresh()
+
+async def start_ping(call, token, control=None, interval=PING_INTERVAL):
+    # type: (socket._Address, bytes, Connection | None, float) -> ping_protocol
+    ping_socket = new_udp_socket()
+    ping_socket.setblocking(False)
+    ping_socket.connect(call)
+    _, ping = await asyncio.get_running_loop().create_datagram_endpoint(lambda: ping_protocol(token, control, interval), sock=ping_socket)
+    return ping
+
+async def udp_port_forward(local, remote, call, session_timeout=SESSION_TIMEOUT, max_sessions=0, per_prefix=0, reuseport=False, control=None, pong_redirect=None,
+                           raknet_pong_interval=0, ping_interval=PING_INTERVAL):
+    # type: (socket._Address, socket._Address, socket._Address | None, float, int, int, bool, Connection | control_channel | None, tuple | None, float, float) -> None
+    loop = asyncio.get_running_loop()
+    server_socket = new_udp_socket(reuseport=reuseport)
+    server_socket.bind(local)
+    server_socket.setblocking(False)
+    raknet = None
+    if raknet_pong_interval > 0:
+        raknet = raknet_pong_cache(remote, raknet_pong_interval)
+        await start_raknet_refresh(raknet)
+    ping = None # type: ping_protocol | None
+    if call is None:
+        pong_source, pong_addr = pong_redirect or (None, None)
+        _, server = await loop.create_datagram_endpoint(lambda: server_protocol(remote, pong_addr, session_timeout, max_sessions, per_prefix, control, pong_source, raknet),
+                                                        sock=server_socket)
+    else:
+        pong_transport, _ = await loop.create_datagram_endpoint(pong_protocol, local_addr=("127.0.0.1", 0))
+        pong_addr = pong_transport.get_extra_info("sockname")
+        _, server = await loop.create_datagram_endpoint(lambda: server_protocol(remote, pong_addr, session_timeout, max_sessions, per_prefix, control, raknet=raknet),
+                                                        sock=server_socket)
+        server.ping_token = PING + ping_nonce()
+        ping = await start_ping(call, server.ping_token, control, ping_interval)
+    if control is not None:
+        control.send(("listening", None))
+    async def remap(call):
+        # type: (socket._Address) -> None
+        nonlocal ping
+        ping.close()
+        ping = await start_ping(call, server.ping_token, control, ping_interval)
+    def handle_control(message, value):
+        # type: (str, Any) -> None
+        """Same as server_handle.handle_control."""
+        if message == "remap":
+            mapped_addr, nonce = value
+            server.ping_token = PING + nonce
+            if ping is not None:
+                loop.create_task(remap(mapped_addr))
+            server.create_client = server.create_client2
+            control.send(("armed", None))
+            info("映射地址变更为 %s:%s", mapped_addr[0], mapped_addr[1])
+        elif message == "disarm" and server.create_client == server.create_client2:
+            server.create_client = server.create_client1
+    if control is not None:
+        watch_control(control, handle_control)
+    await loop.create_future()
+
+def start_udp_port_forward(local, remote, call, metrics_port=None, engine=None, event_loop=None, batch=1, mmsg=False, session_timeout=SESSION_TIMEOUT,
+                           max_sessions=None, per_prefix=0, reuseport=False, control=None, pong_redirect=None, max_datagram=MAX_DATAGRAM_SIZE, gso=False,
+                           raknet_pong_interval=0, ping_interval=PING_INTERVAL):
+    # type: (socket._Address, socket._Address, socket._Address | None, int | None, str | None, str | None, int, bool, float, int | None, int, bool, Connection | None, tuple | None, int, bool, float, float) -> None
+    """
+    call is the mapped address to ping; None starts a shard without the
+    ping/pong channel. control is the pipe to the supervisor: every process
+    sends ("listening", None) once bound, whoever takes the ping session
+    sends ("pong", (source, pong_addr)), shards get it as pong_redirect;
+    the owner sends ("lost", None) when the ping fails and gets ("remap",
+    (mapped_addr, nonce)) back. Without control it exits instead.
+    raknet_pong_interval > 0 answers RakNet Unconnected Pings (mcbe) from
+    a pong of the backend refreshed at that interval. ping_interval is the
+    keepalive period of the ping, unanswered pings are retried every second.
+    """
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port)
+    if max_sessions is None:
+        max_sessions = default_max_sessions()
+    debug("UDP会话数上限 %d，每个网段上限 %d", max_sessions, per_prefix)
+    if engine == "asyncio":
+        run_event_loop(udp_port_forward(local, remote, call, session_timeout, max_sessions, per_prefix, reuseport, control, pong_redirect, raknet_pong_interval, ping_interval), event_loop)
+        return
+    if gso:
+        if gso_available():
+            debug("UDP转发使用GRO/GSO")
+        else:
+            warning("当前系统不支持UDP GRO/GSO，使用逐个收发")
+            gso = False
+    mmsg_buf = None
+    if mmsg and not gso:
+        if mmsg_available():
+            mmsg_buf = mmsg_buffer(batch, max_datagram)
+            debug("UDP转发使用recvmmsg/sendmmsg")
+        else:
+            warning("当前系统不支持recvmmsg/sendmmsg，使用逐个收发")
+    server_handle(local, remote, call, batch, mmsg_buf, session_timeout, max_sessions, per_prefix, reuseport, control, pong_redirect, max_datagram, gso, raknet_pong_interval, ping_interval).start()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 在仓库根目录执行：python3 -m unittest discover -s tests
+
+__author__ = "Guation"
+
+import unittest
+from unittest import mock
+from nat1_traversal.util import tcp_port_forwarder
+from nat1_traversal.util.tcp_port_forwarder import connection_limiter
+
+class fake_clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def perf_counter(self):
+        return self.now
+
+class connection_limiter_test(unittest.TestCase):
+    def setUp(self):
+        self.clock = fake_clock()
+        patcher = mock.patch.object(tcp_port_forwarder, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_max_connections(self):
+        limiter = connection_limiter(2, 0, 0, 10)
+        self.assertIsNone(limiter.acquire("1.1.1.1"))
+        self.assertIsNone(limiter.acquire("2.2.2.2"))
+        self.assertEqual(limiter.acquire("3.3.3.3"), "max_connections")
+        limiter.release("1.1.1.1")
+        self.assertIsNone(limiter.acquire("3.3.3.3"))
+
+    def test_per_ip_connections(self):
+        limiter = connection_limiter(0, 1, 0, 10)
+        self.assertIsNone(limiter.acquire("1.1.1.1"))
+        self.assertEqual(limiter.acquire("1.1.1.1"), "per_ip_connections")
+        self.assertIsNone(limiter.acquire("2.2.2.2"))
+        limiter.release("1.1.1.1")
+        self.assertNotIn("1.1.1.1", limiter.active)
+        self.assertIsNone(limiter.acquire("1.1.1.1"))
+
+    def test_bucket_refill(self):
+        limiter = connection_limiter(0, 0, 2, 3)
+        for _ in range(3):
+            self.assertIsNone(limiter.acquire("1.1.1.1"))
+        self.assertEqual(limiter.acquire("1.1.1.1"), "per_ip_rate")
+        self.assertIsNone(limiter.acquire("2.2.2.2")) # 桶按IP独立
+        self.clock.now += 0.5 # 补充1个令牌
+        self.assertIsNone(limiter.acquire("1.1.1.1"))
+        self.assertEqual(limiter.acquire("1.1.1.1"), "per_ip_rate")
+        self.clock.now += 100 # 最多回满到burst
+        for _ in range(3):
+            self.assertIsNone(limiter.acquire("1.1.1.1"))
+        self.assertEqual(limiter.acquire("1.1.1.1"), "per_ip_rate")
+
+    def test_rejected_attempt_keeps_partial_token(self):
+        limiter = connection_limiter(0, 0, 1, 1)
+        self.assertIsNone(limiter.acquire("1.1.1.1"))
+        for _ in range(5):
+            self.clock.now += 0.5
+            self.assertEqual(limiter.acquire("1.1.1.1"), "per_ip_rate") # 被拒绝时补充的半个令牌保留到下一次
+            self.clock.now += 0.5
+            self.assertIsNone(limiter.acquire("1.1.1.1"))
+
+    def test_prune_on_acquire(self):
+        limiter = connection_limiter(0, 0, 1, 5) # 5秒回满
+        interval = max(limiter.refill_time, tcp_port_forwarder.LIMIT_PRUNE_INTERVAL)
+        limiter.acquire("1.1.1.1")
+        self.clock.now += interval - 1
+        limiter.acquire("2.2.2.2")
+        self.clock.now += 1 # 1.1.1.1已回满，2.2.2.2刚连接
+        limiter.acquire("3.3.3.3")
+        self.assertEqual(list(limiter.buckets), ["2.2.2.2", "3.3.3.3"])
+
+    def test_prune_waits_for_interval(self):
+        limiter = connection_limiter(0, 0, 1, 5)
+        limiter.acquire("1.1.1.1")
+        self.clock.now += limiter.refill_time # 已回满，但未到清理间隔
+        limiter.acquire("2.2.2.2")
+        self.assertEqual(list(limiter.buckets), ["1.1.1.1", "2.2.2.2"])
+
+    def test_prune_keeps_recently_connected(self):
+        limiter = connection_limiter(0, 0, 1, 5)
+        interval = max(limiter.refill_time, tcp_port_forwarder.LIMIT_PRUNE_INTERVAL)
+        limiter.acquire("1.1.1.1")
+        limiter.acquire("2.2.2.2")
+        self.clock.now += interval - 1
+        limiter.acquire("1.1.1.1") # 重新插入到末尾
+        self.clock.now += 1
+        limiter.acquire("3.3.3.3")
+        self.assertEqual(list(limiter.buckets), ["1.1.1.1", "3.3.3.3"])
+        self.assertLess(limiter.buckets["1.1.1.1"][0], limiter.per_ip_burst) # 未回满的桶保留了欠下的令牌
+
+    def test_bucket_cap_evicts_least_recent(self):
+        with mock.patch.object(tcp_port_forwarder, "LIMIT_MAX_BUCKETS", 3):
+            limiter = connection_limiter(0, 0, 1, 5)
+            for ip in ("1.1.1.1", "2.2.2.2", "3.3.3.3"):
+                limiter.acquire(ip)
+            limiter.acquire("1.1.1.1")
+            limiter.acquire("4.4.4.4")
+            self.assertEqual(list(limiter.buckets), ["3.3.3.3", "1.1.1.1", "4.4.4.4"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 在仓库根目录执行：python3 -m unittest discover -s tests
+
+__author__ = "Guation"
+
+import struct, unittest
+from nat1_traversal.util.motd import pack_varint, read_varint, pack_packet, read_packet, parse_handshake
+
+def handshake_payload(protocol=763, address=b"localhost", port=25565, next_state=1):
+    # type: (int, bytes, int, int) -> bytes
+    return pack_varint(protocol) + pack_varint(len(address)) + address + struct.pack(">H", port) + pack_varint(next_state)
+
+class varint_test(unittest.TestCase):
+    def test_round_trip(self):
+        for value in (0, 1, 127, 128, 255, 300, 16383, 16384, 2 ** 21, 2 ** 31 - 1, 2 ** 32 - 1):
+            data = pack_varint(value)
+            self.assertEqual(read_varint(data), (value, len(data)))
+            self.assertEqual(read_varint(b"\xff" + data + b"tail", 1), (value, len(data) + 1))
+
+    def test_truncated(self):
+        for data in (b"", b"\x80", b"\xff\xff", b"\x80\x80\x80\x80"):
+            with self.assertRaises(IndexError):
+                read_varint(data)
+        with self.assertRaises(IndexError):
+            read_varint(b"\x01", 1)
+
+    def test_too_long(self):
+        with self.assertRaises(ValueError):
+            read_varint(b"\x80\x80\x80\x80\x80\x01")
+        with self.assertRaises(ValueError):
+            read_varint(b"\xff" * 5) # 第5个字节仍有后续标志
+
+class read_packet_test(unittest.TestCase):
+    def test_complete(self):
+        data = pack_packet(0x00, b"payload")
+        self.assertEqual(read_packet(data), (0x00, b"payload", len(data)))
+
+    def test_back_to_back(self):
+        first, second = pack_packet(0x00, b"abc"), pack_packet(0x01, b"\x00" * 300)
+        data = first + second
+        packet_id, payload, end = read_packet(data)
+        self.assertEqual((packet_id, payload, end), (0x00, b"abc", len(first)))
+        self.assertEqual(read_packet(data, end), (0x01, b"\x00" * 300, len(data)))
+
+    def test_incomplete(self):
+        data = pack_packet(0x00, b"\x00" * 200) # 2字节长度
+        for size in range(len(data)):
+            self.assertIsNone(read_packet(data[:size]), size)
+
+    def test_malformed(self):
+        for data in (
+            b"\x00", # 长度为0
+            b"\x80\x80\x80\x80\x80\x01", # 长度超过5字节
+            b"\x01\x80", # 包ID超出包长度
+            b"\x02\x80\x80", # 包ID在包内未结束
+        ):
+            with self.assertRaises(ValueError, msg=data):
+                read_packet(data)
+
+    def test_oversized_length_is_incomplete(self):
+        self.assertIsNone(read_packet(pack_varint(2 ** 31 - 1) + b"\x00")) # 上限由调用方的STATUS_MAX_HANDSHAKE负责
+
+class parse_handshake_test(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(parse_handshake(handshake_payload()), (763, "localhost", 25565, 1))
+        self.assertEqual(parse_handshake(handshake_payload(5, "例子.example".encode("utf8"), 1, 2)), (5, "例子.example", 1, 2))
+        self.assertEqual(parse_handshake(handshake_payload(address=b"")), (763, "", 25565, 1))
+
+    def test_truncated(self):
+        payload = handshake_payload()
+        for size in range(len(payload)):
+            with self.assertRaises(ValueError, msg=size):
+                parse_handshake(payload[:size])
+
+    def test_malformed(self):
+        for payload in (
+            handshake_payload(address=b"\xff\xfe"), # 非UTF-8地址
+            pack_varint(763) + pack_varint(100) + b"short" + b"\x63\xdd\x01", # 地址长度超出数据
+            pack_varint(763) + b"\xff\xff\xff\xff\xff\xff", # 地址长度超过5字节
+            handshake_payload()[:-1] + b"\x80", # next state未结束
+        ):
+            with self.assertRaises(ValueError, msg=payload):
+                parse_handshake(payload)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 在仓库根目录执行：python3 -m unittest discover -s tests
+
+__author__ = "Guation"
+
+import struct, unittest
+from nat1_traversal.util.proxy_protocol import pp_header_builder, build_pp_v1_header, build_pp_v2_header, PP2_SIGNATURE, PP2_TYPE_AUTHORITY, \
+    PP2_TYPE_UNIQUE_ID, PP2_UNIQUE_ID_LENGTH
+
+SOURCES_V4 = [("192.0.2.1", 1), ("203.0.113.254", 65535), ("0.0.0.0", 0)]
+SOURCES_V6 = [("2001:db8::1", 25565), ("::ffff:192.0.2.1", 12345), ("fe80::1:2:3:4", 1)]
+
+def split_v2(header):
+    # type: (bytes) -> tuple[bytes, list[tuple[int, bytes]]]
+    """Address block and TLVs of a v2 header, checks the signature and the length field."""
+    assert header.startswith(PP2_SIGNATURE)
+    fam_proto, length = struct.unpack_from("!xBH", header, len(PP2_SIGNATURE))
+    body = header[len(PP2_SIGNATURE) + 4:]
+    assert len(body) == length, (len(body), length)
+    addr_len = 12 if fam_proto >> 4 == 1 else 36
+    offset, tlvs = addr_len, []
+    while offset < len(body):
+        _type, size = struct.unpack_from("!BH", body, offset)
+        value = body[offset + 3:offset + 3 + size]
+        assert len(value) == size
+        tlvs.append((_type, value))
+        offset += 3 + size
+    return body[:addr_len], tlvs
+
+class pp_header_builder_test(unittest.TestCase):
+    def test_v1_matches_legacy(self):
+        for dst, sources in ((("198.51.100.7", 25565), SOURCES_V4), (("2001:db8::7", 19132), SOURCES_V6)):
+            builder = pp_header_builder("v1", dst)
+            for src in sources:
+                self.assertEqual(builder.build(src), build_pp_v1_header(src, dst))
+
+    def test_v2_matches_legacy(self):
+        for dst, sources in ((("198.51.100.7", 25565), SOURCES_V4), (("2001:db8::7", 19132), SOURCES_V6)):
+            builder = pp_header_builder("v2", dst)
+            for src in sources:
+                self.assertEqual(builder.build(src), build_pp_v2_header(src, dst))
+
+    def test_family_mismatch_falls_back(self):
+        def outcome(build, *args):
+            try:
+                return build(*args)
+            except OSError as e:
+                return type(e)
+        for version, legacy in (("v1", build_pp_v1_header), ("v2", build_pp_v2_header)):
+            for src, dst in ((("192.0.2.1", 1), ("2001:db8::7", 19132)), (("2001:db8::1", 1), ("198.51.100.7", 25565))):
+                self.assertEqual(outcome(pp_header_builder(version, dst).build, src), outcome(legacy, src, dst))
+
+    def test_returns_copies(self):
+        builder = pp_header_builder("v2", ("198.51.100.7", 25565))
+        first = builder.build(SOURCES_V4[0])
+        builder.build(SOURCES_V4[1])
+        self.assertEqual(first, build_pp_v2_header(SOURCES_V4[0], ("198.51.100.7", 25565)))
+
+    def test_authority_tlv(self):
+        dst = ("198.51.100.7", 25565)
+        builder = pp_header_builder("v2", dst, authority="mc.example.com")
+        header = builder.build(SOURCES_V4[0])
+        addr, tlvs = split_v2(header)
+        self.assertEqual(addr, split_v2(build_pp_v2_header(SOURCES_V4[0], dst))[0])
+        self.assertEqual(tlvs, [(PP2_TYPE_AUTHORITY, b"mc.example.com")])
+        utf8 = pp_header_builder("v2", ("2001:db8::7", 19132), authority="例子.example")
+        self.assertEqual(split_v2(utf8.build(SOURCES_V6[0]))[1], [(PP2_TYPE_AUTHORITY, "例子.example".encode("utf-8"))])
+
+    def test_unique_id_tlv(self):
+        dst = ("2001:db8::7", 19132)
+        builder = pp_header_builder("v2", dst, authority="a", unique_id=True)
+        ids = []
+        for src in SOURCES_V6:
+            addr, tlvs = split_v2(builder.build(src))
+            self.assertEqual(addr, split_v2(build_pp_v2_header(src, dst))[0])
+            self.assertEqual([x[0] for x in tlvs], [PP2_TYPE_AUTHORITY, PP2_TYPE_UNIQUE_ID])
+            self.assertEqual(len(tlvs[1][1]), PP2_UNIQUE_ID_LENGTH)
+            ids.append(struct.unpack("!QQ", tlvs[1][1]))
+        self.assertEqual(len({x[0] for x in ids}), 1) # 同一进程前缀相同
+        self.assertEqual([x[1] for x in ids], [1, 2, 3]) # 计数器逐个连接递增
+
+    def test_unique_id_prefix_per_builder(self):
+        dst = ("198.51.100.7", 25565)
+        a = split_v2(pp_header_builder("v2", dst, unique_id=True).build(SOURCES_V4[0]))[1][0][1]
+        b = split_v2(pp_header_builder("v2", dst, unique_id=True).build(SOURCES_V4[0]))[1][0][1]
+        self.assertNotEqual(a[:8], b[:8])
+
+if __name__ == "__main__":
+    unittest.main()
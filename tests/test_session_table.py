@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 在仓库根目录执行：python3 -m unittest discover -s tests
+
+__author__ = "Guation"
+
+import unittest
+from nat1_traversal.util.udp_port_forwarder import session_table, source_prefix
+
+class fake_client:
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.order_time = 0.0
+
+def fill(table, sources, lifetime=0.0):
+    # type: (session_table, list, float) -> dict
+    clients = {}
+    for source in sources:
+        clients[source] = fake_client(lifetime)
+        table.add(source, clients[source])
+    return clients
+
+A, B, C, D = (("192.0.2.%d" % x, 1000 + x) for x in range(1, 5))
+
+class session_table_test(unittest.TestCase):
+    def test_lru_is_oldest(self):
+        table = session_table(3)
+        fill(table, [A, B, C])
+        self.assertTrue(table.full())
+        self.assertEqual(table.lru(), A)
+        table.pop(A)
+        self.assertFalse(table.full())
+        self.assertEqual(table.lru(), B)
+
+    def test_active_entry_moves_back(self):
+        table = session_table(3)
+        clients = fill(table, [A, B, C])
+        clients[A].lifetime = 5.0 # A在入队后收到过数据包
+        self.assertEqual(table.lru(), B)
+        self.assertEqual(list(table.sessions), [B, C, A])
+        self.assertEqual(clients[A].order_time, 5.0)
+        table.pop(B)
+        self.assertEqual(table.lru(), C) # A刷新后的位置在C之后
+
+    def test_all_active_still_evicts(self):
+        table = session_table(3)
+        clients = fill(table, [A, B, C])
+        for client in clients.values():
+            client.lifetime = 5.0
+        self.assertEqual(table.lru(), A) # 一轮后全部重新排队，按新顺序淘汰
+
+    def test_pinned_is_never_evicted(self):
+        table = session_table(3)
+        fill(table, [A, B, C])
+        table.pinned = A
+        self.assertEqual(table.lru(), B)
+        self.assertEqual(list(table.sessions)[-1], A)
+        table.pop(B)
+        table.pop(C)
+        self.assertIsNone(table.lru()) # 只剩pong会话时拒绝新会话
+
+    def test_per_prefix(self):
+        table = session_table(0, 2)
+        fill(table, [A, B])
+        self.assertFalse(table.admit(C)) # 同一个/24
+        self.assertTrue(table.admit(("198.51.100.1", 1)))
+        table.pop(A)
+        self.assertTrue(table.admit(C))
+        table.pop(B)
+        self.assertEqual(table.prefixes, {})
+
+    def test_ipv6_prefix(self):
+        self.assertEqual(source_prefix(("2001:db8:0:1::1", 1)), source_prefix(("2001:db8:0:1:ffff::2", 2, 0, 0)))
+        self.assertNotEqual(source_prefix(("2001:db8:0:1::1", 1)), source_prefix(("2001:db8:0:2::1", 1)))
+        self.assertEqual(source_prefix(("fe80::1%eth0", 1)), source_prefix(("fe80::2", 1)))
+        table = session_table(0, 1)
+        fill(table, [("2001:db8:0:1::1", 1, 0, 0)])
+        self.assertFalse(table.admit(("2001:db8:0:1::2", 1, 0, 0)))
+        self.assertTrue(table.admit(("2001:db8:0:2::1", 1, 0, 0)))
+
+    def test_unlimited(self):
+        table = session_table()
+        fill(table, [A, B, C, D])
+        self.assertFalse(table.full())
+        self.assertTrue(table.admit(A))
+        self.assertEqual(len(table), 4)
+        self.assertIs(table.get(A), table[A])
+
+if __name__ == "__main__":
+    unittest.main()
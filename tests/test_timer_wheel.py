@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# 在仓库根目录执行：python3 -m unittest discover -s tests
+
+__author__ = "Guation"
+
+import random, unittest
+from nat1_traversal.util.timer_wheel import timer_wheel
+
+class timer_wheel_test(unittest.TestCase):
+    def test_fires_after_deadline(self):
+        wheel = timer_wheel(1, 8, 100.0)
+        wheel.add("a", 102.5)
+        self.assertEqual(wheel.advance(102.9), [])
+        self.assertEqual(wheel.advance(103.0), ["a"]) # 至多晚一个tick
+        self.assertEqual(wheel.advance(110.0), [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_deadline_fires_on_next_tick(self):
+        wheel = timer_wheel(1, 8, 100.0)
+        wheel.add("a", 50.0)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(101.0), ["a"])
+
+    def test_wrap_around(self):
+        wheel = timer_wheel(1, 4, 0.0)
+        wheel.add("far", 10.5) # 与2.x同一个slot，需要两圈之后
+        wheel.add("near", 2.5)
+        self.assertEqual(wheel.advance(3.0), ["near"])
+        self.assertEqual(wheel.advance(7.0), [])
+        self.assertEqual(wheel.advance(10.9), [])
+        self.assertEqual(wheel.advance(11.0), ["far"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_long_gap(self):
+        wheel = timer_wheel(1, 4, 0.0)
+        deadlines = {"k%d" % i: i + 0.5 for i in range(20)}
+        for key, deadline in deadlines.items():
+            wheel.add(key, deadline)
+        wheel.add("later", 1000.5)
+        self.assertEqual(sorted(wheel.advance(500.0)), sorted(deadlines)) # 只看每个slot一次
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(1000.9), [])
+        self.assertEqual(wheel.advance(1001.0), ["later"])
+
+    def test_remove(self):
+        wheel = timer_wheel(1, 4, 0.0)
+        handle = wheel.add("a", 9.5)
+        wheel.add("b", 9.5)
+        wheel.remove("a", handle)
+        wheel.remove("a", handle) # 重复删除无影响
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(20.0), ["b"])
+
+    def test_reschedule(self):
+        wheel = timer_wheel(1, 4, 0.0)
+        handle = wheel.add("a", 2.5)
+        wheel.remove("a", handle)
+        wheel.add("a", 6.5) # 同一个slot的下一圈
+        self.assertEqual(wheel.advance(3.0), [])
+        self.assertEqual(wheel.advance(7.0), ["a"])
+
+    def test_fractional_tick(self):
+        wheel = timer_wheel(0.25, 16, 0.0)
+        wheel.add("a", 1.1)
+        self.assertEqual(wheel.advance(1.2), [])
+        self.assertEqual(wheel.advance(1.25), ["a"])
+
+    def test_random_against_reference(self):
+        rng = random.Random(1)
+        wheel = timer_wheel(1, 16, 0.0)
+        pending = {}
+        now = 0.0
+        for i in range(2000):
+            now += rng.choice((0.3, 1, 2.7, 17, 40))
+            for key in wheel.advance(now):
+                deadline = pending.pop(key)[0]
+                self.assertLess(deadline, int(now)) # 截止时间所在的tick已结束
+            for key, (deadline, added) in pending.items():
+                self.assertGreaterEqual(max(deadline, added), int(now)) # 没有漏掉到期的键，添加时已过期的在下一个tick触发
+            key = "k%d" % i
+            deadline = now + rng.uniform(-2, 100) # 含添加时已过期的截止时间
+            pending[key] = (deadline, int(now))
+            wheel.add(key, deadline)
+            self.assertEqual(len(wheel), len(pending))
+
+if __name__ == "__main__":
+    unittest.main()